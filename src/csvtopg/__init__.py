@@ -1,13 +1,24 @@
-from pkg_resources import DistributionNotFound, get_distribution
+import sys
 
 __author__ = "Alexandre Gravier"
 __copyright__ = "Alexandre Gravier"
 __license__ = "GPLv3"
-try:
-    # Change here if project is renamed and does not equal the package name
-    dist_name = __name__
-    __version__ = get_distribution(dist_name).version
-except DistributionNotFound:
-    __version__ = 'unknown'
-finally:
-    del get_distribution, DistributionNotFound
+
+
+def __getattr__(name: str) -> str:
+    """Look __version__ up on its first access only, importlib.metadata
+    taking a large part of the start-up time of the CLI"""
+    if name != '__version__':
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    if sys.version_info >= (3, 8):
+        from importlib.metadata import PackageNotFoundError, version
+    else:
+        from importlib_metadata import PackageNotFoundError, version
+    try:
+        # Change here if project is renamed and does not equal the package name
+        dist_name = __name__
+        value = version(dist_name)
+    except PackageNotFoundError:
+        value = 'unknown'
+    globals()['__version__'] = value
+    return value
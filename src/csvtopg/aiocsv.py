@@ -1,10 +1,21 @@
+import asyncio
 import csv
 import io
+import time
 import warnings
 from enum import Enum
+from itertools import repeat
+from typing import List, Optional
 
 import aiofile
-from aiofile import LineReader
+from aiofile import LineReader, Reader
+
+from csvtopg.ranges import find_first_record_end
+
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+# chunks of data after the last record found by counting quotes beyond which
+# the records are found by csv.reader instead
+MAX_TAIL_CHUNKS = 4
 
 
 class OnError(Enum):
@@ -18,6 +29,78 @@ class AsyncReaderError(Exception):
     pass
 
 
+def reject_record(reader, policy: OnError, message: str, line_num: int,
+                  row: List[str]):
+    """Apply the error policy of a reader to a record it cannot load: raise,
+    or skip the record after passing it to the `reject` callback of the reader
+    if it has one, or warning about it"""
+    if policy is OnError.exception:
+        raise AsyncReaderError(message)
+    if reader.reject is not None:
+        reader.reject(line_num, message, row)
+    elif policy is OnError.skip_and_warn:
+        warnings.warn(message)
+
+
+def find_records_end(data: bytes, quote: bytes = b'"',
+                     newline: bytes = b'\n') -> int:
+    """Return the position just after the last newline of `data` that is not
+    enclosed in a quoted field, or 0 if `data` holds no complete record. `data`
+    must start on a record boundary. Quotes are assumed to be escaped by
+    doubling them (the csv module default), so that a newline is a record
+    separator if and only if it is preceded by an even number of quotes.
+
+    >>> find_records_end(b'a,b\\n"c\\nd",e')
+    4
+    """
+    pos = data.rfind(newline)
+    if pos == -1:
+        return 0
+    num_quotes = data.count(quote, 0, pos)
+    while num_quotes % 2:
+        previous = data.rfind(newline, 0, pos)
+        if previous == -1:
+            return 0
+        num_quotes -= data.count(quote, previous, pos)
+        pos = previous
+    return pos + 1
+
+
+def chunk_reader(file, chunk_size: int, offset: int = 0):
+    """Return a reader of the file by chunks: an aiofile.Reader for an
+    aiofile.AIOFile, or the reader created by the `reader` method of other
+    files, such as csvtopg.compression.CompressedFile"""
+    if isinstance(file, aiofile.AIOFile):
+        return Reader(file, chunk_size=chunk_size, offset=offset)
+    return file.reader(chunk_size=chunk_size, offset=offset)
+
+
+class ChunkLineReader:
+    """Split the chunks read by a chunk reader in lines, like
+    aiofile.LineReader"""
+
+    def __init__(self, reader, line_sep: str = '\n'):
+        self.reader = reader
+        self.line_sep = line_sep.encode()
+        self.buffer = b''
+        self.position = 0
+
+    async def readline(self) -> bytes:
+        while True:
+            end = self.buffer.find(self.line_sep, self.position)
+            if end != -1:
+                end += len(self.line_sep)
+                line = self.buffer[self.position:end]
+                self.position = end
+                return line
+            chunk = await self.reader.read_chunk()
+            self.buffer = self.buffer[self.position:] + chunk
+            self.position = 0
+            if not chunk:
+                line, self.buffer = self.buffer, b''
+                return line
+
+
 class AsyncReader:
     def __init__(self, aio_file: aiofile.AIOFile, csv_reader,
                  on_empty_line: OnError = OnError.skip_and_warn,
@@ -26,10 +109,15 @@ class AsyncReader:
         self.on_empty_line = on_empty_line
         self.on_wrong_length = on_wrong_length
         self.line_sep = kwargs.pop('line_sep', '\n')
-        self.file_reader = LineReader(
-            aio_file, line_sep=self.line_sep,
-            chunk_size=kwargs.pop('chunk_size', 4096),
-            offset=kwargs.pop('offset', 0))
+        chunk_size = kwargs.pop('chunk_size', 4096)
+        offset = kwargs.pop('offset', 0)
+        if isinstance(aio_file, aiofile.AIOFile):
+            self.file_reader = LineReader(
+                aio_file, line_sep=self.line_sep, chunk_size=chunk_size,
+                offset=offset)
+        else:
+            self.file_reader = ChunkLineReader(
+                chunk_reader(aio_file, chunk_size, offset), self.line_sep)
         self.buffer = io.BytesIO()
         self.csv_reader = csv_reader(
             io.TextIOWrapper(
@@ -39,10 +127,17 @@ class AsyncReader:
             ), **kwargs)
         self.line_num = 0
         self.expected_num_fields = -1
+        # called with the line number, the reason and the fields of the
+        # skipped records, e.g. to write them to csvtopg.deadletters
+        self.reject = None
+        self.io_time = 0.  # cumulative, in seconds
+        self.parse_time = 0.
 
     async def readline(self):
         self.line_num += 1
+        t0 = time.perf_counter()
         line = await self.file_reader.readline()
+        self.io_time += time.perf_counter() - t0
         while line == self.line_sep and \
                 self.on_empty_line is not OnError.leroy_jenkins:
             if self.on_empty_line is OnError.exception:
@@ -51,9 +146,15 @@ class AsyncReader:
                 warnings.warn(f'Empty line at line {self.line_num}')
             self.line_num += 1
             print(f'ignoring line {self.line_num}: {repr(line)}')
+            t0 = time.perf_counter()
             line = await self.file_reader.readline()
+            self.io_time += time.perf_counter() - t0
         return line
 
+    def row_lines(self) -> List[int]:
+        """Return the line number of the last row"""
+        return [self.line_num]
+
     def __aiter__(self):
         return self
 
@@ -69,10 +170,8 @@ class AsyncReader:
                         f'Incorrect record length at line {self.line_num} '
                         f'(expected {self.expected_num_fields}, found '
                         f'{num_fields})')
-                    if self.on_wrong_length is OnError.exception:
-                        raise AsyncReaderError(message)
-                    elif self.on_wrong_length is OnError.skip_and_warn:
-                        warnings.warn(message)
+                    reject_record(self, self.on_wrong_length, message,
+                                  self.line_num, result)
                     result = await self._next_row_no_verify()
                     num_fields = len(result)
         return result
@@ -83,10 +182,13 @@ class AsyncReader:
             raise StopAsyncIteration
         self.buffer.write(line)
         self.buffer.seek(0)
+        t0 = time.perf_counter()
         try:
             result = next(self.csv_reader)
         except StopIteration as e:
             raise StopAsyncIteration from e
+        finally:
+            self.parse_time += time.perf_counter() - t0
         self.buffer.seek(0)
         self.buffer.truncate(0)
         return result
@@ -106,3 +208,315 @@ class AsyncDictReader(AsyncReader):
 class AsyncListReader(AsyncReader):
     def __init__(self, aio_file: aiofile.AIOFile, **kwargs):
         super().__init__(aio_file, csv_reader=csv.reader, **kwargs)
+
+
+class AsyncChunkReader:
+    """Read a CSV file by large blocks and parse all the complete records of
+    each block in a single csv.reader pass. Iterating yields lists of rows, one
+    per block. The partial record at the end of a block is carried over to the
+    next one. Record boundaries are found on the raw bytes, so the encoding
+    must be ASCII-compatible (utf-8, latin-1...). The `offset` and `end`
+    keyword arguments restrict reading to a byte range, which must start and
+    end on record boundaries. `aio_file` may also be a compressed file opened
+    with csvtopg.compression.CompressedFile, in which case the offsets are
+    positions in the decompressed data.
+
+    The csv module accepts quotes inside unquoted fields, such as 12" ruler,
+    after which no newline looks like the end of a record when counting
+    quotes. When more than MAX_TAIL_CHUNKS chunks follow the last record
+    found, the end of the records is found by csv.reader instead, so that the
+    rest of the file is not carried over and scanned again with each block.
+    A newline inside a quoted field following such a quote still looks like
+    the end of a record: the line reader parses these files correctly.
+    """
+
+    def __init__(self, aio_file: aiofile.AIOFile,
+                 on_empty_line: OnError = OnError.skip_and_warn,
+                 on_wrong_length: OnError = OnError.skip_and_warn,
+                 **kwargs):
+        self.on_empty_line = on_empty_line
+        self.on_wrong_length = on_wrong_length
+        self.newline = kwargs.pop('line_sep', '\n').encode()[-1:]
+        self.quote = kwargs.get('quotechar', '"').encode()
+        self.encoding = kwargs.pop('encoding', 'utf-8')
+        self.errors = kwargs.pop('errors', 'replace')
+        self.position = kwargs.pop('offset', 0)
+        self.end = kwargs.pop('end', None)
+        chunk_size = kwargs.pop('chunk_size', DEFAULT_BLOCK_SIZE)
+        self.file_reader = chunk_reader(aio_file, chunk_size, self.position)
+        self.max_tail = MAX_TAIL_CHUNKS * chunk_size
+        self.csv_kwargs = kwargs
+        self.records_end = self.position  # offset after the parsed records
+        self.tail = b''
+        self.eof = False
+        self.line_num = 0
+        self.expected_num_fields = -1
+        # csvtopg.columns.Projection of the rows, applied as soon as parsed
+        self.projection = None
+        # called with the line number, the reason and the fields of the
+        # skipped records, e.g. to write them to csvtopg.deadletters. The last
+        # block is then kept to find the lines of its rows, see row_lines
+        self.reject = None
+        self.last_block = None
+        self.last_block_lines: Optional[List[int]] = None
+        # csvtopg.index.RowWindow of the rows to return, starting in the
+        # byte range. The iteration stops after its last row.
+        self.window = None
+        self.num_skipped = 0  # rows of the last block before the window
+        self.io_time = 0.  # cumulative, in seconds
+        self.parse_time = 0.
+
+    async def read_header(self) -> List[str]:
+        """Parse and return the first record. The rest of the data read so far
+        is kept for the following iterations.
+        """
+        rows = []
+        while not rows and not self.eof:
+            chunk = await self.read_chunk()
+            data = self.tail + chunk
+            end = find_first_record_end(data, self.quote, self.newline)
+            if end == 0 and chunk:
+                self.tail = data
+                continue
+            if end == 0:
+                end = len(data)
+                self.eof = True
+            self.tail = data[end:]
+            self.records_end += end
+            rows = self.parse(data[:end])
+        if not rows:
+            raise AsyncReaderError('Missing header')
+        return rows[0]
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> List[List[str]]:
+        while not self.eof:
+            data = await self.read_records()
+            if data:
+                t0 = time.perf_counter()
+                rows = self.parse(data)
+                if self.window is not None:
+                    rows = self.apply_window(rows)
+                if rows and self.projection is not None:
+                    rows = self.projection(rows)
+                self.parse_time += time.perf_counter() - t0
+                if rows:
+                    return rows
+        raise StopAsyncIteration
+
+    def apply_window(self, rows: List[List[str]]) -> List[List[str]]:
+        skip = self.window.skip
+        rows = self.window(rows)
+        self.num_skipped = skip - self.window.skip
+        if not self.window.num_rows:
+            self.eof = True
+        return rows
+
+    async def verify(self) -> int:
+        """Apply the error policies to the remaining records without returning
+        them, and return their number. Blocks without quotes are checked by
+        counting delimiters, without parsing.
+        """
+        num_records = 0
+        delimiter = self.csv_kwargs.get('delimiter', ',').encode()
+        while not self.eof:
+            data = await self.read_records()
+            t0 = time.perf_counter()
+            num_records += self.verify_records(data, delimiter)
+            self.parse_time += time.perf_counter() - t0
+        return num_records
+
+    def verify_records(self, data: bytes, delimiter: bytes) -> int:
+        if self.quote not in data:
+            lines = data.split(self.newline)
+            if not lines[-1]:
+                lines.pop()
+            num_fields = set(map(bytes.count, lines, repeat(delimiter)))
+            if num_fields <= {self.expected_num_fields - 1}:
+                self.line_num += len(lines)
+                return len(lines)
+        return len(self.parse(data))
+
+    async def read_chunk(self) -> bytes:
+        t0 = time.perf_counter()
+        if self.end is None:
+            chunk = await self.file_reader.read_chunk()
+        elif self.position < self.end:
+            chunk = await self.file_reader.read_chunk()
+            chunk = chunk[:self.end - self.position]
+        else:
+            chunk = b''
+        self.io_time += time.perf_counter() - t0
+        self.position += len(chunk)
+        return chunk
+
+    async def read_records(self) -> bytes:
+        """Read the next block and return all the complete records it contains,
+        prefixed by the tail of the previous block.
+        """
+        chunk = await self.read_chunk()
+        if not chunk:
+            self.eof = True
+            data, self.tail = self.tail, b''
+        else:
+            data = self.tail + chunk
+            end = self.last_record_end(data)
+            self.tail = data[end:]
+            data = data[:end]
+        self.records_end += len(data)
+        return data
+
+    def last_record_end(self, data: bytes) -> int:
+        return self.check_tail(
+            data, find_records_end(data, self.quote, self.newline))
+
+    def check_tail(self, data, end: int) -> int:
+        """Return `end`, the end of the records of `data` found by counting
+        quotes, or the end found by csv.reader if the tail after `end` is
+        longer than max_tail"""
+        if len(data) - end <= self.max_tail:
+            return end
+        scanned = self.scan_records_end(data)
+        if scanned <= end:
+            # a quoted field longer than max_tail: scan again when twice as
+            # long only
+            self.max_tail *= 2
+            return end
+        return scanned
+
+    def scan_records_end(self, data) -> int:
+        """Return the position after the last complete record of `data`, found
+        by parsing its lines with csv.reader"""
+        lines = bytes(data).split(self.newline)[:-1]
+        position = end = 0
+        exhausted = False
+
+        def read_lines():
+            nonlocal position, exhausted
+            for line in lines:
+                position += len(line) + 1
+                yield str(line, self.encoding, self.errors) + '\n'
+            exhausted = True
+
+        try:
+            for _ in csv.reader(read_lines(), **self.csv_kwargs):
+                if not exhausted:  # else a record cut by the end of data
+                    end = position
+        except csv.Error:
+            pass  # parsed again, and reported, with the records before it
+        return end
+
+    def parse(self, data: bytes) -> List[List[str]]:
+        text = str(data, self.encoding, self.errors)
+        if self.reject is not None:
+            self.last_block = (text, self.line_num)
+            self.last_block_lines = None
+        if self.expected_num_fields != -1 or \
+                self.on_wrong_length is OnError.leroy_jenkins:
+            reader = self.csv_reader(text)
+            rows = list(reader)
+            if self.all_valid(rows):
+                self.line_num += reader.line_num
+                return rows
+        # Parse again, row by row, to apply the error policies
+        return self.parse_checked(self.csv_reader(text))
+
+    def csv_reader(self, text: str):
+        return csv.reader(io.StringIO(text, newline=''), **self.csv_kwargs)
+
+    def all_valid(self, rows: List[List[str]]) -> bool:
+        if self.on_wrong_length is OnError.leroy_jenkins:
+            return self.on_empty_line is OnError.leroy_jenkins or all(rows)
+        return not rows or set(map(len, rows)) == {self.expected_num_fields}
+
+    def parse_checked(self, reader) -> List[List[str]]:
+        rows = [row for _, row in self.checked_rows(reader, self.line_num)]
+        self.line_num += reader.line_num
+        return rows
+
+    def checked_rows(self, reader, first_line_num: int, report: bool = True):
+        """Yield the line number and the fields of the records that pass the
+        error policies, applying them to the others if `report` is set"""
+        for row in reader:
+            line_num = first_line_num + reader.line_num
+            if not row and self.on_empty_line is not OnError.leroy_jenkins:
+                if report and self.on_empty_line is OnError.exception:
+                    raise AsyncReaderError(f'Empty line at line {line_num}')
+                elif report and self.on_empty_line is OnError.skip_and_warn:
+                    warnings.warn(f'Empty line at line {line_num}')
+                continue
+            if self.on_wrong_length is not OnError.leroy_jenkins:
+                if self.expected_num_fields == -1:
+                    self.expected_num_fields = len(row)
+                elif len(row) != self.expected_num_fields:
+                    if report:
+                        reject_record(
+                            self, self.on_wrong_length,
+                            f'Incorrect record length at line {line_num} '
+                            f'(expected {self.expected_num_fields}, found '
+                            f'{len(row)})', line_num, row)
+                    continue
+            yield line_num, row
+
+    def row_lines(self) -> List[int]:
+        """Return the line numbers of the rows of the last parsed block,
+        found by parsing it again. Only available with a reject callback."""
+        if self.last_block_lines is None:
+            text, first_line_num = self.last_block
+            self.last_block_lines = [
+                line_num for line_num, _ in self.checked_rows(
+                    self.csv_reader(text), first_line_num, report=False)]
+        return self.last_block_lines[self.num_skipped:]
+
+
+class MmapChunkReader(AsyncChunkReader):
+    """Chunk reader of a memory-mapped file (csvtopg.sources.MmapSource).
+    Record boundaries are searched in the mapped region, and the records are
+    decoded straight from a memoryview of it, without copying them into
+    intermediate bytes objects. Only the blocks containing quotes are copied,
+    to count their quotes. The header is read like in AsyncChunkReader."""
+
+    def __init__(self, source, **kwargs):
+        self.chunk_size = kwargs.get('chunk_size', DEFAULT_BLOCK_SIZE)
+        super().__init__(source, **kwargs)
+        self.buffer = source.buffer
+        if self.end is None:
+            self.end = len(self.buffer)
+
+    def find_records_end(self, start: int, limit: int) -> int:
+        if limit == self.end:
+            return limit
+        newline = self.buffer.rfind(self.newline, start, limit)
+        if newline == -1:
+            return start
+        if self.buffer.find(self.quote, start, newline) == -1:
+            return newline + 1
+        data = self.buffer[start:limit]
+        return start + self.check_tail(
+            data, find_records_end(data, self.quote, self.newline))
+
+    async def read_records(self) -> memoryview:
+        """Return a view of the complete records of the next block, which
+        grows until it holds at least one record"""
+        # nothing is awaited while reading the mapped file: let the writers run
+        await asyncio.sleep(0)
+        t0 = time.perf_counter()
+        start = self.records_end
+        limit = end = start
+        while end == start and limit < self.end:
+            limit = min(limit + self.chunk_size, self.end)
+            end = self.find_records_end(start, limit)
+        self.eof = end >= self.end
+        self.position = self.records_end = end
+        self.io_time += time.perf_counter() - t0
+        return memoryview(self.buffer)[start:end]
+
+    def parse(self, data) -> List[List[str]]:
+        try:
+            return super().parse(data)
+        finally:
+            # release the views at once, the file cannot be unmapped before
+            if isinstance(data, memoryview):
+                data.release()
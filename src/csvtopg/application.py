@@ -1,23 +1,58 @@
 import asyncio
 import csv
+import io
 import logging
+import os
 import re
 import time
 import traceback
 from asyncio import Future
-from collections import deque
-from dataclasses import dataclass, field
-from typing import List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import AsyncExitStack, asynccontextmanager
+from dataclasses import dataclass, field, replace
+from functools import partial
+from itertools import repeat
+from typing import Dict, List, Optional, Set, Tuple, Type
 
-import aiofile
 import asyncpg
 
-from csvtopg.aiocsv import AsyncListReader
+from csvtopg.aiocsv import (
+    AsyncChunkReader, AsyncListReader, MmapChunkReader, OnError,
+    chunk_reader)
+from csvtopg.batching import Batch, Batcher, ByteBudgetQueue, Segment
+from csvtopg.checkpoints import (
+    CheckpointError, FileCheckpoints, TableCheckpoints, missing_rows,
+    plan_reads)
+from csvtopg.columns import Projection, compile_transforms
+from csvtopg.compression import (
+    CompressedFile, open_decompressed, resolve_compression)
 from csvtopg.configuration import Config
+from csvtopg.deadletters import FileDeadLetters, TableDeadLetters
+from csvtopg.filtering import RowFilter
+from csvtopg.formats import (
+    COLUMNAR_FORMATS, ColumnarFile, NdjsonReader, ndjson_header,
+    resolve_format)
+from csvtopg.index import (
+    RecordIndex, RecordIndexError, RowWindow, index_path)
+from csvtopg.inference import (
+    infer_column_types, load_column_types, sample_rows, save_column_types)
+from csvtopg.metrics import Metrics, log_metrics, write_prometheus_textfile
+from csvtopg.packing import PackedRows, copy_rows_to_table
+from csvtopg.pgtypes import RowConverter, sql_type
+from csvtopg.ranges import split_records
+from csvtopg.sources import FileSource, MmapSource, StreamSource, is_stream
+from csvtopg.staging import (
+    BatchMerge, StagingLoad, check_key_columns, primary_key_clause,
+    quote_identifier)
 
 log = logging.getLogger(__name__)
 
-MAX_QUEUE_SIZE = 1000
+HEADER_CHUNK_SIZE = 64 * 1024
+# errors of the server on the values of rows, which are bisected to reject
+# the bad rows with dead letters. asyncpg raises client-side DataError, a
+# ValueError, on values it cannot encode.
+REJECTED_ROW_ERRORS = (asyncpg.DataError,
+                       asyncpg.IntegrityConstraintViolationError, ValueError)
 EOS = object()  # end of stream nonce
 STATUS_STRING_PATTERN = re.compile(r'COPY\s+(?P<num_rows>\d+)\s*$')
 
@@ -50,17 +85,17 @@ class CSVToPgError(Exception):
     pass
 
 
-@dataclass
-class Metrics:
-    wall_clock_computation_time: Optional[float] = None  # in seconds
-    num_rows_read: int = 0
-    num_rows_written: int = 0
-
-
 @dataclass
 class ExecutionResult:
     metrics: Metrics = field(default_factory=Metrics)
     errors: List = field(default_factory=list)
+    worker_metrics: List[Metrics] = field(default_factory=list)
+    file_metrics: Dict[str, Metrics] = field(default_factory=dict)
+
+
+def describe_exception(e: BaseException) -> str:
+    details = '\n'.join(traceback.format_exception(None, e, e.__traceback__))
+    return f'Uncaught exception: {repr(e)}, traceback: {details}'
 
 
 def parse_insert_status_string(status_string: str) -> int:
@@ -71,31 +106,299 @@ def parse_insert_status_string(status_string: str) -> int:
     raise CSVToPgError(f'Unexpected INSERT response: "{status_string}"')
 
 
-async def clear_queue(q: asyncio.Queue):
-    q._queue.clear()
+async def gather_or_cancel(*coroutines):
+    """Like asyncio.gather, but cancel the remaining tasks if one fails"""
+    tasks = [asyncio.ensure_future(c) for c in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
+async def clear_queue(q: ByteBudgetQueue):
+    q.clear()
     q._finished.set()
     q._unfinished_tasks = 0
     await q.put(EOS)
 
 
+def load_byte_range(config: Config, byte_range: Tuple[int, int],
+                    header: Optional[List[str]] = None) -> ExecutionResult:
+    """Entry point of the worker processes started by
+    CSVToPg.run_in_processes"""
+    if config.use_uvloop:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    return CSVToPg(config, byte_range=byte_range, header=header).run()
+
+
+class HeaderMismatchError(Exception):
+    pass
+
+
 class CSVToPg:
-    def __init__(self, config: Config):
+    def __init__(self, config: Config,
+                 byte_range: Optional[Tuple[int, int]] = None,
+                 pool: Optional[asyncpg.pool.Pool] = None,
+                 header: Optional[List[str]] = None):
         self.config = config
+        self.byte_range = byte_range
+        self.pool = pool  # shared by several loads, not closed
+        # the table is created by the parent process or the scheduler when
+        # the input is split between several loads
+        self.table_created = byte_range is not None
+        # and the staging table is swapped or appended by them at the end
+        self.finishes_load = byte_range is None
         self.file_reader_task: Optional[Future] = None
         self.postgres_task: Optional[Future] = None
         self.tick = Ticker()
-        self._header: Optional[List[str]] = None
+        self.metrics = Metrics()
+        self._header: Optional[List[str]] = header
+        # header that the input must have, when loaded with other files
+        self.expected_header: Optional[List[str]] = None
         self._record_length: Optional[int] = None
+        self._projection: Optional[Projection] = None
+        self._row_filter: Optional[RowFilter] = None
+        self._index: Optional[RecordIndex] = None
+        self.index_loaded = False
+        self.window: Optional[RowWindow] = None  # of the configured row_range
         self._exception: Optional[BaseException] = None
+        self.checkpoints = None
+        if config.checkpoint == 'table':
+            self.checkpoints = TableCheckpoints(
+                config.checkpoint_table, config.table_name, config.input_file)
+        elif config.checkpoint == 'file':
+            self.checkpoints = FileCheckpoints(
+                config.checkpoint_file or f'{config.input_file}.checkpoint')
+        self.copied_segments: List[Segment] = []
+        self.dead_letters = None
+        if config.dead_letter == 'file':
+            self.dead_letters = FileDeadLetters(
+                config.dead_letter_file or f'{config.input_file}.rejected',
+                config.input_file,
+                byte_range[0] if byte_range is not None else None)
+        elif config.dead_letter == 'table':
+            self.dead_letters = TableDeadLetters(
+                config.dead_letter_table, config.table_name,
+                config.input_file, self.connect)
+        self.staging = None
+        self.merge = None
+        if config.load_strategy != 'direct':
+            self.staging = StagingLoad(
+                config.table_name, config.load_strategy, config.key_columns,
+                config.max_parallel_index_builds, config.on_conflict,
+                config.update_columns, config.keep_unlogged)
+        elif config.on_conflict:
+            self.merge = BatchMerge(config.table_name, config.key_columns,
+                                    config.on_conflict, config.update_columns)
+        self.readers: List = []  # their I/O and parsing times are collected
+        self.batcher: Optional[Batcher] = None
+        self.start_time = time.perf_counter()
+        self._compression: Optional[str] = None
+        self._input_format: Optional[str] = None
+        self._columnar_file: Optional[ColumnarFile] = None
+        self.input = None  # source opened by execute
+        self.header_end = 0  # position of the first record
+
+    @property
+    def compression(self) -> Optional[str]:
+        """Compression of a regular input file. Streams are decompressed by
+        their source."""
+        if is_stream(self.config.input_file):
+            return None
+        if self._compression is None:
+            self._compression = resolve_compression(
+                self.config.input_file, self.config.compression) or 'none'
+        return None if self._compression == 'none' else self._compression
 
     @property
     def header(self) -> List[str]:
-        if self._header is None:
-            with open(self.config.input_file, newline='') as csvfile:
+        """Header of the input, read by execute or open_header, or read
+        synchronously here otherwise"""
+        if self._header is None and self.columnar_file is not None:
+            self._header = self.columnar_file.header
+        elif self._header is None and self.input_format == 'ndjson':
+            with open_decompressed(self.config.input_file,
+                                   self.compression) as f:
+                self._header = ndjson_header(f)
+        elif self._header is None:
+            with io.TextIOWrapper(
+                    open_decompressed(self.config.input_file,
+                                      self.compression),
+                    newline='') as csvfile:
                 reader = csv.reader(csvfile)
                 self._header = next(reader)
         return self._header
 
+    @property
+    def input_format(self) -> str:
+        if self._input_format is None:
+            self._input_format = resolve_format(self.config.input_file,
+                                                self.config.input_format)
+        return self._input_format
+
+    @property
+    def columnar_file(self) -> Optional[ColumnarFile]:
+        """Parquet or Arrow input file, opened once"""
+        if self._columnar_file is None and \
+                self.input_format in COLUMNAR_FORMATS:
+            self._columnar_file = ColumnarFile(
+                self.config.input_file, self.input_format,
+                self.config.read_threads)
+        return self._columnar_file
+
+    def open_input(self):
+        """Return the source of the input, see csvtopg.sources"""
+        path = self.config.input_file
+        if self.columnar_file is not None:
+            return self.columnar_file
+        if is_stream(path):
+            return StreamSource(path, self.config.compression)
+        if self.compression is not None:
+            log.debug('Decompressing %s input', self.compression)
+            return CompressedFile(path, self.compression,
+                                  self.config.decompression_threads)
+        if self.config.input_source == 'mmap' or \
+                self.config.reader_mode == 'mmap':
+            return MmapSource(path)
+        return FileSource(path)
+
+    async def read_header(self):
+        """Read the header from the input source, and the position of the
+        first record. The bytes read ahead from a stream are put back."""
+        if isinstance(self.input, ColumnarFile):
+            # and the types of its columns, unless configured
+            self._header = self.input.header
+            self.config = replace(self.config, column_types={
+                **self.file_column_types, **self.config.column_types})
+            return
+        reader_class = NdjsonReader if self.input_format == 'ndjson' \
+            else AsyncChunkReader
+        reader = reader_class(self.input, chunk_size=HEADER_CHUNK_SIZE)
+        self._header = await reader.read_header()
+        self.header_end = reader.records_end
+        if not self.input.seekable:
+            self.input.unread(reader.tail)
+
+    async def open_header(self):
+        """Read the header from a source of the input opened for it, when
+        the input is not loaded by execute"""
+        async with self.open_input() as self.input:
+            await self.read_header()
+        self.input = None
+
+    @property
+    def index(self) -> Optional[RecordIndex]:
+        """Index of the records of a regular input file, written by
+        `csvtopg index`, if it exists and still matches the file"""
+        if self.index_loaded:
+            return self._index
+        self.index_loaded = True
+        path = self.config.input_file
+        if is_stream(path) or self.compression is not None or \
+                not os.path.exists(index_path(path)):
+            return None
+        try:
+            index = RecordIndex.load(index_path(path))
+        except (RecordIndexError, TypeError) as e:
+            log.warning('Ignoring the index of %s: %s', path, e)
+            return None
+        if not index.matches(path):
+            log.warning('Ignoring the index of %s, which was modified since '
+                        'it was indexed', path)
+            return None
+        self._index = index
+        return index
+
+    def seek_row_range(self) -> Optional[RowWindow]:
+        """Return the window of the configured row range in the input"""
+        if self.config.row_range is None:
+            return None
+        if self.index is None:
+            raise RecordIndexError(
+                f'A row range requires an index of {self.config.input_file}, '
+                f'run csvtopg index first')
+        return self.index.seek(*self.config.row_range)
+
+    @property
+    def num_rows_total(self) -> int:
+        """Number of rows to read according to the index, including the
+        invalid records, or 0 if unknown"""
+        if self.window is not None:
+            return self.window.num_rows
+        if self.columnar_file is not None:
+            return self.columnar_file.num_rows
+        if self.index is None:
+            return 0
+        if self.byte_range is None:
+            return self.index.num_records
+        return self.index.records_between(*self.byte_range) or 0
+
+    @property
+    def projection(self) -> Optional[Projection]:
+        """Projection of the parsed rows on the configured columns"""
+        if self._projection is None and self.config.columns:
+            self._projection = Projection(self.header, self.config.columns)
+        return self._projection
+
+    @property
+    def row_filter(self) -> Optional[RowFilter]:
+        """Filter of the converted rows, compiled for the columns"""
+        if self._row_filter is None and self.config.filter is not None:
+            self._row_filter = RowFilter(self.config.filter, self.columns,
+                                         self.config.column_types)
+        return self._row_filter
+
+    @property
+    def columns(self) -> List[str]:
+        """Columns of the target table, the header unless configured"""
+        if self.config.columns:
+            return list(self.config.columns)
+        return self.header
+
+    @property
+    def column_sources(self) -> Dict[str, str]:
+        """Input column of each column of the target table"""
+        if self.config.columns:
+            return {name: spec.source or name
+                    for name, spec in self.config.columns.items()}
+        return {col: col for col in self.header}
+
+    @property
+    def file_column_types(self) -> Dict[str, str]:
+        """Types of the columns of the target table that are copied from
+        typed columns of a Parquet or Arrow file, without transforms"""
+        types = self.columnar_file.column_types
+        transformed = {name for name, spec in self.config.columns.items()
+                       if compile_transforms(spec) is not None}
+        return {col: types[source]
+                for col, source in self.column_sources.items()
+                if col not in transformed and types[source] != 'text'}
+
+    @property
+    def text_sources(self) -> Set[str]:
+        """Columns of a Parquet or Arrow file to read as text, to be
+        transformed or converted to the type of their table column"""
+        file_types = self.file_column_types
+        column_types = self.config.column_types
+        return {source for col, source in self.column_sources.items()
+                if column_types.get(col, 'text') != file_types.get(
+                    col, 'text') or col not in file_types}
+
+    @property
+    def conversion_types(self) -> Dict[str, str]:
+        """Types of the columns that are converted from text"""
+        if self.columnar_file is None:
+            return self.config.column_types
+        text_sources = self.text_sources
+        sources = self.column_sources
+        return {col: type_name
+                for col, type_name in self.config.column_types.items()
+                if sources[col] in text_sources}
+
     @property
     def record_length(self) -> int:
         if self._record_length is None:
@@ -104,20 +407,168 @@ class CSVToPg:
 
     @property
     def schema(self) -> str:
-        return ',\n'.join((f'    "{col}" text' for col in self.header))
+        types = self.config.column_types
+        return ',\n'.join(
+            f'    {quote_identifier(col)} {sql_type(types.get(col, "text"))}'
+            for col in self.columns)
+
+    @property
+    def chunk_reader_class(self) -> Type[AsyncChunkReader]:
+        if self.input_format == 'ndjson':
+            return NdjsonReader
+        if self.config.reader_mode == 'mmap':
+            return MmapChunkReader
+        return AsyncChunkReader
+
+    async def open_chunk_reader(self, f, **kwargs) -> AsyncChunkReader:
+        """Return a chunk reader positioned on the first record to load"""
+        if self.byte_range is not None:
+            start, end = self.byte_range
+            reader = self.chunk_reader_class(
+                f, chunk_size=self.config.chunk_size, offset=start, end=end,
+                **kwargs)
+        elif self.window is not None:
+            reader = self.chunk_reader_class(
+                f, chunk_size=self.config.chunk_size,
+                offset=self.window.start, end=self.window.end, **kwargs)
+            reader.window = self.window
+        else:
+            reader = self.chunk_reader_class(
+                f, chunk_size=self.config.chunk_size, offset=self.header_end,
+                **kwargs)
+        self.readers.append(reader)
+        return reader
+
+    async def read_blocks(self, f, convert: RowConverter):
+        """Parse the input blocks that were not copied yet according to the
+        checkpoints. For each block, yield the number of parsed rows, then the
+        converted rows to load with their size and input segment."""
+        reader = await self.open_chunk_reader(f)
+        units = [(reader.records_end, reader.end, [])]
+        if self.copied_segments:
+            end = reader.end
+            if end is None:
+                end = os.path.getsize(self.config.input_file)
+            units = plan_reads(reader.records_end, end, self.copied_segments)
+            log.info('[read_file] Resuming, reading %d of %d bytes',
+                     sum(e - s for s, e, _ in units), end - reader.records_end)
+        for start, end, copied in units:
+            if copied or (start, end) != (reader.records_end, reader.end):
+                reader = self.chunk_reader_class(
+                    f, chunk_size=max(end - start, 1) if copied else
+                    self.config.chunk_size, offset=start, end=end)
+                self.readers.append(reader)
+            reader.expected_num_fields = self.record_length
+            if self.input_format == 'ndjson':
+                reader.keys = self.header
+            reader.projection = self.projection
+            self.reject_to_dead_letters(reader, start, convert)
+            block_start = start
+            async for parsed in reader:
+                t0 = time.perf_counter()
+                rows = self.convert_and_filter(convert, parsed)
+                self.metrics.conversion_time += time.perf_counter() - t0
+                block_end = reader.records_end
+                nbytes = block_end - block_start
+                if not copied:
+                    yield len(parsed), rows, nbytes, Segment(
+                        block_start, block_end, 0, len(rows), len(rows))
+                elif (block_start, block_end) != (start, end) or \
+                        copied[-1][1] > len(rows):
+                    raise CheckpointError(
+                        f'The checkpointed block {start}-{end} cannot be '
+                        f'parsed again identically')
+                else:
+                    yield len(parsed), [], 0, None
+                    for first, last in missing_rows(len(rows), copied):
+                        yield 0, rows[first:last], \
+                            nbytes * (last - first) // len(rows), Segment(
+                                start, end, first, last, len(rows))
+                block_start = block_end
 
-    async def read_file(self, q: asyncio.Queue) -> int:
+    async def read_row_groups(self, f: ColumnarFile, convert: RowConverter):
+        """Read the projected columns of the row groups of a Parquet or
+        Arrow file, and yield their rows like read_blocks"""
+        columns = list(dict.fromkeys(self.column_sources.values()))
+        reader = f.reader(columns, self.text_sources)
+        if self.config.columns:
+            reader.projection = Projection(columns, self.config.columns)
+        self.readers.append(reader)
+        self.reject_to_dead_letters(reader, self.header_end, convert)
+        async for parsed in reader:
+            t0 = time.perf_counter()
+            rows = self.convert_and_filter(convert, parsed)
+            self.metrics.conversion_time += time.perf_counter() - t0
+            yield len(parsed), rows, reader.nbytes, None
+
+    def reject_to_dead_letters(self, reader, start: int,
+                               convert: RowConverter):
+        """Write the records skipped by a reader starting at byte `start`,
+        and by the conversion of its rows, to the dead letters"""
+        if self.dead_letters is None:
+            return
+        byte_offset = start
+        if self.byte_range is None and start == self.header_end:
+            byte_offset = 0
+            if self.input_format == 'csv':
+                reader.line_num = 1  # the header
+        reader.reject = partial(self.dead_letters.reject, byte_offset)
+        convert.reject = lambda row, reason, fields: \
+            self.dead_letters.reject(byte_offset, reader.row_lines()[row],
+                                     reason, fields)
+
+    def convert_and_filter(self, convert: RowConverter,
+                           rows: List[List[str]]) -> List:
+        rows = convert(rows)
+        if self.row_filter is not None and rows:
+            num_rows = len(rows)
+            rows = self.row_filter(rows)
+            self.metrics.num_rows_filtered += num_rows - len(rows)
+        return rows
+
+    async def read_file(self, q: ByteBudgetQueue) -> int:
         num_rows_read = 0
+        batcher = Batcher(q, self.config.batch_target_rows,
+                          self.config.batch_target_bytes,
+                          self.config.batch_max_linger,
+                          PackedRows.pack
+                          if self.config.batch_format == 'packed' else None)
+        self.batcher = batcher
+        linger_task = asyncio.ensure_future(batcher.linger())
         try:
-            async with aiofile.AIOFile(self.config.input_file, 'rb') as f:
-                log.debug('[read_file] Reading %s', self.config.input_file)
-                reader = AsyncListReader(f)
-                await reader.__anext__()  # skip the header
+            convert = RowConverter(
+                self.columns, self.conversion_types,
+                OnError(self.config.on_conversion_error))
+            f = self.input
+            log.debug('[read_file] Reading %s', self.config.input_file)
+            if self.config.reader_mode == 'line':
+                reader = AsyncListReader(f, offset=self.header_end)
+                reader.line_num = 1
+                self.readers.append(reader)
+                self.reject_to_dead_letters(reader, self.header_end, convert)
                 async for row in reader:
                     num_rows_read += 1
-                    await q.put(row)
-                    # if num_rows_read > 100:
-                    #     raise Exception()
+                    t0 = time.perf_counter()
+                    rows = self.convert_and_filter(
+                        convert, [row] if self.projection is None
+                        else self.projection([row]))
+                    self.metrics.conversion_time += time.perf_counter() - t0
+                    await batcher.add(rows, sum(map(len, row)) + len(row))
+                    self.metrics.num_rows_read = num_rows_read
+            else:
+                blocks = self.read_row_groups(f, convert) \
+                    if isinstance(f, ColumnarFile) \
+                    else self.read_blocks(f, convert)
+                async for num_parsed, rows, nbytes, segment in blocks:
+                    num_rows_read += num_parsed
+                    await batcher.add(rows, nbytes, segment)
+                    self.metrics.num_rows_read = num_rows_read
+                # if num_rows_read > 100:
+                #     raise Exception()
+            linger_task.cancel()
+            # let a flush in progress in the linger task give its rows back
+            await asyncio.gather(linger_task, return_exceptions=True)
+            await batcher.flush()
             log.debug('[read_file] Read %d rows', num_rows_read)
             await q.put(EOS)
         except KeyboardInterrupt:
@@ -128,35 +579,51 @@ class CSVToPg:
         except Exception as e:  # noqa
             self._exception = e
             await clear_queue(q)
+        finally:
+            linger_task.cancel()
+            self.update_stage_metrics()
         return num_rows_read
 
-    async def stream_to_postgres(self, q: asyncio.Queue):
-        try:
-            conn = await asyncpg.connect(self.config.conn_uri)
-        except Exception as e:  # noqa
-            self._exception = e
-            self.file_reader_task.cancel()
-            return 0
-        log.debug('[stream_to_postgres] Connected to %s', self.config.conn_uri)
+    def update_stage_metrics(self):
+        """Collect the metrics measured by the readers and the batcher"""
+        if self.readers:
+            self.metrics.file_io_time = sum(r.io_time for r in self.readers)
+            self.metrics.parse_time = sum(r.parse_time for r in self.readers)
+        if self.dead_letters is not None:
+            self.metrics.num_rows_rejected = self.dead_letters.num_rejected
+        if self.batcher is not None:
+            self.metrics.queue_put_wait_time = self.batcher.put_wait_time
+            self.metrics.peak_inflight_bytes = \
+                self.batcher.q.peak_inflight_bytes
+            self.metrics.batch_rows_histogram = self.batcher.rows_histogram
+            self.metrics.batch_bytes_histogram = self.batcher.bytes_histogram
+
+    async def stream_to_postgres(self, q: ByteBudgetQueue):
+        num_writers = self.config.num_writers
+        pool = self.pool
+        if pool is None:
+            try:
+                pool = await asyncpg.create_pool(
+                    self.config.conn_uri, min_size=num_writers,
+                    max_size=num_writers)
+            except Exception as e:  # noqa
+                self._exception = e
+                self.file_reader_task.cancel()
+                return 0
+            log.debug('[stream_to_postgres] Connected to %s with %d '
+                      'connections', self.config.conn_uri, num_writers)
         num_rows_written = 0
         try:
-            await conn.execute(f'''
-                CREATE TABLE IF NOT EXISTS {self.config.table_name} (
-                    {self.schema})''')
-            eos = False
-            while not eos:
-                records = deque([await q.get()])
-                while not q.empty():
-                    record = await q.get()
-                    records.append(record)
-                if records[-1] is EOS:
-                    eos = True
-                    records.pop()
-                if records:
-                    status = await conn.copy_records_to_table(
-                        self.config.table_name, records=records)
-                    num_rows_written += parse_insert_status_string(status)
-                    q.task_done()
+            if not self.table_created:
+                async with pool.acquire() as conn:
+                    await self.create_table(conn)
+            if self.config.shared_snapshot:
+                counts = await self.write_in_shared_snapshot(pool, q)
+            else:
+                counts = await gather_or_cancel(
+                    *(self.write_with_pool(pool, q)
+                      for _ in range(num_writers)))
+            num_rows_written = sum(counts)
             log.debug('[stream_to_postgres] Wrote %d rows', num_rows_written)
         except KeyboardInterrupt:
             log.warning('[stream_to_postgres] User interrupt')
@@ -165,36 +632,483 @@ class CSVToPg:
             raise
         except Exception as e:  # noqa
             log.error('[stream_to_postgres] Exception: %s', e)
+            self.file_reader_task.cancel()
             raise
         finally:
-            await conn.close()
+            if pool is not self.pool:
+                await pool.close()
         print('[read_file] returning')
         return num_rows_written
 
+    @property
+    def create_table_statement(self) -> str:
+        return (f'CREATE TABLE IF NOT EXISTS {self.config.table_name} (\n'
+                f'{self.schema}{primary_key_clause(self.config.key_columns)})')
+
+    @property
+    def copy_table(self) -> str:
+        """Table the rows are copied to"""
+        if self.staging is not None:
+            return self.staging.staging_table
+        return self.config.table_name
+
+    async def create_table(self, conn: asyncpg.Connection):
+        if self.staging is None:
+            await conn.execute(self.create_table_statement)
+        else:
+            await self.staging.create(conn, self.schema)
+
+    async def finish_load(self, metrics: Optional[Metrics] = None):
+        """Swap or append the staging table into the target table, and count
+        the rows appended in `metrics`, by default those of this load"""
+        if self.staging is None:
+            return
+        counts = await self.staging.finish(self.connect, self.columns)
+        if counts is not None:
+            metrics = metrics or self.metrics
+            metrics.num_rows_inserted += counts[0]
+            metrics.num_rows_updated += counts[1]
+
+    async def infer_types(self) -> Config:
+        """Return the configuration completed with the column types inferred
+        from a sample of the input, or loaded from the schema file if it
+        exists. Explicitly configured column types take precedence."""
+        schema_file = self.config.schema_file
+        if schema_file and os.path.exists(schema_file):
+            log.debug('Loading column types from %s', schema_file)
+            inferred = load_column_types(schema_file)
+        else:
+            if self.input_format == 'csv':
+                rows = await sample_rows(
+                    self.config.input_file, self.header,
+                    self.config.infer_sample_rows,
+                    self.config.infer_sample_ranges, self.compression)
+            else:
+                rows = await self.sample_first_rows()
+            if self.projection is not None:
+                rows = self.projection(rows)
+            inferred = infer_column_types(self.columns, rows)
+            log.debug('Inferred column types from %d rows: %s', len(rows),
+                      inferred)
+            if schema_file:
+                save_column_types(schema_file, inferred)
+        return replace(self.config, infer_types=False,
+                       column_types={**inferred, **self.config.column_types})
+
+    async def sample_first_rows(self) -> List:
+        """Read the first infer_sample_rows rows of NDJSON, Parquet or Arrow
+        input, as text"""
+        rows = []
+        async with self.open_input() as f:
+            if isinstance(f, ColumnarFile):
+                reader = f.reader(self.header, set(self.header))
+            else:
+                reader = NdjsonReader(f, chunk_size=HEADER_CHUNK_SIZE,
+                                      on_wrong_length=OnError.skip_silently)
+                reader.keys = self.header
+            async for block in reader:
+                rows.extend(block)
+                if len(rows) >= self.config.infer_sample_rows:
+                    break
+        return rows[:self.config.infer_sample_rows]
+
+    @asynccontextmanager
+    async def connect(self):
+        """Acquire a connection from the shared pool if there is one, or open
+        a new one"""
+        if self.pool is not None:
+            async with self.pool.acquire() as conn:
+                yield conn
+        else:
+            conn = await asyncpg.connect(self.config.conn_uri)
+            try:
+                yield conn
+            finally:
+                await conn.close()
+
+    async def open_checkpoints(self):
+        """Load the segments already copied by previous runs, after
+        forgetting them unless resuming"""
+        if self.checkpoints is None:
+            return
+        clear = not self.config.resume and self.byte_range is None
+        async with self.connect() as conn:
+            await self.checkpoints.prepare(conn)
+            if clear:
+                await self.checkpoints.clear(conn)
+            self.copied_segments = await self.checkpoints.load(conn)
+
+    async def open_dead_letters(self):
+        """Create the dead letter table, unless created by the parent
+        process"""
+        if self.dead_letters is not None and self.byte_range is None:
+            async with self.connect() as conn:
+                await self.dead_letters.prepare(conn)
+
+    async def close_dead_letters(self):
+        """Write the last rejected rows, even if the load failed"""
+        if self.dead_letters is None:
+            return
+        try:
+            await self.dead_letters.close()
+        except Exception as e:  # noqa
+            self._exception = self._exception or e
+
+    def prepare_checkpoints(self):
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(self.open_checkpoints())
+
+    async def complete_schema(self):
+        """Read the header if it was not read yet, and complete the
+        configuration with inferred types if requested"""
+        if self._header is None:
+            await self.open_header()
+        if self.config.infer_types:
+            self.config = await self.infer_types()
+            log.info('Table schema:\n%s', self.create_table_statement)
+
+    def resolve_schema(self):
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(self.complete_schema())
+
+    async def prepare_table(self):
+        async with self.connect() as conn:
+            await self.create_table(conn)
+        self.table_created = True
+
+    async def write_with_pool(self, pool: asyncpg.pool.Pool,
+                              q: ByteBudgetQueue) -> int:
+        async with pool.acquire() as conn:
+            return await self.write_batches(conn, q)
+
+    async def write_in_shared_snapshot(self, pool: asyncpg.pool.Pool,
+                                       q: ByteBudgetQueue) -> List[int]:
+        """Run the writers in transactions sharing the snapshot exported by
+        the first one. Nothing is committed before all writers are done, and
+        everything is rolled back if any of them or the file reader fails.
+        The transactions are then committed one after another, which is not
+        atomic: if a commit fails, those of the previous writers are durable
+        and the others are rolled back.
+        """
+        conns = [await pool.acquire()
+                 for _ in range(self.config.num_writers)]
+        transactions = [conn.transaction(isolation='repeatable_read')
+                        for conn in conns]
+        started = []
+        try:
+            for i, (conn, transaction) in enumerate(zip(conns, transactions)):
+                await transaction.start()
+                started.append(transaction)
+                if i == 0:
+                    snapshot = await conn.fetchval(
+                        'SELECT pg_export_snapshot()')
+                    log.debug('[stream_to_postgres] Sharing snapshot %s',
+                              snapshot)
+                else:
+                    await conn.execute(
+                        f"SET TRANSACTION SNAPSHOT '{snapshot}'")
+            counts = await gather_or_cancel(
+                *(self.write_batches(conn, q) for conn in conns))
+            if self._exception is not None:
+                return []
+            while started:
+                await started.pop(0).commit()
+            return counts
+        finally:
+            for transaction in started:
+                await transaction.rollback()
+            for conn in conns:
+                await pool.release(conn)
+
+    async def write_batches(self, conn: asyncpg.Connection,
+                            q: ByteBudgetQueue) -> int:
+        """Copy the batches of the queue until the end of stream, releasing
+        their bytes from the in-flight budget of the queue once copied. The
+        EOS nonce is put back in the queue so that all the writers sharing the
+        queue see it.
+        """
+        num_rows_written = 0
+        metrics = self.metrics
+        if self.merge is not None:
+            await self.merge.prepare(conn)
+        while True:
+            t0 = time.perf_counter()
+            batch = await q.get()
+            t1 = time.perf_counter()
+            metrics.queue_get_wait_time += t1 - t0
+            if batch is EOS:
+                await q.put(EOS)
+                break
+            try:
+                if self.checkpoints is None and self.merge is None:
+                    num_rows = await self.copy_batch(conn, batch)
+                else:
+                    async with conn.transaction():
+                        num_rows = await self.copy_batch(conn, batch)
+                        if self.checkpoints is not None:
+                            await self.checkpoints.record_in_transaction(
+                                conn, batch.segments)
+                    if self.checkpoints is not None:
+                        self.checkpoints.record_committed(batch.segments)
+            finally:
+                q.release(batch)
+            latency = time.perf_counter() - t1
+            metrics.copy_time += latency
+            metrics.batch_copy_latencies.append(latency)
+            metrics.num_bytes_copied += batch.nbytes
+            num_rows_written += num_rows
+            metrics.num_rows_written += num_rows
+            q.task_done()
+        return num_rows_written
+
+    async def copy_batch(self, conn: asyncpg.Connection, batch: Batch) -> int:
+        """Copy or upsert a batch and return the number of rows written"""
+        if self.dead_letters is None:
+            return await self.copy_rows(conn, batch.rows)
+        return await self.copy_bisecting(conn, batch, 0, len(batch))
+
+    async def copy_bisecting(self, conn: asyncpg.Connection, batch: Batch,
+                             first: int, end: int) -> int:
+        """Copy the rows `first` to `end` (excluded) of a batch in a savepoint.
+        If the server rejects them, copy each half of them likewise, down to
+        the rejected rows, which are written to the dead letters."""
+        try:
+            async with conn.transaction():
+                return await self.copy_rows(conn, batch.rows[first:end])
+        except REJECTED_ROW_ERRORS as e:
+            if end - first == 1:
+                self.dead_letters.reject(
+                    batch.block_start(first), None,
+                    f'Rejected by the server: {e}', batch.rows[first])
+                return 0
+        middle = (first + end) // 2
+        return await self.copy_bisecting(conn, batch, first, middle) + \
+            await self.copy_bisecting(conn, batch, middle, end)
+
+    async def copy_rows(self, conn: asyncpg.Connection, rows: List) -> int:
+        if self.merge is None:
+            status = await copy_rows_to_table(conn, self.copy_table, rows)
+            return parse_insert_status_string(status)
+        inserted, updated = await self.merge.merge(conn, rows, self.columns)
+        self.metrics.num_rows_inserted += inserted
+        self.metrics.num_rows_updated += updated
+        return inserted + updated
+
+    async def file_chunks(self, f, start: int, end: Optional[int]):
+        reader = chunk_reader(f, self.config.chunk_size, start)
+        position = start
+        while True:
+            chunk = await reader.read_chunk()
+            if not chunk:
+                break
+            if end is not None:
+                chunk = chunk[:end - position]
+            position += len(chunk)
+            if chunk:
+                self.metrics.num_bytes_copied += len(chunk)
+                yield chunk
+            if end is not None and position >= end:
+                break
+
+    async def copy_passthrough(self) -> Tuple[int, int]:
+        """Stream the bytes of the input following the header (or of the byte
+        range) straight to the server, which parses them. If passthrough_verify
+        is set, a first pass checks the length of all the records."""
+        num_rows_read = 0
+        try:
+            async with self.connect() as conn:
+                if not self.table_created:
+                    await self.create_table(conn)
+                f = self.input
+                reader = await self.open_chunk_reader(
+                    f, on_empty_line=OnError.exception,
+                    on_wrong_length=OnError.exception)
+                start, end = reader.records_end, reader.end
+                if self.config.passthrough_verify:
+                    reader.expected_num_fields = self.record_length
+                    num_rows_read = await reader.verify()
+                    log.debug('[copy_passthrough] Verified %d rows',
+                              num_rows_read)
+                status = await self.copy_file(conn, f, start, end)
+            num_rows_written = parse_insert_status_string(status)
+            log.debug('[copy_passthrough] Wrote %d rows', num_rows_written)
+            return num_rows_read or num_rows_written, num_rows_written
+        except Exception as e:  # noqa
+            self._exception = e
+            return num_rows_read, 0
+
+    async def copy_file(self, conn: asyncpg.Connection, f,
+                        start: int, end: Optional[int]) -> str:
+        """Copy the bytes of the file between start and end in CSV format"""
+        text_columns = [col for col in self.header
+                        if col not in self.config.column_types]
+        t0 = time.perf_counter()
+        status = await conn.copy_to_table(
+            self.copy_table, source=self.file_chunks(f, start, end),
+            format='csv', force_not_null=text_columns or None)
+        self.metrics.copy_time += time.perf_counter() - t0
+        return status
+
+    async def sample_queue_depth(self, q: ByteBudgetQueue):
+        """Record the number of batches waiting in the queue every
+        metrics_sample_interval seconds, until cancelled"""
+        while True:
+            self.metrics.queue_depth_samples.append(
+                (time.perf_counter() - self.start_time, q.qsize()))
+            await asyncio.sleep(self.config.metrics_sample_interval)
+
+    async def report_metrics(self):
+        """Report the metrics every metrics_interval seconds, until
+        cancelled"""
+        while True:
+            await asyncio.sleep(self.config.metrics_interval)
+            self.report()
+
+    def report(self):
+        """Write the current metrics to the Prometheus textfile if one is
+        configured, or log them otherwise"""
+        self.update_stage_metrics()
+        labels = {'table': self.config.table_name}
+        path = self.config.metrics_prometheus_file
+        if self.byte_range is not None:
+            labels['byte_range_start'] = self.byte_range[0]
+            if path:
+                root, ext = os.path.splitext(path)
+                path = f'{root}-{self.byte_range[0]}{ext}'
+        if path:
+            write_prometheus_textfile(path, self.metrics, **labels)
+        else:
+            log_metrics(self.metrics, **labels)
+
+    @property
+    def reports_metrics(self) -> bool:
+        return bool(self.config.metrics_interval or
+                    self.config.metrics_prometheus_file)
+
     async def schedule_coroutines(self) -> Tuple[int, int]:
-        q = asyncio.Queue(maxsize=MAX_QUEUE_SIZE)
-        self.file_reader_task = asyncio.ensure_future(self.read_file(q))
-        self.postgres_task = asyncio.ensure_future(self.stream_to_postgres(q))
-        return await asyncio.gather(self.file_reader_task, self.postgres_task)
+        monitors = []
+        if self.config.metrics_interval:
+            monitors.append(asyncio.ensure_future(self.report_metrics()))
+        try:
+            if self.config.passthrough:
+                return await self.copy_passthrough()
+            q = ByteBudgetQueue(self.config.max_inflight_bytes)
+            monitors.append(asyncio.ensure_future(self.sample_queue_depth(q)))
+            self.file_reader_task = asyncio.ensure_future(self.read_file(q))
+            self.postgres_task = asyncio.ensure_future(
+                self.stream_to_postgres(q))
+            return await asyncio.gather(self.file_reader_task,
+                                        self.postgres_task)
+        finally:
+            for task in monitors:
+                task.cancel()
 
     def run(self) -> ExecutionResult:
+        if self.config.num_processes > 1 and self.byte_range is None:
+            return self.run_in_processes()
+        loop = asyncio.get_event_loop()
+        try:
+            return loop.run_until_complete(self.execute())
+        finally:
+            loop.run_until_complete(loop.shutdown_asyncgens())
+
+    async def execute(self) -> ExecutionResult:
+        """Load the input in the running event loop"""
         self.tick()
+        self.start_time = time.perf_counter()
         self._exception = None
-        loop = asyncio.get_event_loop()
-        result = ExecutionResult()
+        self.metrics = Metrics()
+        self.readers = []
+        self.batcher = None
+        result = ExecutionResult(metrics=self.metrics)
         num_rows_read = num_rows_written = 0
         try:
-            num_rows_read, num_rows_written = \
-                loop.run_until_complete(self.schedule_coroutines())
-            if self._exception:
-                e = self._exception
-                details = '\n'.join(
-                    traceback.format_exception(None, e, e.__traceback__))
-                result.errors.append(
-                    f'Uncaught exception: {repr(e)}, traceback: {details}')
+            async with AsyncExitStack() as stack:
+                try:
+                    self.input = await stack.enter_async_context(
+                        self.open_input())
+                    if self.byte_range is None:
+                        await self.read_header()
+                    if self.expected_header not in (None, self._header):
+                        raise HeaderMismatchError(
+                            'the header differs from the header of the '
+                            'other files')
+                    self.projection  # raises on unknown source columns
+                    self.row_filter  # and on unknown filtered columns
+                    check_key_columns(self.columns, self.config.key_columns,
+                                      self.config.update_columns)
+                    self.window = self.seek_row_range()
+                    self.metrics.num_rows_total = self.num_rows_total
+                except Exception as e:  # noqa
+                    self._exception = e
+                else:
+                    await self.complete_schema()
+                    await self.open_checkpoints()
+                    await self.open_dead_letters()
+                    num_rows_read, num_rows_written = \
+                        await self.schedule_coroutines()
+                    await self.close_dead_letters()
+                    if self._exception is None and self.finishes_load:
+                        try:
+                            await self.finish_load()
+                        except Exception as e:  # noqa
+                            self._exception = e
+            if isinstance(self._exception, HeaderMismatchError):
+                result.errors.append(str(self._exception))
+            elif self._exception:
+                result.errors.append(describe_exception(self._exception))
         finally:
-            loop.run_until_complete(loop.shutdown_asyncgens())
             result.metrics.num_rows_read = num_rows_read
             result.metrics.num_rows_written = num_rows_written
             result.metrics.wall_clock_computation_time = self.tick()
+            self.update_stage_metrics()
+            result.metrics.summarize()
+            if self.reports_metrics:
+                self.report()
+        return result
+
+    def split_input(self) -> List[Tuple[int, int]]:
+        """Split the records following the header in byte ranges, one per
+        worker process, on indexed records if the input is indexed"""
+        if self.index is not None:
+            return self.index.split(self.config.num_processes)
+        return split_records(self.config.input_file,
+                             self.config.num_processes, start=self.header_end)
+
+    def run_in_processes(self) -> ExecutionResult:
+        """Load the input file with one reader and writers per byte range in
+        a pool of num_processes processes, and merge their results."""
+        self.tick()
+        result = ExecutionResult()
+        self.metrics = result.metrics
+        try:
+            self.resolve_schema()
+            self.prepare_checkpoints()
+            byte_ranges = self.split_input()
+            log.debug('Split %s in byte ranges %s', self.config.input_file,
+                      byte_ranges)
+            loop = asyncio.get_event_loop()
+            loop.run_until_complete(self.prepare_table())
+            loop.run_until_complete(self.open_dead_letters())
+            try:
+                with ProcessPoolExecutor(
+                        self.config.num_processes) as executor:
+                    for worker_result in executor.map(
+                            load_byte_range, repeat(self.config), byte_ranges,
+                            repeat(self.header)):
+                        result.worker_metrics.append(worker_result.metrics)
+                        result.metrics.merge(worker_result.metrics)
+                        result.errors.extend(worker_result.errors)
+            finally:
+                if isinstance(self.dead_letters, FileDeadLetters):
+                    self.dead_letters.merge_worker_files(
+                        [start for start, _ in byte_ranges])
+            if not result.errors:
+                loop.run_until_complete(self.finish_load())
+        except Exception as e:  # noqa
+            result.errors.append(describe_exception(e))
+        finally:
+            result.metrics.wall_clock_computation_time = self.tick()
+            if self.reports_metrics:
+                self.report()
         return result
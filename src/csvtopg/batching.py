@@ -0,0 +1,205 @@
+"""Grouping of the rows read from the input in batches bounded by a number of
+rows, a number of bytes and a maximum waiting time, and queue of the batches
+bounded by their total size.
+"""
+
+import asyncio
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, NamedTuple, Optional
+
+
+class Segment(NamedTuple):
+    """Rows first_row to end_row (excluded) of the block_rows rows parsed
+    from the input bytes block_start to block_end (excluded)"""
+    block_start: int
+    block_end: int
+    first_row: int
+    end_row: int
+    block_rows: int
+
+
+class Batch:
+    """Rows copied to the database in a single COPY operation, along with the
+    approximate size in bytes that they occupied in the input and the input
+    segments they come from, if known"""
+    __slots__ = ('rows', 'nbytes', 'segments')
+
+    def __init__(self, rows: List, nbytes: int,
+                 segments: Optional[List[Segment]] = None):
+        self.rows = rows
+        self.nbytes = nbytes
+        self.segments = segments or []
+
+    def __len__(self):
+        return len(self.rows)
+
+    def block_start(self, row: int) -> Optional[int]:
+        """Return the first byte of the input block that a row of the batch
+        was parsed from, if known"""
+        for segment in self.segments:
+            if row < segment.end_row - segment.first_row:
+                return segment.block_start
+            row -= segment.end_row - segment.first_row
+        return None
+
+
+def record_in_histogram(histogram: Dict[int, int], value: int):
+    """Count `value` in the bucket of the smallest power of 2 that is greater
+    than or equal to it.
+
+    >>> histogram = {}
+    >>> for value in (1, 3, 4, 5):
+    ...     record_in_histogram(histogram, value)
+    >>> histogram
+    {1: 1, 4: 2, 8: 1}
+    """
+    bucket = 1 << max(value - 1, 0).bit_length()
+    histogram[bucket] = histogram.get(bucket, 0) + 1
+
+
+class Batcher:
+    """Accumulate rows and put them in the queue as batches of at most
+    `target_rows` rows and `target_bytes` bytes. Rows wait at most
+    `max_linger` seconds before being sent as part of an incomplete batch,
+    provided that the linger coroutine is running. The rows of the batches
+    are converted by `pack`, if set, e.g. to csvtopg.packing.PackedRows.
+    """
+
+    def __init__(self, q: asyncio.Queue, target_rows: int, target_bytes: int,
+                 max_linger: float, pack: Optional[Callable] = None):
+        self.q = q
+        self.target_rows = target_rows
+        self.target_bytes = target_bytes
+        self.max_linger = max_linger
+        self.pack = pack
+        self.rows: List = []
+        self.nbytes = 0
+        self.segments: List[Segment] = []
+        self.oldest: Optional[float] = None
+        self.rows_histogram: Dict[int, int] = {}
+        self.bytes_histogram: Dict[int, int] = {}
+        self.put_wait_time = 0.  # time blocked on a full queue, in seconds
+
+    async def add(self, rows: List, nbytes: int,
+                  segment: Optional[Segment] = None):
+        if not self.rows:
+            self.oldest = time.perf_counter()
+        self.rows.extend(rows)
+        self.nbytes += nbytes
+        if segment is not None:
+            self.segments.append(segment)
+        while len(self.rows) >= self.target_rows or \
+                self.nbytes >= self.target_bytes:
+            row_size = self.nbytes / len(self.rows)
+            num_rows = self.target_rows
+            if row_size:
+                num_rows = max(1, min(num_rows,
+                                      int(self.target_bytes / row_size)))
+            batch = Batch(self.packed(self.rows[:num_rows]),
+                          round(num_rows * row_size),
+                          self.take_segments(num_rows))
+            del self.rows[:num_rows]
+            self.nbytes = max(self.nbytes - batch.nbytes, 0)
+            await self.put(batch)
+        if self.rows and \
+                time.perf_counter() - self.oldest >= self.max_linger:
+            await self.flush()
+
+    async def flush(self):
+        """Send the pending rows, if any, as an incomplete batch"""
+        if self.rows:
+            rows = self.rows
+            batch = Batch(self.packed(rows), self.nbytes, self.segments)
+            self.rows = []
+            self.nbytes = 0
+            self.segments = []
+            try:
+                await self.put(batch)
+            except asyncio.CancelledError:
+                # the linger task is cancelled while waiting for room in the
+                # queue: keep the rows for the final flush
+                self.rows[:0] = rows
+                self.nbytes += batch.nbytes
+                self.segments[:0] = batch.segments
+                raise
+
+    def packed(self, rows: List):
+        return rows if self.pack is None else self.pack(rows)
+
+    def take_segments(self, num_rows: int) -> List[Segment]:
+        """Remove and return the segments of the first num_rows rows"""
+        taken = []
+        while self.segments:
+            segment = self.segments[0]
+            segment_rows = segment.end_row - segment.first_row
+            if segment_rows > num_rows:
+                split = segment.first_row + num_rows
+                taken.append(segment._replace(end_row=split))
+                self.segments[0] = segment._replace(first_row=split)
+                break
+            taken.append(self.segments.pop(0))
+            num_rows -= segment_rows
+        return taken
+
+    async def linger(self):
+        """Flush the pending rows whenever the oldest has been waiting for
+        max_linger seconds. Runs until cancelled."""
+        while True:
+            delay = self.max_linger
+            if self.rows:
+                delay -= time.perf_counter() - self.oldest
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                await self.flush()
+
+    async def put(self, batch: Batch):
+        t0 = time.perf_counter()
+        await self.q.put(batch)
+        self.put_wait_time += time.perf_counter() - t0
+        record_in_histogram(self.rows_histogram, len(batch))
+        record_in_histogram(self.bytes_histogram, batch.nbytes)
+
+
+class ByteBudgetQueue(asyncio.Queue):
+    """Queue of batches that blocks producers while the batches in flight,
+    from their put in the queue to their release by the consumer, exceed
+    `max_bytes` in total. Sizes are estimated by the `nbytes` attribute of
+    the items, 0 if they have none. A batch larger than the budget is
+    accepted when nothing else is in flight.
+    """
+
+    def __init__(self, max_bytes: int, maxsize: int = 0):
+        super().__init__(maxsize)
+        self.max_bytes = max_bytes
+        self.inflight_bytes = 0
+        self.peak_inflight_bytes = 0
+        self.budget_waiters: Deque[asyncio.Future] = deque()
+
+    async def put(self, item):
+        nbytes = getattr(item, 'nbytes', 0)
+        while self.inflight_bytes and \
+                self.inflight_bytes + nbytes > self.max_bytes:
+            waiter = asyncio.get_event_loop().create_future()
+            self.budget_waiters.append(waiter)
+            await waiter
+        self.inflight_bytes += nbytes
+        self.peak_inflight_bytes = max(self.peak_inflight_bytes,
+                                       self.inflight_bytes)
+        await super().put(item)
+
+    def release(self, item):
+        """Remove a batch taken from the queue from the bytes in flight, once
+        it has been processed"""
+        self.inflight_bytes -= getattr(item, 'nbytes', 0)
+        while self.budget_waiters:
+            waiter = self.budget_waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def clear(self):
+        """Drop the batches waiting in the queue"""
+        for item in self._queue:
+            self.release(item)
+        self._queue.clear()
@@ -0,0 +1,286 @@
+"""Throughput benchmarks of the reader and writer modes, against a throwaway
+local PostgreSQL server started with initdb and pg_ctl, and memory footprint
+of the batch formats.
+
+The CLI imports this module for the defaults of the bench command, so the
+application is only imported by the functions running benchmarks.
+"""
+
+import asyncio
+import csv
+import dataclasses
+import gc
+import io
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socket
+import string
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from itertools import islice
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+if TYPE_CHECKING:
+    from csvtopg.configuration import Config
+
+log = logging.getLogger(__name__)
+
+# Configuration overrides of the benchmarked modes
+MODES: Dict[str, Dict] = {
+    'line': {'reader_mode': 'line'},
+    'chunk': {},
+    'mmap': {'reader_mode': 'mmap'},
+    'chunk-4-writers': {'num_writers': 4},
+    'chunk-packed': {'batch_format': 'packed'},
+    'processes': {'num_processes': os.cpu_count() or 2, 'num_writers': 2},
+    'passthrough': {'passthrough': True},
+}
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+@dataclasses.dataclass
+class Dataset:
+    num_rows: int = 1_000_000
+    num_columns: int = 10
+    quote_ratio: float = 0.1  # proportion of quoted fields
+    field_size: int = 8  # average number of characters per field
+    size: Optional[int] = None  # in bytes, overrides num_rows if set
+
+
+def generate_csv(path: str, dataset: Dataset, seed: int = 0) -> int:
+    """Write a synthetic CSV file and return its number of data rows. Quoted
+    fields contain delimiters, quotes and newlines."""
+    rng = random.Random(seed)
+    alphabet = string.ascii_letters + string.digits
+    max_size = 2 * dataset.field_size
+    pool = [''.join(rng.choices(alphabet, k=rng.randint(1, max_size)))
+            for _ in range(1000)]
+    quoted = [f'"{v[:len(v) // 2]},""\n{v[len(v) // 2:]}"' for v in pool]
+    header = ','.join(f'col{i}' for i in range(dataset.num_columns)) + '\n'
+    num_rows = 0
+    size = len(header)
+    with open(path, 'w', newline='') as f:
+        f.write(header)
+        while (size < dataset.size if dataset.size is not None
+               else num_rows < dataset.num_rows):
+            lines = []
+            for _ in range(1000):
+                fields = [
+                    rng.choice(quoted) if rng.random() < dataset.quote_ratio
+                    else rng.choice(pool) for _ in range(dataset.num_columns)]
+                lines.append(','.join(fields) + '\n')
+            if dataset.size is None:
+                lines = lines[:dataset.num_rows - num_rows]
+            chunk = ''.join(lines)
+            f.write(chunk)
+            size += len(chunk)
+            num_rows += len(lines)
+    return num_rows
+
+
+class LocalPostgres:
+    """Context manager running a PostgreSQL server in a temporary directory,
+    listening on a Unix socket only. The binaries are looked up in
+    `bin_dir`, or in the PATH. Like initdb, it refuses to run as root."""
+
+    def __init__(self, bin_dir: Optional[str] = None):
+        self.bin_dir = bin_dir
+        self.tmp_dir: Optional[tempfile.TemporaryDirectory] = None
+        self.port = find_free_port()
+
+    def binary(self, name: str) -> str:
+        path = (os.path.join(self.bin_dir, name) if self.bin_dir
+                else shutil.which(name))
+        if not path or not os.path.exists(path):
+            raise BenchmarkError(
+                f'Cannot find {name}, install PostgreSQL or set its '
+                f'binaries directory')
+        return path
+
+    @property
+    def conn_uri(self) -> str:
+        return (f'postgresql://csvtopg@/postgres?host={self.tmp_dir.name}'
+                f'&port={self.port}')
+
+    def __enter__(self) -> 'LocalPostgres':
+        self.tmp_dir = tempfile.TemporaryDirectory(prefix='csvtopg-bench-')
+        data_dir = os.path.join(self.tmp_dir.name, 'data')
+        subprocess.run(
+            [self.binary('initdb'), '-D', data_dir, '-U', 'csvtopg',
+             '--auth=trust', '--no-sync'],
+            check=True, capture_output=True)
+        subprocess.run(
+            [self.binary('pg_ctl'), '-D', data_dir, '-w', '-l',
+             os.path.join(self.tmp_dir.name, 'postgres.log'), '-o',
+             f'-p {self.port} -k {self.tmp_dir.name} -c listen_addresses=',
+             'start'], check=True, capture_output=True)
+        return self
+
+    def __exit__(self, *exc_info):
+        subprocess.run(
+            [self.binary('pg_ctl'), '-D',
+             os.path.join(self.tmp_dir.name, 'data'), '-m', 'fast', 'stop'],
+            capture_output=True)
+        self.tmp_dir.cleanup()
+
+
+def find_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+async def drop_table(conn_uri: str, table_name: str):
+    import asyncpg
+    conn = await asyncpg.connect(conn_uri)
+    try:
+        await conn.execute(f'DROP TABLE IF EXISTS {table_name}')
+    finally:
+        await conn.close()
+
+
+def run_mode(config: 'Config') -> Dict:
+    """Run a load in the current (fresh) process and return its result with
+    the peak resident memory of the process and its children."""
+    from csvtopg.application import CSVToPg, ExecutionResult
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    asyncio.get_event_loop().run_until_complete(
+        drop_table(config.conn_uri, config.table_name))
+    result: ExecutionResult = CSVToPg(config).run()
+    peak_rss_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                      resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return {'metrics': dataclasses.asdict(result.metrics),
+            'errors': result.errors, 'peak_rss_kb': peak_rss_kb}
+
+
+def benchmark(input_file: str, conn_uri: str,
+              modes: List[str]) -> List[Dict]:
+    """Load the input file once per mode, each time in a new process, and
+    return the measurements"""
+    from csvtopg.configuration import Config
+    size = os.path.getsize(input_file)
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for mode in modes:
+        config = Config(conn_uri, f'bench_{mode.replace("-", "_")}',
+                        input_file, False, 'WARNING', **MODES[mode])
+        with context.Pool(1) as pool:
+            run = pool.apply(run_mode, (config,))
+        metrics = run['metrics']
+        wall_time = metrics['wall_clock_computation_time']
+        results.append({
+            'mode': mode,
+            'rows_per_s': metrics['num_rows_written'] / wall_time,
+            'mb_per_s': size / wall_time / 1e6,
+            'peak_rss_mb': run['peak_rss_kb'] / 1024,
+            'wall_time': wall_time,
+            'stage_times': {k: v for k, v in metrics.items()
+                            if k.endswith('_time') and
+                            k != 'wall_clock_computation_time'},
+            'num_rows_written': metrics['num_rows_written'],
+            'errors': run['errors'],
+        })
+        log.info('%s: %.0f rows/s', mode, results[-1]['rows_per_s'])
+    return results
+
+
+def measure_batch_memory(input_file: str,
+                         num_rows: int = 50_000) -> Dict[str, Dict]:
+    """Measure with tracemalloc, for each batch format, the memory held by a
+    batch of the first rows of the input file, the peak memory while it is
+    built from the parsed rows, and the number of memory blocks it holds"""
+    with open(input_file, newline='') as f:
+        reader = csv.reader(f)
+        next(reader)
+        output = io.StringIO()
+        csv.writer(output).writerows(islice(reader, num_rows))
+    text = output.getvalue()
+    results = {}
+    from csvtopg.configuration import BATCH_FORMATS
+    from csvtopg.packing import PackedRows
+    for batch_format in sorted(BATCH_FORMATS):
+        gc.collect()
+        tracemalloc.start()
+        try:
+            rows = list(csv.reader(io.StringIO(text, newline='')))
+            batch = PackedRows.pack(rows) if batch_format == 'packed' \
+                else rows
+            del rows
+            current, peak = tracemalloc.get_traced_memory()
+            num_blocks = sum(stat.count for stat in
+                             tracemalloc.take_snapshot().statistics('filename'))
+        finally:
+            tracemalloc.stop()
+        results[batch_format] = {
+            'bytes_per_row': current / len(batch),
+            'peak_bytes_per_row': peak / len(batch),
+            'blocks_per_batch': num_blocks,
+        }
+        del batch
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            check=True, text=True,
+            cwd=os.path.dirname(__file__)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        from csvtopg import __version__
+        return __version__
+
+
+def run_benchmarks(dataset: Dataset, modes: List[str],
+                   pg_bin_dir: Optional[str] = None,
+                   conn_uri: Optional[str] = None) -> Dict:
+    """Generate the dataset and benchmark the modes against conn_uri, or a
+    throwaway local server if it is None"""
+    with tempfile.TemporaryDirectory(prefix='csvtopg-bench-') as tmp_dir:
+        input_file = os.path.join(tmp_dir, 'bench.csv')
+        t0 = time.perf_counter()
+        num_rows = generate_csv(input_file, dataset)
+        log.info('Generated %d rows in %.1f s', num_rows,
+                 time.perf_counter() - t0)
+        report = {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'dataset': {**dataclasses.asdict(dataset), 'num_rows': num_rows,
+                        'size': os.path.getsize(input_file)},
+        }
+        if conn_uri is None:
+            with LocalPostgres(pg_bin_dir) as server:
+                report['results'] = benchmark(
+                    input_file, server.conn_uri, modes)
+        else:
+            report['results'] = benchmark(input_file, conn_uri, modes)
+        report['batch_memory'] = measure_batch_memory(input_file)
+    return report
+
+
+def compare(report: Dict, baseline: Dict) -> List[str]:
+    """Describe the throughput change of each mode against a baseline"""
+    before = {r['mode']: r for r in baseline['results']}
+    lines = []
+    for result in report['results']:
+        if result['mode'] in before:
+            ratio = (result['rows_per_s'] /
+                     before[result['mode']]['rows_per_s'])
+            lines.append(f'{result["mode"]}: {ratio - 1:+.1%} rows/s vs '
+                         f'{baseline["commit"]}')
+    return lines
+
+
+def save_report(report: Dict, path: str):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
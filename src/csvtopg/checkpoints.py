@@ -0,0 +1,163 @@
+"""Durable records of the input segments already copied, which allow resuming
+an interrupted load without duplicating rows.
+
+The rows of each block parsed by the chunk reader are numbered from 0. A
+checkpoint records, for each committed batch, the byte range of the blocks its
+rows come from and their row numbers in those blocks. Resuming skips the
+blocks that were fully copied and parses again the partially copied ones, as a
+single block, to only copy their missing rows. This requires the same input
+and the same reader options as the interrupted load.
+"""
+
+import json
+import os
+from collections import defaultdict
+from typing import Iterable, List, Tuple
+
+import asyncpg
+
+from csvtopg.batching import Segment
+
+# Input byte range to read, with the row ranges already copied from it
+ReadUnit = Tuple[int, int, List[Tuple[int, int]]]
+
+
+class CheckpointError(Exception):
+    pass
+
+
+class TableCheckpoints:
+    """Checkpoints kept in a side table of the target database, and written
+    in the same transaction as the COPY of their batch."""
+
+    def __init__(self, checkpoint_table: str, table_name: str,
+                 input_file: str):
+        self.checkpoint_table = checkpoint_table
+        self.table_name = table_name
+        self.input_file = os.path.abspath(input_file)
+
+    async def prepare(self, conn: asyncpg.Connection):
+        await conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {self.checkpoint_table} (
+                table_name text NOT NULL,
+                input_file text NOT NULL,
+                block_start bigint NOT NULL,
+                block_end bigint NOT NULL,
+                first_row integer NOT NULL,
+                end_row integer NOT NULL,
+                block_rows integer NOT NULL,
+                committed_at timestamp with time zone DEFAULT now())''')
+
+    async def clear(self, conn: asyncpg.Connection):
+        await conn.execute(
+            f'DELETE FROM {self.checkpoint_table} '
+            f'WHERE table_name = $1 AND input_file = $2',
+            self.table_name, self.input_file)
+
+    async def load(self, conn: asyncpg.Connection) -> List[Segment]:
+        records = await conn.fetch(
+            f'SELECT block_start, block_end, first_row, end_row, block_rows '
+            f'FROM {self.checkpoint_table} '
+            f'WHERE table_name = $1 AND input_file = $2',
+            self.table_name, self.input_file)
+        return [Segment(*record) for record in records]
+
+    async def record_in_transaction(self, conn: asyncpg.Connection,
+                                    segments: List[Segment]):
+        await conn.copy_records_to_table(
+            self.checkpoint_table,
+            records=[(self.table_name, self.input_file) + segment
+                     for segment in segments],
+            columns=['table_name', 'input_file', 'block_start', 'block_end',
+                     'first_row', 'end_row', 'block_rows'])
+
+    def record_committed(self, segments: List[Segment]):
+        pass
+
+
+class FileCheckpoints:
+    """Checkpoints appended as JSON lines to a local file once their batch is
+    committed. A crash between the commit and the write duplicates the rows
+    of that batch on resume."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    async def prepare(self, conn: asyncpg.Connection):
+        pass
+
+    async def clear(self, conn: asyncpg.Connection):
+        open(self.path, 'w').close()
+
+    async def load(self, conn: asyncpg.Connection) -> List[Segment]:
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as f:
+            return [Segment(*json.loads(line)) for line in f if line.strip()]
+
+    async def record_in_transaction(self, conn: asyncpg.Connection,
+                                    segments: List[Segment]):
+        pass
+
+    def record_committed(self, segments: List[Segment]):
+        with open(self.path, 'a') as f:
+            f.writelines(json.dumps(segment) + '\n' for segment in segments)
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def plan_reads(start: int, end: int,
+               segments: Iterable[Segment]) -> List[ReadUnit]:
+    """Return the byte ranges between `start` and `end` that remain to be
+    read, with the row ranges already copied from partially copied blocks.
+
+    >>> plan_reads(0, 100, [Segment(0, 10, 0, 5, 5), Segment(20, 30, 0, 2, 4)])
+    [(10, 20, []), (20, 30, [(0, 2)]), (30, 100, [])]
+    """
+    blocks = defaultdict(list)
+    block_rows = {}
+    for segment in segments:
+        if segment.block_end <= start or segment.block_start >= end:
+            continue
+        if segment.block_start < start or segment.block_end > end:
+            raise CheckpointError(
+                f'Checkpointed block {segment.block_start}-'
+                f'{segment.block_end} overlaps the range {start}-{end}. '
+                f'Resume with the same options as the interrupted load.')
+        key = (segment.block_start, segment.block_end)
+        blocks[key].append((segment.first_row, segment.end_row))
+        block_rows[key] = segment.block_rows
+    units = []
+    position = start
+    for (block_start, block_end), copied in sorted(blocks.items()):
+        if block_start < position:
+            raise CheckpointError(
+                f'Checkpointed blocks overlap at byte {block_start}')
+        if block_start > position:
+            units.append((position, block_start, []))
+        copied.sort()
+        num_copied = sum(b - a for a, b in copied)
+        if num_copied < block_rows[(block_start, block_end)]:
+            units.append((block_start, block_end, copied))
+        position = block_end
+    if position < end:
+        units.append((position, end, []))
+    return units
+
+
+def missing_rows(num_rows: int,
+                 copied: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Return the row ranges of a block that are not in the sorted `copied`.
+
+    >>> missing_rows(10, [(0, 2), (5, 7)])
+    [(2, 5), (7, 10)]
+    """
+    missing = []
+    position = 0
+    for first, end in copied:
+        if first > position:
+            missing.append((position, first))
+        position = max(position, end)
+    if position < num_rows:
+        missing.append((position, num_rows))
+    return missing
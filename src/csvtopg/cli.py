@@ -3,30 +3,42 @@ contain application logic. The architecture is such that a this CLI module
 parses the command-line options and/or configuration file and creates a
 configuration object. It then instantiated a CSVToPg object representing the
 application logic, passing it the configuration object.
+
+The CLI is started many times on small files, where the start-up time is a
+large part of the run time: the application, its configuration and their
+dependencies are imported by the commands that use them, so that the help,
+the version and invalid invocations do not import them at all.
 """
 
 import asyncio
+import importlib.util
+import json
 import logging
 import os.path
+import subprocess
 import sys
+import time
 import traceback
-from typing import Dict, Optional, Union
+from dataclasses import replace
+from typing import TYPE_CHECKING, Dict, Optional, Sequence, Union
 
 import _io
 import click
-import toml
 
-from csvtopg import __version__
-from csvtopg.application import CSVToPg
-from csvtopg.configuration import Config, ConfigurationError, check_uvloop
+from csvtopg.bench import MODES, Dataset
+from csvtopg.index import DEFAULT_STRIDE
+
+if TYPE_CHECKING:
+    from csvtopg.configuration import Config
 
 log = logging.getLogger(__name__)
 
-UVLOOP_AVAILABLE = check_uvloop()
+UVLOOP_AVAILABLE = importlib.util.find_spec('uvloop') is not None
 
 OPTION_DEFAULTS = {
     'use_uvloop': UVLOOP_AVAILABLE,
-    'log_level': 'INFO'
+    'log_level': 'INFO',
+    'resume': False,
 }
 
 
@@ -47,6 +59,7 @@ def load_toml_file(conf_file: _io.TextIOWrapper) -> Dict:
     :param conf_file: file data as TextIOWrapper
     :return: hierarchical configuration in a dictionary
     """
+    import toml
     try:
         return toml.load(conf_file)
     finally:
@@ -54,9 +67,11 @@ def load_toml_file(conf_file: _io.TextIOWrapper) -> Dict:
 
 
 def load_and_check_configuration(
-        conf_file: _io.TextIOWrapper, csv_file: Optional[str],
+        conf_file: _io.TextIOWrapper,
+        csv_file: Optional[Union[str, Sequence[str]]],
         connection_string: Optional[str], table_name: str,
-        use_uvloop: Optional[bool], log_level: Optional[str]) -> Config:
+        use_uvloop: Optional[bool], log_level: Optional[str],
+        resume: Optional[bool] = None) -> 'Config':
     """Load the configuration file if specified. Then load the ad-hoc options,
     which take precedence over the configuration file. Verify consistency,
     display an error message and exit in case of issue, otherwise return a
@@ -66,15 +81,21 @@ def load_and_check_configuration(
     :param connection_string: PostgreSQL connection string in the libpq
         connection URI format
     :param table_name: table where the data will be inserted
-    :param csv_file: Path to the CSV file to load
+    :param csv_file: Path, glob or directory of the CSV files to load, or a
+        sequence of them
     :param use_uvloop: Flag to decide to use uvloop as event loop
     :param log_level: Minimum log level to be displayed in the console
+    :param resume: Flag to resume an interrupted load from its checkpoints
     :return: Merged and verified configuration object
     """
-    args_dict = Config(
+    from csvtopg.configuration import Config, ConfigurationError
+    if csv_file is not None and not isinstance(csv_file, str):
+        csv_file = list(csv_file) if len(csv_file) > 1 else \
+            (csv_file[0] if csv_file else None)
+    args_dict = dict(
         conn_uri=connection_string, input_file=csv_file,
         table_name=table_name, use_uvloop=use_uvloop,
-        log_level=log_level).to_dict()
+        log_level=log_level, resume=resume or None)
     valid_args_dict = {k: v for k, v in args_dict.items() if v is not None}
     unset_args_dict = {k: v for k, v in args_dict.items() if v is None}
     if conf_file:
@@ -102,7 +123,8 @@ def load_and_check_configuration(
                     message=f'Missing command-line option: "{k}"', err=True)
                 sys.exit(1)
         config = Config.from_dict({**unset_args_dict, **valid_args_dict})
-    config.input_file = os.path.expanduser(config.input_file)
+    if isinstance(config.input_file, str):
+        config.input_file = os.path.expanduser(config.input_file)
     if config.configuration_issues:
         issues = '\n'.join(config.configuration_issues)
         click.echo(message=f'Invalid configuration:\n{issues}', err=True)
@@ -110,19 +132,55 @@ def load_and_check_configuration(
     return config
 
 
-@click.command()
-@click.version_option(
-    version=__version__, help='Display the version and exit',
-    message='%(version)s')
+def print_version(ctx: click.Context, param: click.Parameter, value: bool):
+    if value and not ctx.resilient_parsing:
+        from csvtopg import __version__
+        click.echo(__version__)
+        ctx.exit()
+
+
+def check_loopback(ctx: click.Context, param: click.Parameter,
+                   value: str) -> str:
+    from csvtopg.server import is_loopback
+    if not is_loopback(value):
+        raise click.BadParameter('the server only listens on loopback '
+                                 'addresses')
+    return value
+
+
+class DefaultCommandGroup(click.Group):
+    """Group of commands that runs its default command when the first
+    argument is not the name of a command, so that `csvtopg --input_file ...`
+    keeps loading a file."""
+
+    def __init__(self, *args, default_command: str, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.default_command = default_command
+
+    def parse_args(self, ctx, args):
+        if not args or args[0] not in {*self.commands, '--help'}:
+            args = [self.default_command] + args
+        return super().parse_args(ctx, args)
+
+
+@click.group(cls=DefaultCommandGroup, default_command='load')
+def cli():
+    """Fast utility to load a CSV file in a PostgreSQL table. Without a
+    command name, the options are those of the load command."""
+
+
+@cli.command()
+@click.option(
+    '--version', is_flag=True, expose_value=False, is_eager=True,
+    callback=print_version, help='Display the version and exit')
 @click.option(
     '--conf_file', required=False, type=click.File('r'),
     help='Path to configuration file (TOML syntax). All options must be '
          'present. Redundant command-line options take precedence.')
 @click.option(
-    '--input_file', required=False, type=click.Path(
-        exists=True, file_okay=True, dir_okay=False, readable=True,
-        resolve_path=False, path_type=str),
-    help='Path to the input CSV file')
+    '--input_file', required=False, multiple=True, type=str,
+    help='Path to the input CSV file, or glob pattern or directory of input '
+         'files, or - for the standard input (repeatable)')
 @click.option(
     '--conn_uri', required=False, type=str,
     help='Connection string to the database, in the following format: '
@@ -136,18 +194,34 @@ def load_and_check_configuration(
 @click.option(
     '--log_level', required=False,
     help='Console logging level: DEBUG, INFO (default), WARNING, etc.')
-def cli(conf_file, input_file, conn_uri, table_name, use_uvloop, log_level):
-    """Entry point for console_scripts
+@click.option(
+    '--print_schema', is_flag=True, required=False,
+    help='Print the CREATE TABLE statement, with inferred types if '
+         'infer_types is configured, and exit without loading.')
+@click.option(
+    '--resume', is_flag=True, required=False,
+    help='Resume an interrupted load from its checkpoints.')
+def load(conf_file, input_file, conn_uri, table_name, use_uvloop, log_level,
+         print_schema, resume):
+    """Load a CSV file in a table (default command)
     """
+    from csvtopg.application import CSVToPg
+    from csvtopg.scheduler import run_load
     config = load_and_check_configuration(
-        conf_file, input_file, conn_uri, table_name, use_uvloop, log_level)
+        conf_file, input_file, conn_uri, table_name, use_uvloop, log_level,
+        resume)
     if config.use_uvloop:
         import uvloop
         asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     setup_logging(config.log_level)
     log.info("Final configuration: %s", config)
+    if print_schema:
+        app = CSVToPg(replace(config, input_file=config.input_files[0]))
+        app.resolve_schema()
+        click.echo(app.create_table_statement)
+        return
     log.debug("Starting")
-    result = CSVToPg(config).run()
+    result = run_load(config)
     log.info(result)
     if result.errors:
         click.echo("Errors encountered:", file=sys.stderr)
@@ -160,5 +234,150 @@ def cli(conf_file, input_file, conn_uri, table_name, use_uvloop, log_level):
         exit(2)
 
 
+@cli.command()
+@click.option('--rows', type=int, default=Dataset.num_rows, show_default=True,
+              help='Number of rows of the generated CSV file')
+@click.option('--size', type=int, required=False,
+              help='Size in MB of the generated CSV file, overrides --rows')
+@click.option('--columns', type=int, default=Dataset.num_columns,
+              show_default=True, help='Number of columns')
+@click.option('--field_size', type=int, default=Dataset.field_size,
+              show_default=True, help='Average number of characters per field')
+@click.option('--quote_ratio', type=float, default=Dataset.quote_ratio,
+              show_default=True,
+              help='Proportion of quoted fields, with embedded newlines')
+@click.option('--mode', 'modes', multiple=True, type=click.Choice(list(MODES)),
+              help='Mode to benchmark (repeatable, default: all)')
+@click.option('--pg_bin_dir', required=False, type=click.Path(file_okay=False),
+              help='Directory of the initdb and pg_ctl binaries, if not in '
+                   'the PATH')
+@click.option('--conn_uri', required=False, type=str,
+              help='Benchmark against this existing database instead of a '
+                   'throwaway local server')
+@click.option('--output', type=click.Path(dir_okay=False), required=False,
+              help='JSON file where the results are saved '
+                   '[default: csvtopg-bench-<commit>.json]')
+@click.option('--baseline', type=click.File('r'), required=False,
+              help='JSON results of a previous run to compare with')
+@click.option('--log_level', default='INFO', show_default=True,
+              help='Console logging level')
+def bench(rows, size, columns, field_size, quote_ratio, modes, pg_bin_dir,
+          conn_uri, output, baseline, log_level):
+    """Benchmark the load modes on a synthetic CSV file"""
+    from csvtopg.bench import (
+        BenchmarkError, compare, run_benchmarks, save_report)
+    setup_logging(log_level)
+    dataset = Dataset(num_rows=rows, num_columns=columns,
+                      quote_ratio=quote_ratio, field_size=field_size,
+                      size=size * 1_000_000 if size else None)
+    try:
+        report = run_benchmarks(dataset, list(modes or MODES), pg_bin_dir,
+                                conn_uri)
+    except (BenchmarkError, subprocess.CalledProcessError) as e:
+        click.echo(f'Benchmark failed: {e}', err=True)
+        sys.exit(1)
+    for r in report['results']:
+        click.echo(
+            f'{r["mode"]:>16}: {r["rows_per_s"]:>12,.0f} rows/s '
+            f'{r["mb_per_s"]:>8.1f} MB/s {r["peak_rss_mb"]:>8.1f} MB peak RSS'
+            + (' (errors)' if r['errors'] else ''))
+    for batch_format, m in report['batch_memory'].items():
+        click.echo(
+            f'{batch_format + " batches":>16}: '
+            f'{m["bytes_per_row"]:>12,.0f} bytes/row '
+            f'{m["peak_bytes_per_row"]:>8,.0f} peak bytes/row '
+            f'{m["blocks_per_batch"]:>10,} blocks per batch')
+    if baseline:
+        for line in compare(report, json.load(baseline)):
+            click.echo(line)
+    output = output or f'csvtopg-bench-{report["commit"]}.json'
+    save_report(report, output)
+    click.echo(f'Results saved to {output}')
+
+
+@cli.command()
+@click.argument('input_files', nargs=-1, required=True)
+@click.option('--stride', type=click.IntRange(min=1), default=DEFAULT_STRIDE,
+              show_default=True,
+              help='Number of records between two indexed offsets')
+@click.option('--log_level', default='INFO', show_default=True,
+              help='Console logging level')
+def index(input_files, stride, log_level):
+    """Index the records of CSV files, next to them (<file>.index), to
+    split, count and seek their rows without scanning them when loaded"""
+    from csvtopg.compression import resolve_compression
+    from csvtopg.configuration import expand_input_spec
+    from csvtopg.index import build_index, index_path
+    setup_logging(log_level)
+    paths = [path for spec in input_files
+             for path in expand_input_spec(spec)]
+    if not paths:
+        click.echo('No input file to index', err=True)
+        sys.exit(1)
+    failed = False
+    for path in paths:
+        if not os.path.isfile(path) or resolve_compression(path):
+            click.echo(f'Cannot index {path}: only uncompressed regular '
+                       f'files can be indexed', err=True)
+            failed = True
+            continue
+        t0 = time.perf_counter()
+        record_index = build_index(path, stride)
+        record_index.save(index_path(path))
+        click.echo(f'Indexed {record_index.num_records} records of '
+                   f'{record_index.num_fields} fields in {path} in '
+                   f'{time.perf_counter() - t0:.3f} seconds')
+    if failed:
+        sys.exit(1)
+
+
+@cli.command()
+@click.option('--socket', 'socket_path', required=False,
+              type=click.Path(dir_okay=False),
+              help='Unix socket to listen on, instead of a TCP port')
+@click.option('--host', default='127.0.0.1', show_default=True,
+              callback=check_loopback,
+              help='Loopback address to listen on, without --socket')
+@click.option('--port', type=int, default=8432, show_default=True,
+              help='TCP port to listen on, without --socket')
+@click.option('--token', envvar='CSVTOPG_SERVER_TOKEN', show_envvar=True,
+              required=False,
+              help='Token that the requests must send in an "Authorization: '
+                   'Bearer <token>" header, required without --socket')
+@click.option('--root', required=True,
+              type=click.Path(exists=True, file_okay=False),
+              help='Directory of the files that jobs may read and write')
+@click.option('--max_jobs', type=click.IntRange(min=1), default=4,
+              show_default=True,
+              help='Number of jobs run at a time, the others wait')
+@click.option('--pool_size', type=click.IntRange(min=1), default=8,
+              show_default=True,
+              help='Maximum number of connections kept open per database')
+@click.option('--use_uvloop', is_flag=True, required=False,
+              hidden=not UVLOOP_AVAILABLE, help='Use uvloop as event loop')
+@click.option('--log_level', default='INFO', show_default=True,
+              help='Console logging level')
+def serve(socket_path, host, port, token, root, max_jobs, pool_size,
+          use_uvloop, log_level):
+    """Run load jobs posted as JSON configurations to /jobs, over HTTP,
+    keeping the connections to the databases open between jobs"""
+    from csvtopg.server import LoadServer
+    if socket_path is None and not token:
+        raise click.UsageError('A token is required to listen on a TCP port, '
+                               'set CSVTOPG_SERVER_TOKEN or use --socket')
+    if use_uvloop:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    setup_logging(log_level)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = LoadServer(root, max_jobs=max_jobs, pool_size=pool_size,
+                        log_level=log_level, token=token)
+    try:
+        loop.run_until_complete(server.serve(socket_path, host, port))
+    finally:
+        loop.close()
+
+
 if __name__ == "__main__":
     cli()
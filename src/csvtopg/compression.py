@@ -0,0 +1,292 @@
+"""Streaming decompression of compressed inputs, detected by their magic
+bytes. gzip and bz2 are read with the standard library, zstd and lz4 with the
+optional zstandard and lz4 packages. Decompression runs in worker threads so
+that it does not block the event loop. The files made of several independent
+zstd or lz4 frames, as written by parallel compressors such as pzstd or by
+concatenating compressed parts, have their frames decompressed in parallel.
+"""
+
+import asyncio
+import bz2
+import gzip
+import importlib
+import os
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Deque, List, Optional, Tuple
+
+COMPRESSIONS = ('gzip', 'bz2', 'zstd', 'lz4')
+MAGIC_BYTES = {
+    b'\x1f\x8b': 'gzip',
+    b'BZh': 'bz2',
+    b'\x28\xb5\x2f\xfd': 'zstd',
+    b'\x04\x22\x4d\x18': 'lz4',
+}
+OPTIONAL_PACKAGES = {'zstd': 'zstandard', 'lz4': 'lz4.frame'}
+ZSTD_MAGIC = 0xFD2FB528
+LZ4_MAGIC = 0x184D2204
+# zstd and lz4 skippable frames (metadata) have magic numbers 0x184D2A5?
+SKIPPABLE_MAGIC_MASK = 0xFFFFFFF0
+SKIPPABLE_MAGIC = 0x184D2A50
+# files with larger frames are decompressed sequentially, to bound the memory
+# taken by the frames decompressed ahead
+MAX_PARALLEL_FRAME_SIZE = 16 * 1024 * 1024
+
+Frame = Tuple[int, int]  # start and end offsets of a frame in the file
+
+
+class CompressionError(Exception):
+    pass
+
+
+def detect_compression(path: str) -> Optional[str]:
+    """Return the compression format of the file according to its first
+    bytes, or None if it is not compressed"""
+    with open(path, 'rb') as f:
+        return detect_magic(f.read(4))
+
+
+def resolve_compression(path: str, compression: str = 'auto') \
+        -> Optional[str]:
+    """Interpret the compression configuration option for a file"""
+    if compression == 'auto':
+        return detect_compression(path)
+    return None if compression == 'none' else compression
+
+
+def import_codec(compression: str):
+    """Import the optional package needed to decompress a format"""
+    name = OPTIONAL_PACKAGES[compression]
+    try:
+        return importlib.import_module(name)
+    except ImportError as e:
+        raise CompressionError(
+            f'Reading {compression} files requires the '
+            f'{name.split(".")[0]} package') from e
+
+
+def detect_magic(head: bytes) -> Optional[str]:
+    for magic, compression in MAGIC_BYTES.items():
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def open_decompressed(path: str, compression: Optional[str]) -> BinaryIO:
+    """Open a file for reading its decompressed bytes, blocking"""
+    if compression is None:
+        return open(path, 'rb')
+    if compression == 'gzip':
+        return gzip.open(path, 'rb')
+    if compression == 'bz2':
+        return bz2.open(path, 'rb')
+    codec = import_codec(compression)
+    if compression == 'zstd':
+        return codec.ZstdDecompressor().stream_reader(
+            open(path, 'rb'), read_across_frames=True, closefd=True)
+    return codec.open(path, 'rb')
+
+
+def read_uint(f: BinaryIO, offset: int, size: int) -> int:
+    data = os.pread(f.fileno(), size, offset)
+    if len(data) < size:
+        raise CompressionError(f'Truncated frame at byte {offset}')
+    return int.from_bytes(data, 'little')
+
+
+def zstd_frame_end(f: BinaryIO, start: int) -> int:
+    """Return the end of the zstd frame starting at `start` by walking its
+    block headers, without decompressing it"""
+    descriptor = read_uint(f, start + 4, 1)
+    content_size_flag = descriptor >> 6
+    single_segment = descriptor >> 5 & 1
+    has_checksum = descriptor >> 2 & 1
+    header_size = 1 + (not single_segment) + (0, 1, 2, 4)[descriptor & 3] + \
+        (single_segment, 2, 4, 8)[content_size_flag]
+    position = start + 4 + header_size
+    while True:
+        block_header = read_uint(f, position, 3)
+        block_type = block_header >> 1 & 3
+        if block_type == 3:
+            raise CompressionError(f'Invalid zstd block at byte {position}')
+        # RLE blocks hold a single byte repeated block size times
+        position += 3 + (1 if block_type == 1 else block_header >> 3)
+        if block_header & 1:  # last block
+            return position + 4 * has_checksum
+
+
+def lz4_frame_end(f: BinaryIO, start: int) -> int:
+    """Return the end of the lz4 frame starting at `start` by walking its
+    block sizes, without decompressing it"""
+    flags = read_uint(f, start + 4, 1)
+    has_block_checksums = flags >> 4 & 1
+    position = start + 7 + 8 * (flags >> 3 & 1) + 4 * (flags & 1)
+    while True:
+        block_size = read_uint(f, position, 4)
+        position += 4
+        if block_size == 0:  # end mark
+            return position + 4 * (flags >> 2 & 1)
+        position += (block_size & 0x7FFFFFFF) + 4 * has_block_checksums
+
+
+def find_frames(path: str, compression: str) -> List[Frame]:
+    """Return the byte ranges of the data frames of a zstd or lz4 file"""
+    magic_number, frame_end = {
+        'zstd': (ZSTD_MAGIC, zstd_frame_end),
+        'lz4': (LZ4_MAGIC, lz4_frame_end)}[compression]
+    size = os.path.getsize(path)
+    frames = []
+    position = 0
+    with open(path, 'rb') as f:
+        while position < size:
+            magic = read_uint(f, position, 4)
+            if magic & SKIPPABLE_MAGIC_MASK == SKIPPABLE_MAGIC:
+                position += 8 + read_uint(f, position + 4, 4)
+            elif magic == magic_number:
+                end = frame_end(f, position)
+                frames.append((position, end))
+                position = end
+            else:
+                raise CompressionError(
+                    f'Invalid {compression} frame at byte {position}')
+    return frames
+
+
+def decompress_frame(path: str, compression: str, frame: Frame) -> bytes:
+    start, end = frame
+    with open(path, 'rb') as f:
+        data = os.pread(f.fileno(), end - start, start)
+    codec = import_codec(compression)
+    if compression == 'zstd':
+        return codec.ZstdDecompressor().decompressobj().decompress(data)
+    return codec.decompress(data)
+
+
+class DecompressingReader:
+    """Read the decompressed bytes of a file by chunks, like aiofile.Reader
+    reads a plain file. The `offset` is a position in the decompressed data;
+    the bytes before it are decompressed and skipped."""
+
+    def __init__(self, path: str, compression: str, chunk_size: int,
+                 offset: int = 0, num_threads: int = 1):
+        self.path = path
+        self.compression = compression
+        self.chunk_size = chunk_size
+        self.skip = offset
+        self.num_threads = num_threads
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.file: Optional[BinaryIO] = None
+        self.frames: Optional[Deque[Frame]] = None
+        self.pending: Deque[asyncio.Future] = deque()
+        self.eof = False
+
+    async def start(self):
+        self.executor = ThreadPoolExecutor(self.num_threads)
+        loop = asyncio.get_event_loop()
+        if self.num_threads > 1 and self.compression in ('zstd', 'lz4'):
+            frames = await loop.run_in_executor(
+                self.executor, find_frames, self.path, self.compression)
+            if len(frames) > 1 and max(
+                    end - start for start, end in frames) <= \
+                    MAX_PARALLEL_FRAME_SIZE:
+                self.frames = deque(frames)
+                return
+        self.file = await loop.run_in_executor(
+            self.executor, open_decompressed, self.path, self.compression)
+
+    async def read_decompressed(self) -> bytes:
+        loop = asyncio.get_event_loop()
+        if self.frames is None:
+            return await loop.run_in_executor(
+                self.executor, self.file.read, self.chunk_size)
+        while self.frames and len(self.pending) < self.num_threads:
+            self.pending.append(loop.run_in_executor(
+                self.executor, decompress_frame, self.path, self.compression,
+                self.frames.popleft()))
+        if not self.pending:
+            return b''
+        return await self.pending.popleft()
+
+    async def read_chunk(self) -> bytes:
+        if self.eof:
+            return b''
+        if self.executor is None:
+            await self.start()
+        while True:
+            chunk = await self.read_decompressed()
+            if not chunk:
+                self.eof = True
+                self.close()
+            elif self.skip:
+                skipped = min(self.skip, len(chunk))
+                self.skip -= skipped
+                chunk = chunk[skipped:]
+                if not chunk:
+                    continue
+            return chunk
+
+    def close(self):
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+
+class CompressedFile:
+    """Stands for an aiofile.AIOFile of a compressed file, for the readers of
+    csvtopg.aiocsv, which create their chunk readers with `reader`"""
+    # readers can start anywhere, the bytes before are decompressed again
+    seekable = True
+
+    def __init__(self, path: str, compression: str, num_threads: int = 1):
+        self.path = path
+        self.compression = compression
+        self.num_threads = num_threads
+        self.readers: List[DecompressingReader] = []
+
+    def reader(self, chunk_size: int, offset: int = 0) -> DecompressingReader:
+        reader = DecompressingReader(self.path, self.compression, chunk_size,
+                                     offset, self.num_threads)
+        self.readers.append(reader)
+        return reader
+
+    async def __aenter__(self) -> 'CompressedFile':
+        return self
+
+    async def __aexit__(self, *exc_info):
+        for reader in self.readers:
+            reader.close()
+
+
+class StreamDecompressor:
+    """Incremental decompression of the data of a stream, which may be made
+    of several concatenated members or frames"""
+
+    def __init__(self, compression: str):
+        self.compression = compression
+        self.decompressor = self.new_decompressor()
+
+    def new_decompressor(self):
+        if self.compression == 'gzip':
+            return zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+        if self.compression == 'bz2':
+            return bz2.BZ2Decompressor()
+        codec = import_codec(self.compression)
+        if self.compression == 'zstd':
+            return codec.ZstdDecompressor().decompressobj()
+        return codec.LZ4FrameDecompressor()
+
+    def decompress(self, data: bytes) -> bytes:
+        decompressed = []
+        while data:
+            decompressed.append(self.decompressor.decompress(data))
+            data = b''
+            if self.decompressor.eof:
+                data = self.decompressor.unused_data
+                self.decompressor = self.new_decompressor()
+        return b''.join(decompressed)
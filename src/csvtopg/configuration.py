@@ -1,12 +1,36 @@
+import glob
+import importlib.util
 import logging
 import os.path
-from dataclasses import asdict, dataclass
-from typing import Dict, List, Optional
+import re
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional, Union
 
 import dacite
 
+from csvtopg.aiocsv import OnError
+from csvtopg.columns import ColumnSpec
+from csvtopg.compression import COMPRESSIONS, resolve_compression
+from csvtopg.deadletters import DEAD_LETTER_STORES
+from csvtopg.filtering import FilterError, parse_filter
+from csvtopg.formats import COLUMNAR_FORMATS, INPUT_FORMATS, resolve_format
+from csvtopg.index import INDEX_SUFFIX
+from csvtopg.pgtypes import PG_TYPES
+from csvtopg.sources import INPUT_SOURCES, STDIN, is_stream
+from csvtopg.staging import CONFLICT_POLICIES, LOAD_STRATEGIES
+
 log = logging.getLogger(__name__)
 
+READER_MODES = {'line', 'chunk', 'mmap'}
+BLOCK_READER_MODES = {'chunk', 'mmap'}  # modes that can read byte ranges
+# rows of the batches in flight: lists of values, or csvtopg.packing buffers
+BATCH_FORMATS = {'rows', 'packed'}
+# files written next to the inputs, ignored when loading a directory
+SIDECAR_SUFFIXES = ('.checkpoint', '.rejected', INDEX_SUFFIX)
+# table names are written in SQL statements as they are: unquoted
+# identifiers, possibly qualified by a schema
+TABLE_NAME = re.compile(r'([A-Za-z_][A-Za-z0-9_$]*\.)?[A-Za-z_][A-Za-z0-9_$]*')
+
 
 class ConfigurationError(Exception):
     pass
@@ -16,9 +40,55 @@ class ConfigurationError(Exception):
 class Config:
     conn_uri: str
     table_name: str
-    input_file: str
+    input_file: Union[str, List[str]]  # paths, globs or directories
     use_uvloop: Optional[bool]
     log_level: str
+    reader_mode: str = 'chunk'
+    chunk_size: int = 4 * 1024 * 1024
+    num_writers: int = 1
+    shared_snapshot: bool = False
+    num_processes: int = 1
+    batch_target_rows: int = 50000
+    batch_target_bytes: int = 8 * 1024 * 1024
+    batch_max_linger: float = 0.1
+    max_inflight_bytes: int = 128 * 1024 * 1024
+    batch_format: str = 'rows'
+    column_types: Dict[str, str] = field(default_factory=dict)
+    on_conversion_error: str = OnError.skip_and_warn.value
+    infer_types: bool = False
+    infer_sample_rows: int = 1000
+    infer_sample_ranges: int = 1
+    schema_file: Optional[str] = None
+    passthrough: bool = False
+    passthrough_verify: bool = True
+    checkpoint: Optional[str] = None
+    checkpoint_table: str = 'csvtopg_checkpoints'
+    checkpoint_file: Optional[str] = None
+    resume: bool = False
+    metrics_sample_interval: float = 1.
+    metrics_interval: Optional[float] = None
+    metrics_prometheus_file: Optional[str] = None
+    max_concurrent_files: int = 4
+    table_per_file: bool = False
+    compression: str = 'auto'
+    decompression_threads: int = 4
+    input_source: str = 'auto'
+    input_format: str = 'auto'
+    read_threads: int = 4  # row groups of Parquet and Arrow files
+    load_strategy: str = 'direct'
+    key_columns: List[str] = field(default_factory=list)
+    max_parallel_index_builds: int = 4
+    keep_unlogged: bool = False  # the table swapped in by load_strategy swap
+    on_conflict: Optional[str] = None
+    update_columns: List[str] = field(default_factory=list)
+    columns: Dict[str, ColumnSpec] = field(default_factory=dict)
+    filter: Optional[str] = None  # e.g. 'country == "SG" and amount > 0'
+    dead_letter: Optional[str] = None
+    dead_letter_file: Optional[str] = None
+    dead_letter_table: str = 'csvtopg_dead_letters'
+    # [first, end) data rows to load, found with the index of the input
+    # file written by `csvtopg index`
+    row_range: Optional[List[int]] = None
 
     @property
     def configuration_issues(self) -> List[str]:
@@ -31,13 +101,262 @@ class Config:
             issues.append('Missing database connection string.')
         if not self.input_file:
             issues.append('Missing input CSV file path.')
+        for option in ('table_name', 'checkpoint_table', 'dead_letter_table'):
+            if not TABLE_NAME.fullmatch(getattr(self, option) or ''):
+                issues.append(
+                    f'Invalid {option}: "{getattr(self, option)}", table '
+                    f'names are letters, digits, _ and $, optionally '
+                    f'prefixed by a schema name and a dot.')
         if self.log_level is not None and self.log_level not in {
                 'CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG', 'NOTSET'}:
             issues.append(f'Unknown log level: "{self.log_level}".')
-        if not os.path.exists(self.input_file):
-            issues.append(f'"{self.input_file}" does not exist.')
+        if self.reader_mode not in READER_MODES:
+            issues.append(f'Unknown reader mode: "{self.reader_mode}".')
+        if self.chunk_size <= 0:
+            issues.append('The chunk size must be positive.')
+        if self.num_writers < 1:
+            issues.append('At least one writer is required.')
+        if self.num_processes < 1:
+            issues.append('At least one process is required.')
+        if self.num_processes > 1 and \
+                self.reader_mode not in BLOCK_READER_MODES:
+            issues.append('Multiple processes require the chunk or mmap '
+                          'reader.')
+        if self.num_processes > 1 and self.shared_snapshot:
+            issues.append('Snapshots cannot be shared between processes.')
+        if self.batch_target_rows < 1 or self.batch_target_bytes < 1:
+            issues.append('Batch size targets must be positive.')
+        if self.batch_max_linger <= 0:
+            issues.append('The maximum batch linger time must be positive.')
+        if self.max_inflight_bytes < 1:
+            issues.append('The in-flight bytes budget must be positive.')
+        if self.batch_format not in BATCH_FORMATS:
+            issues.append(f'Unknown batch format: "{self.batch_format}".')
+        for col, type_name in self.column_types.items():
+            if type_name not in PG_TYPES:
+                issues.append(
+                    f'Unknown type "{type_name}" for column "{col}". '
+                    f'Supported types: {", ".join(PG_TYPES)}.')
+        if self.on_conversion_error not in {e.value for e in OnError}:
+            issues.append(
+                f'Unknown conversion error policy: '
+                f'"{self.on_conversion_error}".')
+        if self.infer_sample_rows < 1 or self.infer_sample_ranges < 1:
+            issues.append('Type inference needs at least one sample row.')
+        if self.passthrough and self.reader_mode != 'chunk':
+            issues.append('Passthrough mode requires the chunk reader.')
+        if self.passthrough and self.columns:
+            issues.append('Columns cannot be projected in passthrough mode.')
+        for name, spec in self.columns.items():
+            issues.extend(f'Column "{name}": {issue}.'
+                          for issue in spec.issues)
+        if self.filter is not None:
+            try:
+                parse_filter(self.filter)
+            except FilterError as e:
+                issues.append(f'{e}.')
+            if self.passthrough:
+                issues.append('Rows cannot be filtered in passthrough mode.')
+        if self.checkpoint not in {None, 'table', 'file'}:
+            issues.append(f'Unknown checkpoint store: "{self.checkpoint}".')
+        if self.checkpoint and (
+                self.passthrough or
+                self.reader_mode not in BLOCK_READER_MODES):
+            issues.append('Checkpoints require the chunk or mmap reader and '
+                          'are not available in passthrough mode.')
+        if self.dead_letter is not None:
+            if self.dead_letter not in DEAD_LETTER_STORES:
+                issues.append(
+                    f'Unknown dead letter store: "{self.dead_letter}".')
+            if self.passthrough:
+                issues.append('Rows cannot be rejected to dead letters in '
+                              'passthrough mode.')
+        if self.row_range is not None:
+            issues.extend(self.row_range_issues)
+        if self.checkpoint == 'file' and self.shared_snapshot:
+            issues.append('Checkpoints in a file cannot be used with a '
+                          'shared snapshot, use checkpoint = "table".')
+        if self.load_strategy not in LOAD_STRATEGIES:
+            issues.append(f'Unknown load strategy: "{self.load_strategy}".')
+        elif self.load_strategy != 'direct' and self.checkpoint:
+            issues.append('Checkpoints require load_strategy = "direct", '
+                          'staging tables are not crash-safe.')
+        if self.keep_unlogged and self.load_strategy != 'swap':
+            issues.append('Only the table swapped in by load_strategy = '
+                          '"swap" can be kept unlogged.')
+        if self.on_conflict is not None:
+            issues.extend(self.conflict_issues)
+        elif self.update_columns:
+            issues.append('Update columns require on_conflict = "update".')
+        if self.max_parallel_index_builds < 1:
+            issues.append('At least one index must be built at a time.')
+        if self.resume and not self.checkpoint:
+            issues.append('Resuming requires checkpoints.')
+        if self.metrics_sample_interval <= 0 or (
+                self.metrics_interval is not None and
+                self.metrics_interval <= 0):
+            issues.append('Metrics intervals must be positive.')
+        if self.max_concurrent_files < 1:
+            issues.append('At least one file must be loaded at a time.')
+        for spec in self.input_specs:
+            if not expand_input_spec(spec):
+                issues.append(f'"{spec}" does not exist or matches no file.')
+        input_files = self.input_files
+        if len(input_files) > 1 and self.num_processes > 1:
+            issues.append('Multiple processes cannot be used with multiple '
+                          'input files.')
+        if len(input_files) > 1 and self.checkpoint_file:
+            issues.append('A single checkpoint file cannot be used with '
+                          'multiple input files.')
+        if self.compression not in {'auto', 'none', *COMPRESSIONS}:
+            issues.append(f'Unknown compression: "{self.compression}".')
+        elif self.num_processes > 1 or self.checkpoint:
+            for path in input_files:
+                if not is_stream(path) and \
+                        resolve_compression(path, self.compression):
+                    issues.append(
+                        f'"{path}" is compressed: multiple processes and '
+                        f'checkpoints require uncompressed input.')
+        if self.decompression_threads < 1:
+            issues.append('At least one decompression thread is required.')
+        if self.input_source not in INPUT_SOURCES:
+            issues.append(f'Unknown input source: "{self.input_source}".')
+        if self.reader_mode == 'mmap':
+            for path in input_files:
+                if is_stream(path) or \
+                        resolve_compression(path, self.compression):
+                    issues.append(
+                        f'"{path}" cannot be memory-mapped: the mmap reader '
+                        f'requires uncompressed regular files.')
+        if self.input_format not in INPUT_FORMATS:
+            issues.append(f'Unknown input format: "{self.input_format}".')
+        else:
+            issues.extend(self.format_issues)
+        if self.read_threads < 1:
+            issues.append('At least one read thread is required.')
+        streams = [path for path in input_files if is_stream(path)]
+        if streams and len(input_files) > 1:
+            issues.append('The standard input and pipes cannot be loaded '
+                          'with other input files.')
+        elif streams:
+            issues.extend(self.stream_issues)
+        return issues
+
+    @property
+    def conflict_issues(self) -> List[str]:
+        issues = []
+        if self.on_conflict not in CONFLICT_POLICIES:
+            issues.append(
+                f'Unknown conflict policy: "{self.on_conflict}".')
+        if not self.key_columns:
+            issues.append('A conflict policy requires key columns.')
+        if self.load_strategy == 'swap':
+            issues.append('Conflicts cannot occur when swapping tables, use '
+                          'the append or direct load strategy.')
+        if self.passthrough:
+            issues.append('Passthrough mode cannot merge rows on conflicts.')
+        if self.shared_snapshot and self.num_writers > 1:
+            # a writer upserting a key inserted by another one waits for the
+            # transaction of the other, which waits for all the writers
+            issues.append('Writers sharing a snapshot cannot merge rows on '
+                          'conflicts, they would wait for each other: use a '
+                          'single writer or no shared snapshot.')
+        if self.update_columns and self.on_conflict != 'update':
+            issues.append('Update columns require on_conflict = "update".')
+        if set(self.update_columns) & set(self.key_columns):
+            issues.append('Key columns cannot be updated.')
+        return issues
+
+    @property
+    def row_range_issues(self) -> List[str]:
+        issues = []
+        if len(self.row_range) != 2 or self.row_range[0] < 0 or \
+                self.row_range[1] <= self.row_range[0]:
+            issues.append('The row range must be [first, end] with '
+                          '0 <= first < end.')
+        if self.num_processes > 1 or self.checkpoint or self.passthrough or \
+                self.reader_mode not in BLOCK_READER_MODES:
+            issues.append('A row range requires the chunk or mmap reader, in '
+                          'a single process, without checkpoints or '
+                          'passthrough.')
+        input_files = self.input_files
+        if len(input_files) > 1:
+            issues.append('A row range cannot be loaded from multiple input '
+                          'files.')
+        for path in input_files:
+            if is_stream(path) or resolve_compression(path, self.compression):
+                issues.append(f'"{path}" cannot be indexed: a row range '
+                              f'requires an uncompressed regular file.')
+        return issues
+
+    @property
+    def stream_issues(self) -> List[str]:
+        """Options that require reading the input more than once, or at
+        arbitrary positions, which streams do not allow"""
+        issues = []
+        if self.num_processes > 1:
+            issues.append('Streams cannot be split between processes.')
+        if self.checkpoint:
+            issues.append('Streams cannot be checkpointed.')
+        if self.infer_types and not (
+                self.schema_file and os.path.exists(self.schema_file)):
+            issues.append('Types cannot be inferred from a stream, configure '
+                          'column_types or an existing schema_file.')
+        if self.passthrough and self.passthrough_verify:
+            issues.append('Streams cannot be verified before passthrough, '
+                          'set passthrough_verify = false.')
+        if self.dead_letter == 'file' and not self.dead_letter_file:
+            issues.append('The rows rejected from a stream require a '
+                          'dead_letter_file.')
+        return issues
+
+    @property
+    def format_issues(self) -> List[str]:
+        """Options that require CSV input, and requirements of the other
+        input formats"""
+        issues = []
+        formats = {path: resolve_format(path, self.input_format)
+                   for path in self.input_files}
+        if set(formats.values()) <= {'csv'}:
+            return issues
+        if self.passthrough:
+            issues.append('Passthrough mode requires CSV input.')
+        if self.reader_mode not in BLOCK_READER_MODES:
+            issues.append('NDJSON, Parquet and Arrow inputs require the chunk '
+                          'or mmap reader.')
+        if self.num_processes > 1:
+            issues.append('Only CSV input can be split between processes.')
+        if self.row_range is not None:
+            issues.append('A row range requires CSV input.')
+        columnar = [path for path, input_format in formats.items()
+                    if input_format in COLUMNAR_FORMATS]
+        if columnar and self.checkpoint:
+            issues.append('Parquet and Arrow inputs cannot be checkpointed.')
+        if columnar and importlib.util.find_spec('pyarrow') is None:
+            issues.append('Reading Parquet and Arrow files requires the '
+                          'pyarrow package.')
+        for path in columnar:
+            if is_stream(path) or resolve_compression(path, self.compression):
+                issues.append(f'"{path}" cannot be read as {formats[path]}: '
+                              f'Parquet and Arrow inputs must be '
+                              f'uncompressed regular files.')
         return issues
 
+    @property
+    def input_specs(self) -> List[str]:
+        if isinstance(self.input_file, str):
+            return [self.input_file]
+        return list(self.input_file)
+
+    @property
+    def input_files(self) -> List[str]:
+        """Paths of the input files matched by input_file, in order and
+        without duplicates"""
+        paths = {}
+        for spec in self.input_specs:
+            paths.update(dict.fromkeys(expand_input_spec(spec)))
+        return list(paths)
+
     @classmethod
     def from_dict(cls, conf_dict: Dict) -> 'Config':
         """Create a Config instance from the specification in a dictionary. All
@@ -64,9 +383,22 @@ class Config:
         return asdict(self)
 
 
+def expand_input_spec(spec: str) -> List[str]:
+    """Return the files designated by a path, a glob pattern or a directory,
+    whose files are all loaded except hidden and sidecar files"""
+    if spec == STDIN:
+        return [spec]
+    spec = os.path.expanduser(spec)
+    if os.path.isdir(spec):
+        return sorted(
+            path for path in glob.glob(os.path.join(spec, '*'))
+            if os.path.isfile(path) and not path.endswith(SIDECAR_SUFFIXES))
+    if glob.has_magic(spec):
+        return sorted(path for path in glob.glob(spec, recursive=True)
+                      if os.path.isfile(path))
+    return [spec] if os.path.exists(spec) else []
+
+
 def check_uvloop():
-    try:
-        import uvloop  # noqa: F401
-        return True
-    except ImportError:
-        return False
+    """Tell if uvloop is installed, without importing it"""
+    return importlib.util.find_spec('uvloop') is not None
@@ -0,0 +1,173 @@
+"""Dead letters: the rows that cannot be loaded, rejected by the readers (wrong
+number of fields), by the type conversion or by the server (constraint
+violations, values out of range...), written with their position and the
+reason of their rejection to a CSV file or to a table, instead of warnings.
+
+A rejection is located by the line where the record ends, counted from
+`byte_offset`: 0 when the input is read by a single reader, in which case the
+header is line 1, or the start of the byte range read by a worker process.
+The line of the rows rejected by the server is not known, their byte_offset
+is the start of the block of the input they were parsed from, if known. The
+rows of Parquet and Arrow files are located by their number, from 1, instead
+of a line.
+
+Rejections are buffered and written by a background task once
+`buffer_rows` of them are pending, so that millions of bad rows do not slow
+the load down like warnings.
+
+The loads of a process append whole buffers to their files one at a time, so
+that the files loaded concurrently by a scheduler may share a dead letter
+file. Worker processes write to a file of their own, named after the start of
+their byte range, which the parent process appends to the dead letter file
+once they are done.
+"""
+
+import asyncio
+import csv
+import io
+import os
+import shutil
+import threading
+from typing import List, NamedTuple, Optional, Sequence
+
+import asyncpg
+
+DEAD_LETTER_STORES = ('file', 'table')
+DEAD_LETTER_COLUMNS = ['input_file', 'byte_offset', 'line', 'reason',
+                       'record']
+APPEND_LOCK = threading.Lock()  # of the dead letter files of the process
+
+
+class Rejection(NamedTuple):
+    input_file: str
+    byte_offset: Optional[int]
+    line: Optional[int]
+    reason: str
+    record: str  # fields of the row, formatted as a CSV record
+
+
+def format_record(row: Sequence) -> str:
+    """
+    >>> format_record(['1', 'a,b', None])
+    '1,"a,b",'
+    """
+    output = io.StringIO()
+    csv.writer(output, lineterminator='').writerow(row)
+    return output.getvalue()
+
+
+def worker_file(path: str, byte_range_start: int) -> str:
+    """Dead letter file of the worker process loading the byte range starting
+    at `byte_range_start`
+    >>> worker_file('data.csv.rejected', 1024)
+    'data.csv-1024.rejected'
+    """
+    root, ext = os.path.splitext(path)
+    return f'{root}-{byte_range_start}{ext}'
+
+
+class DeadLetters:
+    """Buffer of the rejected rows, written by `write` in subclasses"""
+
+    def __init__(self, input_file: str, buffer_rows: int = 1000):
+        self.input_file = os.path.abspath(input_file)
+        self.buffer_rows = buffer_rows
+        self.pending: List[Rejection] = []
+        self.flushing: Optional[asyncio.Future] = None
+        self.num_rejected = 0
+
+    async def prepare(self, conn: asyncpg.Connection):
+        pass
+
+    def reject(self, byte_offset: Optional[int], line: Optional[int],
+               reason: str, row: Sequence):
+        self.pending.append(Rejection(self.input_file, byte_offset, line,
+                                      reason, format_record(row)))
+        self.num_rejected += 1
+        if len(self.pending) >= self.buffer_rows and (
+                self.flushing is None or self.flushing.done()):
+            self.flushing = asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        while self.pending:
+            rejections, self.pending = self.pending, []
+            await self.write(rejections)
+
+    async def close(self):
+        """Write the pending rejections, raising the errors of the
+        background writes"""
+        if self.flushing is not None:
+            await self.flushing
+        await self.flush()
+
+    async def write(self, rejections: List[Rejection]):
+        raise NotImplementedError
+
+
+class FileDeadLetters(DeadLetters):
+    """Rejections appended as CSV records to a local file, which gets a
+    header when created"""
+
+    def __init__(self, path: str, input_file: str,
+                 byte_range_start: Optional[int] = None, **kwargs):
+        super().__init__(input_file, **kwargs)
+        self.path = path
+        if byte_range_start is not None:
+            self.path = worker_file(path, byte_range_start)
+
+    def append(self, rejections: List[Rejection]):
+        with APPEND_LOCK, open(self.path, 'a', newline='') as f:
+            writer = csv.writer(f)
+            if f.tell() == 0:
+                writer.writerow(DEAD_LETTER_COLUMNS)
+            writer.writerows(rejections)
+
+    def merge_worker_files(self, byte_range_starts: Sequence[int]):
+        """Append the rejections of the worker processes, in the order of
+        their byte ranges, and remove their files"""
+        for start in byte_range_starts:
+            path = worker_file(self.path, start)
+            if not os.path.exists(path):
+                continue
+            with APPEND_LOCK, open(path, newline='') as rejections, \
+                    open(self.path, 'a', newline='') as f:
+                rejections.readline()  # header
+                if f.tell() == 0:
+                    csv.writer(f).writerow(DEAD_LETTER_COLUMNS)
+                shutil.copyfileobj(rejections, f)
+            os.remove(path)
+
+    async def write(self, rejections: List[Rejection]):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.append, rejections)
+
+
+class TableDeadLetters(DeadLetters):
+    """Rejections copied to a side table of the target database, with the
+    name of the table they were loaded to"""
+
+    def __init__(self, dead_letter_table: str, table_name: str,
+                 input_file: str, connect, **kwargs):
+        super().__init__(input_file, **kwargs)
+        self.dead_letter_table = dead_letter_table
+        self.table_name = table_name
+        self.connect = connect  # async context manager of a connection
+
+    async def prepare(self, conn: asyncpg.Connection):
+        await conn.execute(f'''
+            CREATE TABLE IF NOT EXISTS {self.dead_letter_table} (
+                table_name text NOT NULL,
+                input_file text NOT NULL,
+                byte_offset bigint,
+                line bigint,
+                reason text NOT NULL,
+                record text NOT NULL,
+                rejected_at timestamp with time zone DEFAULT now())''')
+
+    async def write(self, rejections: List[Rejection]):
+        async with self.connect() as conn:
+            await conn.copy_records_to_table(
+                self.dead_letter_table,
+                records=[(self.table_name,) + rejection
+                         for rejection in rejections],
+                columns=['table_name', *DEAD_LETTER_COLUMNS])
@@ -0,0 +1,207 @@
+"""Row filters: boolean expressions over the columns of the target table, e.g.
+
+    country == "SG" and amount > 0 and day >= "2020-01-01"
+
+written in a small subset of the Python syntax: comparisons (including `in`
+lists), `and`, `or`, `not`, arithmetic, column names and literals. The
+expression is parsed once, checked against the columns, and compiled to a
+list comprehension filtering a whole batch of converted rows in one call.
+
+The string literals compared to a typed column are converted like its fields,
+so that dates, numerics or uuids compare as such. The empty fields of typed
+columns are None: the rows where an ordering comparison or arithmetic involves
+one are excluded, as in SQL, but `!=` is true for them, and `amount is None`
+selects them.
+
+The fields of the columns without a type are strings: comparing them with, or
+adding them to, a number or a boolean would exclude every row, so such
+filters are rejected until the column is given a type in column_types.
+"""
+
+import ast
+import sys
+from typing import Callable, Dict, List, Optional, Sequence
+
+from csvtopg.pgtypes import PG_TYPES
+
+ALLOWED_NODES = (
+    ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not,
+    ast.USub, ast.UAdd, ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div,
+    ast.Mod, ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt,
+    ast.GtE, ast.In, ast.NotIn, ast.Is, ast.IsNot, ast.Name, ast.Load,
+    ast.Tuple, ast.List, ast.Set)
+
+if sys.version_info < (3, 8):
+    LITERAL_NODES = (ast.Num, ast.Str, ast.NameConstant)
+else:
+    LITERAL_NODES = (ast.Constant,)
+
+Rows = List[Sequence]
+
+
+class FilterError(Exception):
+    pass
+
+
+def literal_value(node: ast.AST) -> object:
+    """Value of a literal node, Num and Str nodes before Python 3.8"""
+    if sys.version_info < (3, 8):
+        if isinstance(node, ast.Num):
+            return node.n
+        if isinstance(node, ast.Str):
+            return node.s
+    return node.value
+
+
+def field(index: int) -> ast.Subscript:
+    """row[index], whose index is wrapped in an Index node before Python 3.9"""
+    index_node = ast.Constant(value=index)
+    if sys.version_info < (3, 9):
+        index_node = ast.Index(value=index_node)
+    return ast.Subscript(value=ast.Name(id='row', ctx=ast.Load()),
+                         slice=index_node, ctx=ast.Load())
+
+
+def row_arguments() -> ast.arguments:
+    """The `row` argument of a lambda, without posonlyargs before Python 3.8"""
+    arguments = dict(args=[ast.arg(arg='row', annotation=None)],
+                     vararg=None, kwonlyargs=[], kw_defaults=[], kwarg=None,
+                     defaults=[])
+    if sys.version_info >= (3, 8):
+        arguments['posonlyargs'] = []
+    return ast.arguments(**arguments)
+
+
+def parse_filter(expression: str) -> ast.Expression:
+    """Parse a filter expression, rejecting what it may not contain
+    >>> parse_filter('__import__("os")')
+    Traceback (most recent call last):
+    ...
+    csvtopg.filtering.FilterError: Filters cannot contain Call expressions
+    """
+    try:
+        tree = ast.parse(expression.strip(), '<filter>', 'eval')
+    except SyntaxError as e:
+        raise FilterError(f'Invalid filter expression: {e.msg}') from e
+    for node in ast.walk(tree):
+        if not isinstance(node, ALLOWED_NODES + LITERAL_NODES):
+            raise FilterError(f'Filters cannot contain '
+                              f'{type(node).__name__} expressions')
+    return tree
+
+
+class ColumnReferences(ast.NodeTransformer):
+    """Replace the column names by fields of `row`, and the literals compared
+    to typed columns by converted values, named `_c0`, `_c1`..."""
+
+    def __init__(self, columns: List[str], column_types: Dict[str, str]):
+        self.indexes = {col: i for i, col in enumerate(columns)}
+        self.column_types = column_types
+        self.constants: Dict[str, object] = {}
+
+    def visit_Name(self, node: ast.Name) -> ast.AST:
+        if node.id not in self.indexes:
+            raise FilterError(f'Unknown column in filter: "{node.id}"')
+        return ast.copy_location(field(self.indexes[node.id]), node)
+
+    def is_text_column(self, node: ast.AST) -> bool:
+        return (isinstance(node, ast.Name) and node.id in self.indexes
+                and self.column_types.get(node.id, 'text') == 'text')
+
+    def check_text_operands(self, column: ast.Name, operands: List[ast.AST],
+                            operation: str):
+        """Reject the numbers and booleans used with a text column"""
+        for operand in operands:
+            for node in ast.walk(operand):
+                if not isinstance(node, LITERAL_NODES):
+                    continue
+                value = literal_value(node)
+                if value is not None and not isinstance(value, str):
+                    raise FilterError(
+                        f'Column "{column.id}" is text and cannot be '
+                        f'{operation} {value!r}: set its type in '
+                        f'column_types')
+
+    def visit_BinOp(self, node: ast.BinOp) -> ast.AST:
+        for column, other in ((node.left, node.right),
+                              (node.right, node.left)):
+            if self.is_text_column(column):
+                self.check_text_operands(column, [other], 'combined with')
+        self.generic_visit(node)
+        return node
+
+    def visit_UnaryOp(self, node: ast.UnaryOp) -> ast.AST:
+        if (isinstance(node.op, (ast.USub, ast.UAdd))
+                and self.is_text_column(node.operand)):
+            raise FilterError(f'Column "{node.operand.id}" is text and cannot '
+                              f'be negated: set its type in column_types')
+        self.generic_visit(node)
+        return node
+
+    def visit_Compare(self, node: ast.Compare) -> ast.AST:
+        operands = [node.left, *node.comparators]
+        for operand in operands:
+            if self.is_text_column(operand):
+                self.check_text_operands(operand, operands, 'compared with')
+        convert = None
+        for operand in operands:
+            if isinstance(operand, ast.Name) and operand.id in self.indexes:
+                convert = PG_TYPES[self.column_types.get(operand.id,
+                                                         'text')][1]
+                break
+        self.generic_visit(node)
+        if convert is not None:
+            node.left = self.convert_literals(node.left, convert)
+            node.comparators = [self.convert_literals(operand, convert)
+                                for operand in node.comparators]
+        return node
+
+    def convert_literals(self, node: ast.AST, convert: Callable) -> ast.AST:
+        if isinstance(node, (ast.Tuple, ast.List, ast.Set)):
+            node.elts = [self.convert_literals(elt, convert)
+                         for elt in node.elts]
+        elif (isinstance(node, LITERAL_NODES)
+                and isinstance(literal_value(node), str)):
+            try:
+                value = convert(literal_value(node))
+            except (ValueError, ArithmeticError) as e:
+                raise FilterError(f'Invalid literal in filter: {e}') from e
+            name = f'_c{len(self.constants)}'
+            self.constants[name] = value
+            return ast.copy_location(ast.Name(id=name, ctx=ast.Load()), node)
+        return node
+
+
+class RowFilter:
+    """Keep the rows of a batch for which the expression is true"""
+
+    def __init__(self, expression: str, columns: List[str],
+                 column_types: Optional[Dict[str, str]] = None):
+        references = ColumnReferences(columns, column_types or {})
+        condition = references.visit(parse_filter(expression)).body
+        row = ast.Name(id='row', ctx=ast.Store())
+        batch = ast.Expression(body=ast.ListComp(
+            elt=ast.Name(id='row', ctx=ast.Load()), generators=[
+                ast.comprehension(target=row, iter=ast.Name(
+                    id='rows', ctx=ast.Load()), ifs=[condition],
+                    is_async=0)]))
+        predicate = ast.Expression(body=ast.Lambda(
+            args=row_arguments(), body=condition))
+        self.namespace = {'__builtins__': {}, **references.constants}
+        self.batch_code = compile(ast.fix_missing_locations(batch),
+                                  '<filter>', 'eval')
+        self.predicate = eval(compile(ast.fix_missing_locations(predicate),
+                                      '<filter>', 'eval'), self.namespace)
+
+    def __call__(self, rows: Rows) -> Rows:
+        try:
+            return eval(self.batch_code, self.namespace, {'rows': rows})
+        except (TypeError, ArithmeticError):
+            # NULL fields in comparisons or arithmetic, row by row
+            return [row for row in rows if self.matches(row)]
+
+    def matches(self, row: Sequence) -> bool:
+        try:
+            return bool(self.predicate(row))
+        except (TypeError, ArithmeticError):
+            return False
@@ -0,0 +1,421 @@
+"""Input formats other than CSV: NDJSON (one JSON object per line), and
+Parquet and Arrow IPC files, read with the optional pyarrow package. Their
+readers iterate like csvtopg.aiocsv.AsyncChunkReader, yielding a list of
+rows per block, so that their rows are converted, filtered, batched and
+copied like the rows of CSV files.
+
+NDJSON is read by blocks from the same sources as CSV (files, compressed
+files and streams), and all the complete lines of a block are parsed by a
+single json.loads call. The fields of the rows are the values of the keys of
+the first object, formatted as text like the fields of CSV records, and
+converted to the column types likewise. Missing keys and nulls are None.
+
+Parquet and Arrow files are read by row group (record batch for Arrow), only
+their projected columns, in worker threads, several row groups at a time.
+Their columns keep the types of the file: the values of the columns whose
+type is the type of their table column are passed as they are to the binary
+COPY, the other columns are read as text and converted like CSV fields.
+"""
+
+import asyncio
+import datetime
+import importlib
+import json
+import threading
+import time
+import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+from pathlib import PurePath
+from typing import Deque, Dict, List, Optional, Sequence, Set, Tuple
+
+from csvtopg.aiocsv import AsyncChunkReader, AsyncReaderError, OnError, \
+    reject_record
+from csvtopg.sources import is_stream
+
+INPUT_FORMATS = ('auto', 'csv', 'ndjson', 'parquet', 'arrow')
+COLUMNAR_FORMATS = ('parquet', 'arrow')
+FORMAT_MAGIC_BYTES = {b'PAR1': 'parquet', b'ARROW1': 'arrow'}
+UTC = datetime.timezone.utc
+NoneType = type(None)
+# text of the JSON values that str does not format like CSV fields
+JSON_TEXT = {bool: {True: 'true', False: 'false'}.__getitem__,
+             dict: json.dumps, list: json.dumps}
+FORMAT_SUFFIXES = {
+    '.ndjson': 'ndjson', '.jsonl': 'ndjson', '.parquet': 'parquet',
+    '.pq': 'parquet', '.arrow': 'arrow', '.feather': 'arrow'}
+
+
+class InputFormatError(Exception):
+    pass
+
+
+def detect_format(path: str) -> str:
+    """Return the format of a file according to its first bytes or, for
+    NDJSON and compressed files, to its extensions
+
+    >>> detect_format('/dev/null/events.ndjson.gz')
+    'ndjson'
+    """
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(6)
+    except OSError:
+        head = b''
+    for magic, input_format in FORMAT_MAGIC_BYTES.items():
+        if head.startswith(magic):
+            return input_format
+    for suffix in reversed(PurePath(path).suffixes):
+        if suffix.lower() in FORMAT_SUFFIXES:
+            return FORMAT_SUFFIXES[suffix.lower()]
+    return 'csv'
+
+
+def resolve_format(path: str, input_format: str = 'auto') -> str:
+    """Interpret the input_format configuration option for a file. Streams
+    are CSV unless configured otherwise."""
+    if input_format != 'auto':
+        return input_format
+    if is_stream(path):
+        return 'csv'
+    return detect_format(path)
+
+
+def import_pyarrow():
+    try:
+        pyarrow = importlib.import_module('pyarrow')
+        importlib.import_module('pyarrow.ipc')
+        importlib.import_module('pyarrow.parquet')
+    except ImportError as e:
+        raise InputFormatError('Reading Parquet and Arrow files requires the '
+                               'pyarrow package') from e
+    return pyarrow
+
+
+def text_values(values: List) -> List[Optional[str]]:
+    """Format the JSON values of a column as text, None for null. Columns
+    of a single type are formatted by a single function.
+
+    >>> text_values(['a', 1, 2.5, True, None, [1]])
+    ['a', '1', '2.5', 'true', None, '[1]']
+    """
+    types = set(map(type, values))
+    nullable = NoneType in types
+    types.discard(NoneType)
+    if types <= {str}:
+        return values
+    if len(types) == 1:
+        format_value = JSON_TEXT.get(types.pop(), str)
+        if not nullable:
+            return list(map(format_value, values))
+    else:
+        def format_value(value):
+            return JSON_TEXT.get(type(value), str)(value)
+    return [None if value is None else format_value(value)
+            for value in values]
+
+
+def object_keys(line: str) -> List[str]:
+    """Return the keys of the JSON object of a line"""
+    try:
+        first = json.loads(line)
+    except ValueError as e:
+        raise AsyncReaderError(f'Invalid first JSON object: {e}') from e
+    if not isinstance(first, dict):
+        raise AsyncReaderError('The first line is not a JSON object')
+    return list(first)
+
+
+class NdjsonReader(AsyncChunkReader):
+    """Chunk reader of NDJSON input. Its header is the keys of the first
+    object, which `keys` must be set to before iterating. Empty lines are
+    handled by the on_empty_line policy, and the lines that are not JSON
+    objects by the on_wrong_length policy."""
+
+    def __init__(self, source, **kwargs):
+        super().__init__(source, **kwargs)
+        self.keys: Optional[List[str]] = None
+
+    async def read_header(self) -> List[str]:
+        """Return the keys of the first object, which is kept for the
+        following iterations, like all the data read so far"""
+        while True:
+            lines = self.tail.split(self.newline)
+            for line in lines[:-1]:
+                if line.strip():
+                    return self.parse_keys(line)
+            chunk = await self.read_chunk()
+            if not chunk:
+                if lines[-1].strip():
+                    return self.parse_keys(lines[-1])
+                raise AsyncReaderError('Missing header')
+            self.tail += chunk
+
+    def parse_keys(self, line: bytes) -> List[str]:
+        self.keys = object_keys(str(line, self.encoding, self.errors))
+        return self.keys
+
+    def last_record_end(self, data: bytes) -> int:
+        return data.rfind(self.newline) + 1
+
+    def parse(self, data: bytes) -> List[Tuple[Optional[str], ...]]:
+        lines = str(data, self.encoding, self.errors).split('\n')
+        if not lines[-1]:
+            lines.pop()
+        first_line_num = self.line_num
+        self.line_num += len(lines)
+        try:
+            objects = json.loads('[' + ','.join(lines) + ']')
+            # e.g. not if a line holds several objects separated by commas
+            valid = len(objects) == len(lines) and \
+                all(type(obj) is dict for obj in objects)
+        except ValueError:  # empty lines, or invalid JSON
+            valid = False
+        if valid:
+            line_nums = range(first_line_num + 1, self.line_num + 1)
+        else:
+            objects, line_nums = self.parse_lines_checked(lines,
+                                                          first_line_num)
+        if self.reject is not None:
+            self.last_block_lines = list(line_nums)
+        return list(zip(*(text_values(list(map(dict.get, objects,
+                                               repeat(key))))
+                          for key in self.keys)))
+
+    def parse_lines_checked(self, lines: List[str], first_line_num: int) \
+            -> Tuple[List[Dict], List[int]]:
+        """Parse the lines one by one to apply the error policies, and return
+        the objects and their line numbers"""
+        objects = []
+        line_nums = []
+        for line_num, line in enumerate(lines, first_line_num + 1):
+            if not line.strip():
+                if self.on_empty_line is OnError.exception:
+                    raise AsyncReaderError(f'Empty line at line {line_num}')
+                elif self.on_empty_line is OnError.skip_and_warn:
+                    warnings.warn(f'Empty line at line {line_num}')
+                continue
+            try:
+                obj = json.loads(line)
+            except ValueError as e:
+                obj = e
+            if not isinstance(obj, dict):
+                reason = obj if isinstance(obj, ValueError) else \
+                    'not an object'
+                reject_record(self, self.on_wrong_length,
+                              f'Invalid JSON object at line {line_num}: '
+                              f'{reason}', line_num, [line])
+                continue
+            objects.append(obj)
+            line_nums.append(line_num)
+        return objects, line_nums
+
+    def row_lines(self) -> List[int]:
+        """Return the line numbers of the rows of the last parsed block. Only
+        available with a reject callback."""
+        return self.last_block_lines[self.num_skipped:]
+
+
+def arrow_type_name(pyarrow, arrow_type) -> str:
+    """Return the column type of csvtopg.pgtypes matching an Arrow type"""
+    types = pyarrow.types
+    if types.is_dictionary(arrow_type):
+        return arrow_type_name(pyarrow, arrow_type.value_type)
+    if types.is_boolean(arrow_type):
+        return 'bool'
+    if types.is_integer(arrow_type):
+        if arrow_type.bit_width < 32 or types.is_int32(arrow_type):
+            return 'int'
+        return 'numeric' if types.is_uint64(arrow_type) else 'bigint'
+    if types.is_floating(arrow_type):
+        return 'float8'
+    if types.is_decimal(arrow_type):
+        return 'numeric'
+    if types.is_date(arrow_type):
+        return 'date'
+    if types.is_timestamp(arrow_type):
+        return 'timestamptz'
+    if types.is_nested(arrow_type):
+        return 'json'
+    return 'text'
+
+
+def is_string(pyarrow, arrow_type) -> bool:
+    types = pyarrow.types
+    if types.is_dictionary(arrow_type):
+        return is_string(pyarrow, arrow_type.value_type)
+    return types.is_string(arrow_type) or types.is_large_string(arrow_type) \
+        or getattr(types, 'is_string_view', bool)(arrow_type)
+
+
+def column_values(pyarrow, column, as_text: bool) -> List:
+    """Return the values of an Arrow column, as text if `as_text` is set or
+    if they have no column type, and otherwise as the Python values that
+    asyncpg encodes for the column type"""
+    if pyarrow.types.is_dictionary(column.type):
+        column = column.cast(column.type.value_type)  # faster decoded
+    type_name = arrow_type_name(pyarrow, column.type)
+    if type_name == 'json':
+        return [None if value is None else json.dumps(value, default=str)
+                for value in column.to_pylist()]
+    if (as_text or type_name == 'text') and \
+            not is_string(pyarrow, column.type):
+        try:
+            column = column.cast(pyarrow.string())
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowNotImplementedError):
+            return [None if value is None else str(value)
+                    for value in column.to_pylist()]
+    elif type_name == 'timestamptz':
+        # in UTC, like CSV timestamps without a time zone. Naive datetimes
+        # made aware in Python are faster than aware datetimes from Arrow,
+        # and PostgreSQL timestamps have a resolution of 1 microsecond.
+        column = column.cast(pyarrow.timestamp(
+            'us' if column.type.unit == 'ns' else column.type.unit),
+            safe=False)
+        return [None if value is None else value.replace(tzinfo=UTC)
+                for value in column.to_pylist()]
+    return column.to_pylist()
+
+
+class ColumnarFile:
+    """Parquet or Arrow IPC file, opened once per thread reading it, whose
+    readers are closed with the file like those of
+    csvtopg.compression.CompressedFile"""
+    seekable = True
+
+    def __init__(self, path: str, input_format: str, num_threads: int = 1):
+        self.path = path
+        self.input_format = input_format
+        self.num_threads = num_threads
+        self.pyarrow = import_pyarrow()
+        self.local = threading.local()
+        self.readers: List[ColumnarReader] = []
+        self.schema = self.file.schema_arrow \
+            if input_format == 'parquet' else self.file.schema
+        if input_format == 'parquet':
+            self.num_parts = self.file.metadata.num_row_groups
+            self.num_rows = self.file.metadata.num_rows
+        else:
+            self.num_parts = self.file.num_record_batches
+            self.num_rows = sum(self.file.get_batch(i).num_rows
+                                for i in range(self.num_parts))
+
+    @property
+    def file(self):
+        """Reader of the file in the current thread"""
+        if not hasattr(self.local, 'file'):
+            source = self.pyarrow.memory_map(self.path)
+            if self.input_format == 'parquet':
+                self.local.file = self.pyarrow.parquet.ParquetFile(source)
+            else:
+                self.local.file = self.pyarrow.ipc.open_file(source)
+        return self.local.file
+
+    @property
+    def header(self) -> List[str]:
+        return list(self.schema.names)
+
+    @property
+    def column_types(self) -> Dict[str, str]:
+        """Column type of each column of the file"""
+        return {field.name: arrow_type_name(self.pyarrow, field.type)
+                for field in self.schema}
+
+    def read_part(self, i: int, columns: Sequence[str],
+                  text_columns: Set[str]) -> Tuple[List[Tuple], int]:
+        """Return the rows of a row group or record batch and its size"""
+        if self.input_format == 'parquet':
+            table = self.file.read_row_group(i, columns=list(columns),
+                                             use_threads=False)
+        else:
+            table = self.file.get_batch(i).select(list(columns))
+        values = [column_values(self.pyarrow, table.column(name),
+                                name in text_columns) for name in columns]
+        return list(zip(*values)), table.nbytes
+
+    def reader(self, columns: Sequence[str], text_columns: Set[str]) \
+            -> 'ColumnarReader':
+        reader = ColumnarReader(self, columns, text_columns)
+        self.readers.append(reader)
+        return reader
+
+    async def __aenter__(self) -> 'ColumnarFile':
+        return self
+
+    async def __aexit__(self, *exc_info):
+        for reader in self.readers:
+            reader.close()
+        self.readers = []
+
+
+class ColumnarReader:
+    """Read the rows of the row groups of a columnar file, with `columns`
+    only and `text_columns` among them as text, num_threads row groups at a
+    time. Iterating yields the rows of each row group, in order."""
+
+    def __init__(self, file: ColumnarFile, columns: Sequence[str],
+                 text_columns: Set[str]):
+        self.file = file
+        self.columns = columns
+        self.text_columns = text_columns
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.pending: Deque[asyncio.Future] = deque()
+        self.next_part = 0
+        self.nbytes = 0  # in memory, of the last row group
+        self.line_num = 0  # number of the last row read, from 1
+        self.num_rows = 0  # of the last row group
+        # csvtopg.columns.Projection of the rows, applied as soon as read
+        self.projection = None
+        self.io_time = 0.  # cumulative, in seconds
+        self.parse_time = 0.
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> List[Tuple]:
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.file.num_threads)
+        loop = asyncio.get_event_loop()
+        while True:
+            while self.next_part < self.file.num_parts and \
+                    len(self.pending) < self.file.num_threads:
+                self.pending.append(loop.run_in_executor(
+                    self.executor, self.file.read_part, self.next_part,
+                    self.columns, self.text_columns))
+                self.next_part += 1
+            if not self.pending:
+                self.close()
+                raise StopAsyncIteration
+            t0 = time.perf_counter()
+            rows, self.nbytes = await self.pending.popleft()
+            self.io_time += time.perf_counter() - t0
+            self.line_num += len(rows)
+            self.num_rows = len(rows)
+            if rows and self.projection is not None:
+                t0 = time.perf_counter()
+                rows = self.projection(rows)
+                self.parse_time += time.perf_counter() - t0
+            if rows:
+                return rows
+
+    def row_lines(self) -> List[int]:
+        """Return the numbers of the rows of the last row group"""
+        return list(range(self.line_num - self.num_rows + 1,
+                          self.line_num + 1))
+
+    def close(self):
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+
+def ndjson_header(f) -> List[str]:
+    """Return the keys of the first object of an NDJSON file opened in
+    binary mode, blocking"""
+    for line in f:
+        if line.strip():
+            return object_keys(line.decode(errors='replace'))
+    raise AsyncReaderError('Missing header')
@@ -0,0 +1,274 @@
+"""Sidecar index of the records of a CSV file, written next to it by
+`csvtopg index` (<input>.index). It holds the byte offset of every
+`stride`-th record, the number of records and of fields, and a fingerprint
+of the file, so that loads can split the file, count the rows to load and
+seek to a row without scanning the file again.
+
+The index is built in one pass over large blocks of the file. Record
+boundaries are the newlines preceded by an even number of quotes since the
+header: with NumPy (the optional numpy package), the newlines and the quotes
+of each block are located in two vectorized passes, otherwise the newlines
+are searched one by one with bytes methods, which is several times slower.
+
+The fingerprint is the size of the file and a hash of samples of its
+content, which survive copies of the file, unlike modification times. As
+edits between the samples keep the fingerprint, an index also only matches
+its file if each of its offsets follows a newline. This is a heuristic, which
+catches most edits moving records without reading the file: a newline inside
+a quoted field also passes it, and loads of a file edited this way may still
+split or seek in the middle of records. Records are counted like the lines of
+a CSV file, including those that the readers skip, such as empty lines.
+
+Sidecar format: a JSON line with the metadata, followed by the offsets as
+little-endian 64-bit integers.
+"""
+
+import array
+import bisect
+import csv
+import hashlib
+import importlib
+import io
+import json
+import logging
+import os
+import sys
+from dataclasses import asdict, dataclass, field
+from typing import List, Optional, Tuple
+
+from csvtopg.ranges import SCAN_BLOCK_SIZE, find_first_record_end
+
+log = logging.getLogger(__name__)
+
+INDEX_SUFFIX = '.index'
+INDEX_VERSION = 1
+DEFAULT_STRIDE = 10000
+INDEX_BLOCK_SIZE = 8 * 1024 * 1024
+NUM_FINGERPRINT_SAMPLES = 16
+FINGERPRINT_SAMPLE_SIZE = 4096
+
+
+class RecordIndexError(Exception):
+    pass
+
+
+def index_path(path: str) -> str:
+    return path + INDEX_SUFFIX
+
+
+def fingerprint(path: str) -> str:
+    """Hash of the size and of evenly spaced samples of the file"""
+    size = os.path.getsize(path)
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    with open(path, 'rb') as f:
+        for i in range(NUM_FINGERPRINT_SAMPLES):
+            digest.update(os.pread(
+                f.fileno(), FINGERPRINT_SAMPLE_SIZE,
+                max(size - FINGERPRINT_SAMPLE_SIZE, 0) * i //
+                (NUM_FINGERPRINT_SAMPLES - 1)))
+    return digest.hexdigest()
+
+
+def follow_newlines(path: str, offsets: List[int],
+                    newline: bytes = b'\n') -> bool:
+    """Whether each of the offsets of the file is the start of a line, not
+    necessarily of a record"""
+    with open(path, 'rb') as f:
+        return all(os.pread(f.fileno(), 1, offset - 1) == newline
+                   for offset in offsets if offset > 0)
+
+
+def import_numpy():
+    try:
+        return importlib.import_module('numpy')
+    except ImportError:
+        return None
+
+
+def record_ends(block: bytes, odd_quotes: bool, quote: bytes = b'"',
+                newline: bytes = b'\n') -> Tuple[List[int], bool]:
+    """Return the positions after the record separators of a block and
+    whether the number of quotes is odd at its end. `odd_quotes` tells if it
+    is odd at the start of the block.
+
+    >>> record_ends(b'a,"b\\nc"\\nd\\ne,"f', False)
+    ([8, 10], True)
+    """
+    ends = []
+    position = 0
+    num_quotes = odd_quotes
+    while True:
+        next_position = block.find(newline, position)
+        if next_position == -1:
+            break
+        num_quotes += block.count(quote, position, next_position)
+        if num_quotes % 2 == 0:
+            ends.append(next_position + 1)
+        position = next_position + 1
+    num_quotes += block.count(quote, position)
+    return ends, bool(num_quotes % 2)
+
+
+def record_ends_vectorized(numpy, block: bytes, odd_quotes: bool,
+                           quote: bytes = b'"', newline: bytes = b'\n'):
+    """record_ends with NumPy: the number of quotes before each newline is
+    found by a binary search of its position in the positions of the
+    quotes"""
+    data = numpy.frombuffer(block, dtype=numpy.uint8)
+    newlines = numpy.flatnonzero(data == ord(newline))
+    quotes = numpy.flatnonzero(data == ord(quote))
+    if len(quotes):
+        num_quotes = numpy.searchsorted(quotes, newlines) + odd_quotes
+        newlines = newlines[num_quotes % 2 == 0]
+    elif odd_quotes:
+        newlines = newlines[:0]
+    return newlines + 1, bool((len(quotes) + odd_quotes) % 2)
+
+
+@dataclass
+class RecordIndex:
+    size: int
+    fingerprint: str
+    header_end: int  # start of the first record after the header
+    num_records: int  # not counting the header
+    num_fields: int  # of the header
+    stride: int
+    # start of the records 0, stride, 2 * stride... (record 0 follows the
+    # header)
+    offsets: List[int] = field(default_factory=list, repr=False)
+
+    def matches(self, path: str) -> bool:
+        return os.path.getsize(path) == self.size and \
+            fingerprint(path) == self.fingerprint and \
+            follow_newlines(path, self.offsets)
+
+    def save(self, path: str):
+        metadata = asdict(self)
+        del metadata['offsets']
+        offsets = array.array('q', self.offsets)
+        if sys.byteorder == 'big':
+            offsets.byteswap()
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(json.dumps({'version': INDEX_VERSION, **metadata})
+                    .encode() + b'\n')
+            f.write(offsets.tobytes())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'RecordIndex':
+        with open(path, 'rb') as f:
+            try:
+                metadata = json.loads(f.readline())
+            except ValueError as e:
+                raise RecordIndexError(f'{path} is not an index') from e
+            if metadata.pop('version', None) != INDEX_VERSION:
+                raise RecordIndexError(f'Unsupported index version in {path}')
+            offsets = array.array('q')
+            offsets.frombytes(f.read())
+        if sys.byteorder == 'big':
+            offsets.byteswap()
+        return cls(**metadata, offsets=offsets.tolist())
+
+    def record_start(self, record: int) -> int:
+        """Return the offset of an indexed record, a multiple of the stride,
+        or the size of the file after the last record"""
+        if record >= self.num_records:
+            return self.size
+        return self.offsets[record // self.stride]
+
+    def records_between(self, start: int, end: int) -> Optional[int]:
+        """Return the number of records from byte `start` to byte `end`, if
+        both are indexed record boundaries"""
+        numbers = {offset: i * self.stride
+                   for i, offset in enumerate(self.offsets)}
+        numbers[self.size] = self.num_records
+        if start in numbers and end in numbers:
+            return numbers[end] - numbers[start]
+        return None
+
+    def split(self, num_ranges: int) -> List[Tuple[int, int]]:
+        """Split the records in at most `num_ranges` byte ranges of similar
+        sizes, starting on indexed records"""
+        boundaries = [self.header_end]
+        for i in range(1, num_ranges):
+            target = self.header_end + \
+                (self.size - self.header_end) * i // num_ranges
+            j = bisect.bisect_left(self.offsets, target)
+            if j < len(self.offsets) and self.offsets[j] > boundaries[-1]:
+                boundaries.append(self.offsets[j])
+        boundaries.append(self.size)
+        return [(a, b) for a, b in zip(boundaries, boundaries[1:]) if a < b]
+
+    def seek(self, first: int, end: Optional[int] = None) -> 'RowWindow':
+        """Return the window of the records `first` to `end` (excluded)"""
+        if end is None or end > self.num_records:
+            end = self.num_records
+        first = min(first, end)
+        indexed = first - first % self.stride
+        last = -(-end // self.stride) * self.stride  # rounded up
+        return RowWindow(self.record_start(indexed),
+                         self.record_start(last) if last < self.num_records
+                         else None, first - indexed, end - first)
+
+
+class RowWindow:
+    """Records read from the byte range `start` to `end`, without the first
+    `skip` ones and after the `num_rows` next ones"""
+
+    def __init__(self, start: int, end: Optional[int], skip: int,
+                 num_rows: int):
+        self.start = start
+        self.end = end
+        self.skip = skip
+        self.num_rows = num_rows
+
+    def __call__(self, rows: List) -> List:
+        if self.skip:
+            skipped = min(self.skip, len(rows))
+            rows = rows[skipped:]
+            self.skip -= skipped
+        rows = rows[:self.num_rows]
+        self.num_rows -= len(rows)
+        return rows
+
+
+def build_index(path: str, stride: int = DEFAULT_STRIDE,
+                block_size: int = INDEX_BLOCK_SIZE) -> RecordIndex:
+    """Scan a file and return the index of its records"""
+    numpy = import_numpy()
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        head = f.read(SCAN_BLOCK_SIZE)
+        header_end = find_first_record_end(head) or len(head)
+        header = next(csv.reader(io.StringIO(
+            head[:header_end].decode(errors='replace'), newline='')), [])
+        offsets = [header_end]
+        num_records = 0
+        last_end = header_end
+        odd_quotes = False
+        block_start = header_end
+        f.seek(header_end)
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            if numpy is None:
+                ends, odd_quotes = record_ends(block, odd_quotes)
+            else:
+                ends, odd_quotes = record_ends_vectorized(numpy, block,
+                                                          odd_quotes)
+            if len(ends):
+                # the end of the record n is the start of the record n + 1
+                first = -(num_records + 1) % stride
+                offsets.extend(block_start + int(end)
+                               for end in ends[first::stride])
+                num_records += len(ends)
+                last_end = block_start + int(ends[-1])
+            block_start += len(block)
+    if size > last_end:
+        num_records += 1  # last record, without a final newline
+    elif offsets[-1] >= size:
+        offsets.pop()  # start of a record after the last one
+    return RecordIndex(size, fingerprint(path), header_end, num_records,
+                       len(header), stride, offsets)
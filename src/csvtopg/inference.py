@@ -0,0 +1,137 @@
+"""Inference of the narrowest column types from a sample of the CSV rows"""
+
+import os
+import re
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import aiofile
+import toml
+
+from csvtopg.aiocsv import AsyncChunkReader, OnError
+from csvtopg.compression import CompressedFile
+from csvtopg.pgtypes import FALSE_STRINGS, PG_TYPES, TRUE_STRINGS
+from csvtopg.ranges import find_first_record_end
+
+SAMPLE_BLOCK_SIZE = 1024 * 1024
+BOOL_STRINGS = (TRUE_STRINGS | FALSE_STRINGS) - {'0', '1'}
+# Leading zeros suggest an identifier rather than a number
+INTEGER = r'[+-]?(0|[1-9]\d*)'
+NUMBER = r'[+-]?((0|[1-9]\d*)(\.\d*)?|\.\d+)'
+
+# Candidate types, from the narrowest to the widest, with a regular expression
+# that the fields must match before trying to convert them
+CANDIDATES: List[Tuple[str, Callable]] = [
+    ('bool', re.compile(r'[A-Za-z]{1,5}').fullmatch),
+    ('int', re.compile(INTEGER).fullmatch),
+    ('bigint', re.compile(INTEGER).fullmatch),
+    ('numeric', re.compile(NUMBER).fullmatch),
+    ('float8', re.compile(
+        NUMBER + r'([eE][+-]?\d+)?|[+-]?(inf|infinity|nan)',
+        re.IGNORECASE).fullmatch),
+    ('date', re.compile(r'\d{4}-\d{2}-\d{2}').fullmatch),
+    ('timestamptz', re.compile(
+        r'\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?'
+        r'(Z|[+-]\d{2}:\d{2})?').fullmatch),
+    ('uuid', re.compile(
+        r'[0-9a-fA-F]{8}-?([0-9a-fA-F]{4}-?){3}[0-9a-fA-F]{12}').fullmatch),
+    ('json', re.compile(r'\s*[\[{].*', re.DOTALL).fullmatch),
+]
+
+
+def is_convertible(values: Sequence[str], type_name: str) -> bool:
+    if type_name == 'bool':
+        return {v.lower() for v in values} <= BOOL_STRINGS
+    convert = PG_TYPES[type_name][1]
+    try:
+        for _ in map(convert, values):
+            pass
+    except (ValueError, ArithmeticError):
+        return False
+    return True
+
+
+def infer_column_type(values: Sequence[str]) -> str:
+    """Return the narrowest supported type that all non-empty values convert
+    to. Each candidate type is tested on the whole column at once.
+
+    >>> infer_column_type(['1', '', '-2'])
+    'int'
+    >>> infer_column_type(['1', '2.5', '3e9'])
+    'float8'
+    """
+    values = [v for v in values if v]
+    if not values:
+        return 'text'
+    for type_name, match in CANDIDATES:
+        if all(map(match, values)) and is_convertible(values, type_name):
+            return type_name
+    return 'text'
+
+
+def infer_column_types(header: List[str],
+                       rows: List[Sequence[str]]) -> Dict[str, str]:
+    """Return the inferred type of each column that is not text"""
+    columns = list(zip(*rows)) if rows else [() for _ in header]
+    types = {col: infer_column_type(values)
+             for col, values in zip(header, columns)}
+    return {col: t for col, t in types.items() if t != 'text'}
+
+
+async def sample_rows(path: str, header: List[str], num_rows: int,
+                      num_ranges: int = 1,
+                      compression: Optional[str] = None) -> List[List[str]]:
+    """Read about `num_rows` rows of the file in `num_ranges` samples evenly
+    spread across it. The samples following the first one start after the
+    first newline of their range, which may be quoted: rows of the wrong
+    length are ignored, so the samples are a best effort. Compressed files
+    are sampled from their beginning only.
+    """
+    if compression is not None:
+        async with CompressedFile(path, compression) as f:
+            reader = AsyncChunkReader(
+                f, on_empty_line=OnError.skip_silently,
+                on_wrong_length=OnError.skip_silently,
+                chunk_size=SAMPLE_BLOCK_SIZE)
+            await reader.read_header()
+            reader.expected_num_fields = len(header)
+            rows = []
+            async for batch in reader:
+                rows.extend(batch)
+                if len(rows) >= num_rows:
+                    break
+            return rows[:num_rows]
+    size = os.path.getsize(path)
+    rows_per_range = max(num_rows // num_ranges, 1)
+    rows = []
+    async with aiofile.AIOFile(path, 'rb') as f:
+        for i in range(num_ranges):
+            offset = size * i // num_ranges
+            head = await f.read(SAMPLE_BLOCK_SIZE, offset)
+            if i == 0:
+                start = find_first_record_end(head)
+            else:
+                start = head.find(b'\n') + 1
+            if start == 0:
+                continue
+            reader = AsyncChunkReader(
+                f, on_empty_line=OnError.skip_silently,
+                on_wrong_length=OnError.skip_silently,
+                chunk_size=SAMPLE_BLOCK_SIZE, offset=offset + start)
+            reader.expected_num_fields = len(header)
+            sample = []
+            async for batch in reader:
+                sample.extend(batch)
+                if len(sample) >= rows_per_range:
+                    break
+            rows.extend(sample[:rows_per_range])
+    return rows
+
+
+def save_column_types(path: str, column_types: Dict[str, str]):
+    with open(path, 'w') as f:
+        toml.dump({'column_types': column_types}, f)
+
+
+def load_column_types(path: str) -> Dict[str, str]:
+    with open(path) as f:
+        return toml.load(f).get('column_types', {})
@@ -0,0 +1,164 @@
+import json
+import logging
+import math
+import os
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+LATENCY_PERCENTILES = (50, 90, 99)
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """Nearest-rank percentile of a non-empty sorted list
+    >>> percentile([1., 2., 3., 4.], 50)
+    2.0
+    """
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+@dataclass
+class Metrics:
+    wall_clock_computation_time: Optional[float] = None  # in seconds
+    num_rows_read: int = 0
+    num_rows_total: int = 0  # to read, if the input is indexed, or 0
+    num_rows_written: int = 0
+    num_rows_filtered: int = 0  # read but excluded by the filter
+    num_rows_rejected: int = 0  # written to the dead letters
+    # rows merged on key columns, by upserts or appends of a staging table
+    num_rows_inserted: int = 0
+    num_rows_updated: int = 0
+    # number of batches by power of 2 upper bound of their size
+    batch_rows_histogram: Dict[int, int] = field(default_factory=dict)
+    batch_bytes_histogram: Dict[int, int] = field(default_factory=dict)
+    # cumulative time spent in each stage, in seconds. The queue wait and copy
+    # times are summed over the writers, and may exceed the wall clock time.
+    file_io_time: float = 0.
+    parse_time: float = 0.
+    conversion_time: float = 0.
+    queue_put_wait_time: float = 0.  # reader blocked on a full queue
+    queue_get_wait_time: float = 0.  # writers blocked on an empty queue
+    copy_time: float = 0.
+    num_bytes_copied: int = 0  # size in the input file of the copied rows
+    # largest size in the input of the batches queued or being copied at once
+    peak_inflight_bytes: int = 0
+    # (seconds since the start of the load, number of batches in the queue)
+    queue_depth_samples: List[Tuple[float, int]] = field(
+        default_factory=list, repr=False)
+    batch_copy_latencies: List[float] = field(default_factory=list,
+                                              repr=False)
+    # e.g. {'p50': 0.12, 'p90': 0.2, 'p99': 0.31, 'max': 0.4}, in seconds
+    batch_copy_latency_percentiles: Dict[str, float] = field(
+        default_factory=dict)
+
+    def merge(self, other: 'Metrics'):
+        """Add the counts of another Metrics object to this one. The queue
+        depth samples of separate pipelines are not merged, and the peak of
+        bytes in flight is the largest of their peaks."""
+        self.num_rows_read += other.num_rows_read
+        self.num_rows_total += other.num_rows_total
+        self.num_rows_written += other.num_rows_written
+        self.num_rows_filtered += other.num_rows_filtered
+        self.num_rows_rejected += other.num_rows_rejected
+        self.num_rows_inserted += other.num_rows_inserted
+        self.num_rows_updated += other.num_rows_updated
+        for mine, theirs in (
+                (self.batch_rows_histogram, other.batch_rows_histogram),
+                (self.batch_bytes_histogram, other.batch_bytes_histogram)):
+            for bucket, count in theirs.items():
+                mine[bucket] = mine.get(bucket, 0) + count
+        self.file_io_time += other.file_io_time
+        self.parse_time += other.parse_time
+        self.conversion_time += other.conversion_time
+        self.queue_put_wait_time += other.queue_put_wait_time
+        self.queue_get_wait_time += other.queue_get_wait_time
+        self.copy_time += other.copy_time
+        self.num_bytes_copied += other.num_bytes_copied
+        self.peak_inflight_bytes = max(self.peak_inflight_bytes,
+                                       other.peak_inflight_bytes)
+        self.batch_copy_latencies.extend(other.batch_copy_latencies)
+        self.summarize()
+
+    def summarize(self):
+        """Compute the latency percentiles of the batches copied so far"""
+        latencies = sorted(self.batch_copy_latencies)
+        if latencies:
+            self.batch_copy_latency_percentiles = {
+                **{f'p{p}': percentile(latencies, p)
+                   for p in LATENCY_PERCENTILES},
+                'max': latencies[-1]}
+
+    def snapshot(self) -> Dict:
+        """Return the scalar metrics, the last queue depth and the latency
+        percentiles in a flat dictionary"""
+        self.summarize()
+        values = {
+            name: getattr(self, name) for name in (
+                'num_rows_read', 'num_rows_total', 'num_rows_written',
+                'num_rows_filtered', 'num_rows_rejected', 'num_rows_inserted',
+                'num_rows_updated',
+                'num_bytes_copied',
+                'peak_inflight_bytes',
+                'file_io_time', 'parse_time', 'conversion_time',
+                'queue_put_wait_time', 'queue_get_wait_time', 'copy_time')}
+        if self.queue_depth_samples:
+            values['queue_depth'] = self.queue_depth_samples[-1][1]
+        for name, value in self.batch_copy_latency_percentiles.items():
+            values[f'batch_copy_latency_{name}'] = value
+        return values
+
+
+def log_metrics(metrics: Metrics, **labels):
+    """Log the current metrics as a single JSON line"""
+    log.info('metrics %s', json.dumps({**labels, **metrics.snapshot()}))
+
+
+def format_prometheus(metrics: Metrics, **labels) -> str:
+    """Format the current metrics in the Prometheus text exposition format"""
+    label_string = ','.join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+    lines = []
+    declared = set()
+
+    def add(name: str, kind: str, value, extra_label: str = ''):
+        all_labels = ','.join(filter(None, (label_string, extra_label)))
+        if name not in declared:
+            declared.add(name)
+            lines.append(f'# TYPE {name} {kind}')
+        lines.append(f'{name}{{{all_labels}}} {value}')
+
+    snapshot = metrics.snapshot()
+    add('csvtopg_rows_read_total', 'counter', snapshot['num_rows_read'])
+    add('csvtopg_rows_to_read', 'gauge', snapshot['num_rows_total'])
+    add('csvtopg_rows_written_total', 'counter', snapshot['num_rows_written'])
+    add('csvtopg_rows_filtered_total', 'counter',
+        snapshot['num_rows_filtered'])
+    add('csvtopg_rows_rejected_total', 'counter',
+        snapshot['num_rows_rejected'])
+    add('csvtopg_rows_inserted_total', 'counter',
+        snapshot['num_rows_inserted'])
+    add('csvtopg_rows_updated_total', 'counter', snapshot['num_rows_updated'])
+    add('csvtopg_bytes_copied_total', 'counter', snapshot['num_bytes_copied'])
+    add('csvtopg_peak_inflight_bytes', 'gauge',
+        snapshot['peak_inflight_bytes'])
+    for stage in ('file_io', 'parse', 'conversion', 'queue_put_wait',
+                  'queue_get_wait', 'copy'):
+        add(f'csvtopg_{stage}_seconds_total', 'counter',
+            snapshot[f'{stage}_time'])
+    if 'queue_depth' in snapshot:
+        add('csvtopg_queue_depth', 'gauge', snapshot['queue_depth'])
+    for name, value in metrics.batch_copy_latency_percentiles.items():
+        quantile = 1 if name == 'max' else int(name[1:]) / 100
+        add('csvtopg_batch_copy_latency_seconds', 'gauge', value,
+            f'quantile="{quantile}"')
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus_textfile(path: str, metrics: Metrics, **labels):
+    """Replace the file atomically, as expected by the textfile collector of
+    the Prometheus node exporter"""
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(format_prometheus(metrics, **labels))
+    os.replace(tmp_path, path)
@@ -0,0 +1,155 @@
+"""Packed batches: the rows of a batch encoded once, by the reader, into a
+single buffer in the text format of COPY, with an array of the offsets of
+the rows, instead of a list of lists of Python objects per batch.
+
+A packed batch of N rows of K fields holds one bytes object and 8 * (N + 1)
+bytes of offsets, where a list of lists holds N + 1 lists and N * K strings
+or values, each with its own header, which the garbage collector has to
+track while the batch is in flight. The writers stream the buffer as is to
+COPY FROM STDIN, without encoding the rows, and the server parses the text
+of the typed values.
+
+Rows are packed by C-level joins when all their fields are strings without
+backslashes, tabs or line breaks; the other columns are escaped and
+formatted one by one. Rows are accessed, e.g. to reject them, through
+RowView objects that decode their fields on demand.
+"""
+
+import collections.abc
+import re
+from array import array
+from itertools import accumulate
+from typing import Iterator, List, Optional, Sequence, Union
+
+import asyncpg
+
+NULL = '\\N'
+SPECIAL_CHARACTERS = ('\\', '\t', '\n', '\r')
+ESCAPE_PATTERN = re.compile(r'\\(.)')
+ESCAPED_CHARACTERS = {'t': '\t', 'n': '\n', 'r': '\r'}
+
+
+def escape(value: str) -> str:
+    """
+    >>> print(escape('a\\tb\\\\c'))
+    a\\tb\\\\c
+    """
+    return value.replace('\\', '\\\\').replace('\t', '\\t') \
+        .replace('\n', '\\n').replace('\r', '\\r')
+
+
+def unescape(field: str) -> Optional[str]:
+    if field == NULL:
+        return None
+    if '\\' not in field:
+        return field
+    return ESCAPE_PATTERN.sub(
+        lambda match: ESCAPED_CHARACTERS.get(match[1], match[1]), field)
+
+
+def format_column(values: Sequence) -> Sequence[str]:
+    """Return the fields of a column in the COPY text format. Values other
+    than strings and None are formatted by str, which PostgreSQL parses for
+    all the types of csvtopg.pgtypes."""
+    if set(map(type, values)) == {str}:
+        text = ''.join(values)
+        if any(character in text for character in SPECIAL_CHARACTERS):
+            return list(map(escape, values))
+        return values
+    return [NULL if value is None else
+            escape(value) if isinstance(value, str) else str(value)
+            for value in values]
+
+
+class PackedRows:
+    """Rows encoded in the COPY text format in `data`. Row i is
+    data[offsets[i]:offsets[i + 1]], including its newline."""
+    __slots__ = ('data', 'offsets')
+
+    def __init__(self, data: Union[bytes, memoryview], offsets: array):
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def pack(cls, rows: Sequence[Sequence]) -> 'PackedRows':
+        try:
+            lines = list(map('\t'.join, rows))
+            text = '\n'.join(lines)
+            valid = '\\' not in text and '\r' not in text and \
+                text.count('\n') == len(lines) - 1 and \
+                text.count('\t') == sum(map(len, rows)) - len(rows)
+        except TypeError:  # fields that are not strings
+            valid = False
+        if not valid:
+            lines = list(map('\t'.join, zip(*map(
+                format_column, zip(*rows)))))
+        encoded = list(map(str.encode, lines))
+        offsets = array('q', [0])
+        offsets.extend(accumulate(len(line) + 1 for line in encoded))
+        return cls(b'\n'.join(encoded) + b'\n' if encoded else b'', offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: Union[int, slice]) \
+            -> Union['RowView', 'PackedRows']:
+        if isinstance(index, slice):
+            start, end, _ = index.indices(len(self))
+            end = max(start, end)
+            base = self.offsets[start]
+            return PackedRows(
+                memoryview(self.data)[base:self.offsets[end]],
+                array('q', (offset - base
+                            for offset in self.offsets[start:end + 1])))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('row index out of range')
+        return RowView(self, index)
+
+    def __iter__(self) -> Iterator['RowView']:
+        return map(RowView, [self] * len(self), range(len(self)))
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the buffer and of the offsets"""
+        return len(self.data) + self.offsets.itemsize * len(self.offsets)
+
+    def fields(self, index: int) -> List[Optional[str]]:
+        """Decode the fields of a row, None for NULL"""
+        line = bytes(self.data[self.offsets[index]:
+                               self.offsets[index + 1] - 1])
+        return [unescape(field) for field in line.decode().split('\t')]
+
+
+class RowView(collections.abc.Sequence):
+    """Fields of a row of a packed batch, as text or None, decoded when
+    accessed"""
+    __slots__ = ('rows', 'index')
+
+    def __init__(self, rows: PackedRows, index: int):
+        self.rows = rows
+        self.index = index
+
+    def __getitem__(self, i):
+        return self.rows.fields(self.index)[i]
+
+    def __len__(self) -> int:
+        return len(self.rows.fields(self.index))
+
+    def __iter__(self):
+        return iter(self.rows.fields(self.index))
+
+    def __repr__(self) -> str:
+        return f'RowView({self.rows.fields(self.index)!r})'
+
+
+async def copy_rows_to_table(conn: asyncpg.Connection, table_name: str,
+                             rows: Union[List, PackedRows]) -> str:
+    """Copy a list of rows in the binary format, encoded by asyncpg, or
+    packed rows as they are, and return the status of COPY"""
+    if isinstance(rows, PackedRows):
+        # a memoryview, since asyncpg takes bytes for a path
+        return await conn.copy_to_table(
+            table_name, source=memoryview(rows.data), format='text')
+    return await conn.copy_records_to_table(table_name, records=rows)
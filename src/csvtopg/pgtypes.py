@@ -0,0 +1,144 @@
+"""Conversion of CSV fields to the Python values of typed PostgreSQL columns.
+The converted values are encoded by asyncpg in the binary COPY format, so that
+the server does not have to parse text.
+"""
+
+import datetime
+import decimal
+import json
+import uuid
+import warnings
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from csvtopg.aiocsv import OnError
+
+INT4_MIN, INT4_MAX = -2 ** 31, 2 ** 31 - 1
+INT8_MIN, INT8_MAX = -2 ** 63, 2 ** 63 - 1
+TRUE_STRINGS = {'t', 'true', 'y', 'yes', 'on', '1'}
+FALSE_STRINGS = {'f', 'false', 'n', 'no', 'off', '0'}
+
+
+class ConversionError(Exception):
+    pass
+
+
+def to_int4(value: str) -> int:
+    result = int(value)
+    if not INT4_MIN <= result <= INT4_MAX:
+        raise ValueError(f'{value} is out of range for type integer')
+    return result
+
+
+def to_int8(value: str) -> int:
+    result = int(value)
+    if not INT8_MIN <= result <= INT8_MAX:
+        raise ValueError(f'{value} is out of range for type bigint')
+    return result
+
+
+def to_bool(value: str) -> bool:
+    lower = value.strip().lower()
+    if lower in TRUE_STRINGS:
+        return True
+    if lower in FALSE_STRINGS:
+        return False
+    raise ValueError(f'invalid input syntax for type boolean: "{value}"')
+
+
+def to_timestamptz(value: str) -> datetime.datetime:
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    result = datetime.datetime.fromisoformat(value)
+    if result.tzinfo is None:
+        result = result.replace(tzinfo=datetime.timezone.utc)
+    return result
+
+
+def to_json(value: str) -> str:
+    json.loads(value)
+    return value
+
+
+# Supported column types: SQL type name and conversion function of the fields
+PG_TYPES: Dict[str, Tuple[str, Optional[Callable]]] = {
+    'text': ('text', None),
+    'int': ('integer', to_int4),
+    'bigint': ('bigint', to_int8),
+    'numeric': ('numeric', decimal.Decimal),
+    'float8': ('double precision', float),
+    'bool': ('boolean', to_bool),
+    'date': ('date', datetime.date.fromisoformat),
+    'timestamptz': ('timestamp with time zone', to_timestamptz),
+    'uuid': ('uuid', uuid.UUID),
+    'json': ('json', to_json),
+}
+
+
+def sql_type(type_name: str) -> str:
+    return PG_TYPES[type_name][0]
+
+
+class RowConverter:
+    """Convert batches of rows column by column. Empty fields become NULL.
+    Rows with unparseable fields are handled according to `on_error`:
+    OnError.leroy_jenkins sets the field to NULL and keeps the row. The rows
+    that are skipped are passed with their index in the batch and the reason
+    to the `reject` callback instead of a warning, if it is set.
+    """
+
+    def __init__(self, header: List[str], column_types: Dict[str, str],
+                 on_error: OnError = OnError.skip_and_warn):
+        unknown = set(column_types) - set(header)
+        if unknown:
+            raise ConversionError(
+                f'Typed columns missing from the header: {sorted(unknown)}')
+        self.header = header
+        self.on_error = on_error
+        self.converters: List[Optional[Callable]] = [
+            PG_TYPES[column_types.get(col, 'text')][1] for col in header]
+        self.reject: Optional[Callable[[int, str, Sequence[str]], None]] = \
+            None
+
+    @property
+    def is_identity(self) -> bool:
+        return not any(self.converters)
+
+    def __call__(self, rows: List[Sequence[str]]) -> List[Sequence]:
+        if not rows or self.is_identity:
+            return rows
+        columns = list(zip(*rows))
+        bad_rows: Dict[int, str] = {}  # index: reason
+        for i, convert in enumerate(self.converters):
+            if convert is None:
+                continue
+            try:
+                columns[i] = [convert(v) if v else None for v in columns[i]]
+            except (ValueError, ArithmeticError):
+                columns[i] = self.convert_checked(i, columns[i], bad_rows)
+        converted = list(zip(*columns))
+        if bad_rows and self.on_error is not OnError.leroy_jenkins:
+            converted = [row for j, row in enumerate(converted)
+                         if j not in bad_rows]
+            if self.reject is not None:
+                for j, message in sorted(bad_rows.items()):
+                    self.reject(j, message, rows[j])
+        return converted
+
+    def convert_checked(self, i: int, column: Sequence[str],
+                        bad_rows: Dict[int, str]) -> List:
+        convert = self.converters[i]
+        result = []
+        for j, value in enumerate(column):
+            try:
+                result.append(convert(value) if value else None)
+            except (ValueError, ArithmeticError) as e:
+                message = (f'Cannot convert field "{self.header[i]}" of '
+                           f'value {value!r}: {e}')
+                if self.on_error is OnError.exception:
+                    raise ConversionError(message) from e
+                elif self.on_error is OnError.skip_and_warn and \
+                        self.reject is None:
+                    warnings.warn(message)
+                bad_rows.setdefault(j, message)
+                result.append(None)
+        return result
@@ -0,0 +1,77 @@
+"""Splitting of CSV files in byte ranges made of complete records, so that the
+ranges can be parsed independently.
+"""
+
+import os
+from typing import List, Tuple
+
+SCAN_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def find_first_record_end(data: bytes, quote: bytes = b'"',
+                          newline: bytes = b'\n') -> int:
+    """Return the position just after the first newline of `data` that is not
+    enclosed in a quoted field, or 0 if there is none. `data` must start on a
+    record boundary.
+
+    >>> find_first_record_end(b'"a\\nb",c\\nd')
+    8
+    """
+    return find_next_record_start(data, 0, 0, quote, newline)
+
+
+def find_next_record_start(data: bytes, pos: int, num_quotes: int,
+                           quote: bytes = b'"', newline: bytes = b'\n') -> int:
+    """Return the position just after the first unquoted newline found at or
+    after `pos`, or 0 if there is none. `num_quotes` is the number of quotes
+    before `data[0]` since the last record boundary, only its parity matters.
+    """
+    num_quotes += data.count(quote, 0, pos)
+    while True:
+        next_pos = data.find(newline, pos)
+        if next_pos == -1:
+            return 0
+        num_quotes += data.count(quote, pos, next_pos)
+        if num_quotes % 2 == 0:
+            return next_pos + 1
+        pos = next_pos + 1
+
+
+def split_records(path: str, num_ranges: int, start: int = 0,
+                  quote: bytes = b'"', newline: bytes = b'\n',
+                  block_size: int = SCAN_BLOCK_SIZE) -> List[Tuple[int, int]]:
+    """Split the file from byte `start` (a record boundary) to its end in at
+    most `num_ranges` contiguous byte ranges of similar sizes, each starting
+    on a record boundary. Quoted newlines are accounted for by counting the
+    quotes from `start`, so this requires a sequential scan of the file. The
+    scan is done with bytes.count and bytes.find over large blocks.
+
+    :return: list of (start, end) offsets, end excluded
+    """
+    size = os.path.getsize(path)
+    targets = [start + (size - start) * i // num_ranges
+               for i in range(1, num_ranges)]
+    boundaries = [start]
+    num_quotes = 0
+    with open(path, 'rb') as f:
+        f.seek(start)
+        block_start = start
+        while targets:
+            block = f.read(block_size)
+            if not block:
+                break
+            block_end = block_start + len(block)
+            while targets and targets[0] < block_end:
+                pos = max(targets[0], boundaries[-1]) - block_start
+                boundary = find_next_record_start(
+                    block, pos, num_quotes, quote, newline)
+                if boundary == 0:
+                    # No record boundary after the target in this block
+                    targets[0] = block_end
+                    break
+                boundaries.append(block_start + boundary)
+                targets.pop(0)
+            num_quotes += block.count(quote)
+            block_start = block_end
+    boundaries.append(size)
+    return [(a, b) for a, b in zip(boundaries, boundaries[1:]) if a < b]
@@ -0,0 +1,181 @@
+"""Load several input files concurrently, over a connection pool shared by
+all the files, in one table or in one table per file."""
+
+import asyncio
+import logging
+import os
+import re
+from dataclasses import replace
+from typing import Dict, List, Optional
+
+import asyncpg
+
+from csvtopg.application import (
+    CSVToPg, ExecutionResult, Ticker, describe_exception)
+from csvtopg.configuration import Config
+from csvtopg.metrics import Metrics, log_metrics, write_prometheus_textfile
+
+log = logging.getLogger(__name__)
+
+
+def table_name_for_file(table_name: str, path: str) -> str:
+    """Name of the table of an input file when loading one table per file
+    >>> table_name_for_file('sales', '/data/2020-01-31.part.csv')
+    'sales_2020_01_31'
+    """
+    stem = os.path.basename(path).split('.')[0]
+    suffix = re.sub(r'\W+', '_', stem).strip('_').lower()
+    return f'{table_name}_{suffix}'
+
+
+def run_load(config: Config) -> ExecutionResult:
+    """Load the input files of the configuration, with a scheduler if there
+    are several of them"""
+    input_files = config.input_files
+    if len(input_files) == 1:
+        return CSVToPg(replace(config, input_file=input_files[0])).run()
+    loop = asyncio.get_event_loop()
+    return loop.run_until_complete(LoadScheduler(config).execute())
+
+
+class LoadScheduler:
+    """Load at most max_concurrent_files input files at a time. The largest
+    files are started first, so that the files still loading at the end are
+    the smallest ones and the load does not end with a single large file
+    loading alone."""
+
+    def __init__(self, config: Config,
+                 pool: Optional[asyncpg.pool.Pool] = None):
+        self.config = config
+        # shared pool, left open, instead of a pool for the load
+        self.shared_pool = pool
+        self.tick = Ticker()
+        self.result = ExecutionResult()
+        self.running: Dict[str, CSVToPg] = {}
+        self.header: Optional[List[str]] = None
+        self.column_types: Dict[str, str] = config.column_types
+        # load that created the table shared by the files, and finishes it
+        self.table_load: Optional[CSVToPg] = None
+
+    def file_config(self, path: str) -> Config:
+        """Configuration of the load of one of the files. The scheduler
+        reports the metrics of all the files together."""
+        table_name = self.config.table_name
+        if self.config.table_per_file:
+            table_name = table_name_for_file(table_name, path)
+        return replace(self.config, input_file=path, table_name=table_name,
+                       metrics_interval=None, metrics_prometheus_file=None)
+
+    async def prepare(self, pool: asyncpg.pool.Pool, path: str):
+        """Create the checkpoint and dead letter tables and, unless loading
+        one table per file, create the target table from the header of
+        `path`"""
+        app = CSVToPg(self.file_config(path), pool=pool)
+        if app.checkpoints is not None:
+            async with app.connect() as conn:
+                await app.checkpoints.prepare(conn)
+        await app.open_dead_letters()
+        if not self.config.table_per_file:
+            await app.complete_schema()
+            await app.prepare_table()
+            self.header = app.header
+            self.column_types = app.config.column_types
+            self.table_load = app
+
+    async def load_file(self, pool: asyncpg.pool.Pool, path: str):
+        config = self.file_config(path)
+        if self.header is not None:
+            config = replace(config, infer_types=False,
+                             column_types=self.column_types)
+        app = CSVToPg(config, pool=pool)
+        self.running[path] = app
+        try:
+            if self.header is not None:
+                app.table_created = True
+                app.finishes_load = False
+                app.expected_header = self.header
+            result = await app.execute()
+        except Exception as e:  # noqa
+            self.result.errors.append(f'{path}: {describe_exception(e)}')
+            return
+        finally:
+            del self.running[path]
+        log.debug('Loaded %s: %s', path, result.metrics)
+        self.result.file_metrics[path] = result.metrics
+        self.result.metrics.merge(result.metrics)
+        self.result.errors.extend(f'{path}: {e}' for e in result.errors)
+
+    async def execute(self) -> ExecutionResult:
+        self.tick()
+        paths = sorted(self.config.input_files, key=os.path.getsize,
+                       reverse=True)
+        if self.config.table_per_file:
+            table_names = [self.file_config(path).table_name
+                           for path in paths]
+            duplicates = {name for name in table_names
+                          if table_names.count(name) > 1}
+            if duplicates:
+                self.result.errors.append(
+                    f'Several input files would be loaded in each of the '
+                    f'tables {", ".join(sorted(duplicates))}')
+                return self.result
+        num_concurrent = min(self.config.max_concurrent_files, len(paths))
+        pool_size = num_concurrent * self.config.num_writers
+        pool = self.shared_pool
+        reporter = None
+        if self.config.metrics_interval:
+            reporter = asyncio.ensure_future(self.report_metrics())
+        try:
+            if pool is None:
+                pool = await asyncpg.create_pool(self.config.conn_uri,
+                                                 min_size=pool_size,
+                                                 max_size=pool_size)
+            log.debug('Loading %d files, %d at a time, with %d connections',
+                      len(paths), num_concurrent, pool_size)
+            await self.prepare(pool, paths[0])
+
+            async def load_next_files():
+                while paths:
+                    await self.load_file(pool, paths.pop(0))
+
+            await asyncio.gather(
+                *(load_next_files() for _ in range(num_concurrent)))
+            if self.table_load is not None and not self.result.errors:
+                await self.table_load.finish_load(self.result.metrics)
+        except Exception as e:  # noqa
+            self.result.errors.append(describe_exception(e))
+        finally:
+            if reporter is not None:
+                reporter.cancel()
+            if pool is not None and pool is not self.shared_pool:
+                await pool.close()
+            self.result.metrics.wall_clock_computation_time = self.tick()
+            if self.config.metrics_interval or \
+                    self.config.metrics_prometheus_file:
+                self.report()
+        return self.result
+
+    def current_metrics(self) -> Metrics:
+        """Metrics of the files already loaded and of the running loads"""
+        metrics = Metrics()
+        metrics.merge(self.result.metrics)
+        for app in self.running.values():
+            app.update_stage_metrics()
+            metrics.merge(app.metrics)
+        return metrics
+
+    async def report_metrics(self):
+        while True:
+            await asyncio.sleep(self.config.metrics_interval)
+            self.report()
+
+    def report(self):
+        metrics = self.current_metrics()
+        metrics.wall_clock_computation_time = \
+            self.result.metrics.wall_clock_computation_time
+        labels = {'table': self.config.table_name}
+        if self.config.metrics_prometheus_file:
+            write_prometheus_textfile(self.config.metrics_prometheus_file,
+                                      metrics, **labels)
+        else:
+            log_metrics(metrics, running_files=len(self.running), **labels)
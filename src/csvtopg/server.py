@@ -0,0 +1,332 @@
+"""Long-running server of load jobs, started by `csvtopg serve`, so that
+frequent small loads do not each pay the start-up of Python, the connection
+to the database and the creation of their table.
+
+Jobs are posted over HTTP, on a Unix socket or a local TCP port, as JSON
+objects with the keys of the configuration file:
+
+    curl --unix-socket /tmp/csvtopg.sock http://localhost/jobs \\
+        -d '{"conn_uri": "postgres://...", "table_name": "events",
+             "input_file": "/data/events.csv"}'
+
+The response is sent once the job is done, with its errors and metrics.
+At most `max_jobs` jobs run at a time, the others wait for their turn. The
+connection pools of the databases stay open between jobs, and the tables
+created by the jobs are not created again by the next ones, unless a job
+fails. Input files are read by the server, from its file system.
+
+Jobs run with the rights of the server, with the credentials of its user.
+Its Unix socket is only accessible to its user. Its TCP port, which other
+users of the host can reach, only listens on loopback addresses and requires
+a shared token, sent by the requests as an `Authorization: Bearer <token>`
+header. The files that jobs read and write (input, schema, checkpoint, dead
+letter and metrics files) must be under the `root` directory of the server.
+
+Endpoints:
+
+- POST /jobs: run a load job and return its result
+- GET /health: number of running and completed jobs
+"""
+
+import asyncio
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import signal
+import stat
+from dataclasses import replace
+from typing import Dict, List, Optional, Set, Tuple
+
+import asyncpg
+
+from csvtopg.application import CSVToPg, ExecutionResult, describe_exception
+from csvtopg.configuration import Config
+from csvtopg.scheduler import LoadScheduler
+from csvtopg.sources import STDIN
+
+log = logging.getLogger(__name__)
+
+MAX_REQUEST_BYTES = 1024 * 1024
+REASONS = {200: 'OK', 400: 'Bad Request', 401: 'Unauthorized',
+           404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large'}
+
+
+class RequestError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def is_loopback(host: str) -> bool:
+    """
+    >>> [is_loopback(host) for host in ('localhost', '::1', '0.0.0.0')]
+    [True, True, False]
+    """
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+class ServedLoad(CSVToPg):
+    """Load of a single file by the server, which skips the creation of the
+    tables that it already created with the same statement"""
+
+    def __init__(self, config: Config, pool: asyncpg.pool.Pool,
+                 created_tables: Set[Tuple[str, str]]):
+        super().__init__(config, pool=pool)
+        self.created_tables = created_tables
+        self.table_key: Optional[Tuple[str, str]] = None
+
+    async def create_table(self, conn: asyncpg.Connection):
+        if self.staging is not None:
+            await super().create_table(conn)
+            return
+        self.table_key = (self.config.conn_uri, self.create_table_statement)
+        if self.table_key not in self.created_tables:
+            await super().create_table(conn)
+            self.created_tables.add(self.table_key)
+
+    async def execute(self) -> ExecutionResult:
+        try:
+            result = await super().execute()
+        except Exception as e:  # noqa
+            result = ExecutionResult(metrics=self.metrics,
+                                     errors=[describe_exception(e)])
+        if result.errors:
+            # e.g. the table was dropped since it was created
+            self.created_tables.discard(self.table_key)
+        return result
+
+
+def result_payload(job_id: int, result: ExecutionResult) -> Dict:
+    return {
+        'job': job_id,
+        'errors': result.errors,
+        'metrics': {
+            'wall_clock_computation_time':
+                result.metrics.wall_clock_computation_time,
+            **result.metrics.snapshot()},
+        'file_metrics': {path: metrics.snapshot()
+                         for path, metrics in result.file_metrics.items()}}
+
+
+class LoadServer:
+    def __init__(self, root: str, max_jobs: int = 4, pool_size: int = 8,
+                 log_level: str = 'INFO', token: Optional[str] = None):
+        self.root = os.path.realpath(root)  # of the files of the jobs
+        self.token = token  # required from the clients if set
+        self.pool_size = pool_size
+        self.log_level = log_level
+        self.slots = asyncio.Semaphore(max_jobs)
+        self.pools: Dict[str, asyncpg.pool.Pool] = {}
+        self.created_tables: Set[Tuple[str, str]] = set()
+        self.jobs: Dict[int, asyncio.Future] = {}
+        self.num_jobs = 0
+        self.num_completed = 0
+
+    async def pool(self, conn_uri: str) -> asyncpg.pool.Pool:
+        """Return the pool of a database, created by its first job and kept
+        open, with its idle connections"""
+        if conn_uri not in self.pools:
+            self.pools[conn_uri] = await asyncpg.create_pool(
+                conn_uri, min_size=1, max_size=self.pool_size,
+                max_inactive_connection_lifetime=0)
+        return self.pools[conn_uri]
+
+    def outside_root(self, paths: List[Optional[str]]) -> List[str]:
+        return [path for path in paths if path not in (None, STDIN) and
+                os.path.commonpath([self.root, os.path.realpath(
+                    os.path.expanduser(path))]) != self.root]
+
+    def check_paths(self, config: Config):
+        """Reject the jobs reading or writing files outside of the root,
+        before looking for their input files"""
+        outside = self.outside_root([
+            *config.input_specs, config.schema_file, config.checkpoint_file,
+            config.dead_letter_file, config.metrics_prometheus_file])
+        if outside:
+            raise RequestError(400, f'Jobs cannot use files outside of '
+                                    f'{self.root}: {", ".join(outside)}')
+
+    def job_config(self, payload: Dict) -> Config:
+        """Configuration of a job posted as a JSON object"""
+        if not isinstance(payload, dict):
+            raise RequestError(400, 'The job must be a JSON object')
+        try:
+            config = Config.from_dict({'use_uvloop': None,
+                                       'log_level': self.log_level,
+                                       **payload})
+        except Exception as e:  # noqa, ConfigurationError and dacite errors
+            raise RequestError(400, f'Invalid configuration: {e}') from e
+        self.check_paths(config)
+        issues = config.configuration_issues
+        outside = self.outside_root(config.input_files)  # through symlinks
+        if outside:
+            issues.append(f'Jobs cannot use files outside of {self.root}: '
+                          f'{", ".join(outside)}.')
+        if STDIN in config.input_files:
+            issues.append('The standard input of the server cannot be '
+                          'loaded.')
+        if config.num_processes > 1:
+            issues.append('Jobs run in the server process, num_processes '
+                          'must be 1.')
+        if config.num_writers > self.pool_size:
+            issues.append(f'Jobs can use at most {self.pool_size} writers, '
+                          f'the size of the connection pools.')
+        if config.shared_snapshot:
+            issues.append('Jobs cannot share a snapshot between writers, '
+                          'concurrent jobs could each wait for the '
+                          'connections of the others.')
+        if issues:
+            raise RequestError(400, 'Invalid configuration: ' +
+                               ' '.join(issues))
+        return config
+
+    async def run_job(self, config: Config) -> Dict:
+        self.num_jobs += 1
+        job_id = self.num_jobs
+        async with self.slots:
+            log.info('Job %d: loading %s into %s', job_id, config.input_file,
+                     config.table_name)
+            try:
+                pool = await self.pool(config.conn_uri)
+            except Exception as e:  # noqa
+                result = ExecutionResult(errors=[
+                    f'Cannot connect to the database: {e!r}'])
+            else:
+                input_files = config.input_files
+                if len(input_files) > 1:
+                    load = LoadScheduler(config, pool=pool).execute()
+                else:
+                    load = ServedLoad(
+                        replace(config, input_file=input_files[0]), pool,
+                        self.created_tables).execute()
+                self.jobs[job_id] = asyncio.ensure_future(load)
+                try:
+                    result = await self.jobs[job_id]
+                finally:
+                    del self.jobs[job_id]
+        self.num_completed += 1
+        log.info('Job %d: wrote %d rows in %.3f seconds%s', job_id,
+                 result.metrics.num_rows_written,
+                 result.metrics.wall_clock_computation_time or 0,
+                 ' with errors' if result.errors else '')
+        return result_payload(job_id, result)
+
+    async def respond(self, method: str, path: str, body: bytes) -> Dict:
+        if path == '/health':
+            if method != 'GET':
+                raise RequestError(405, f'{method} {path} is not allowed')
+            return {'running_jobs': len(self.jobs),
+                    'completed_jobs': self.num_completed,
+                    'pools': len(self.pools)}
+        if path == '/jobs':
+            if method != 'POST':
+                raise RequestError(405, f'{method} {path} is not allowed')
+            try:
+                payload = json.loads(body)
+            except ValueError as e:
+                raise RequestError(400, f'Invalid JSON: {e}') from e
+            return await self.run_job(self.job_config(payload))
+        raise RequestError(404, f'No such endpoint: {path}')
+
+    async def handle(self, reader: asyncio.StreamReader,
+                     writer: asyncio.StreamWriter):
+        """Answer a single HTTP request, then close the connection"""
+        status = 200
+        try:
+            request_line = (await reader.readline()).decode('latin-1')
+            try:
+                method, target, _ = request_line.split(' ', 2)
+            except ValueError:
+                raise RequestError(400, 'Invalid request line')
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1')
+                if not line.strip():
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            if self.token is not None and not hmac.compare_digest(
+                    headers.get('authorization', '').encode(),
+                    f'Bearer {self.token}'.encode()):
+                raise RequestError(401, 'Missing or invalid token')
+            length = int(headers.get('content-length') or 0)
+            if length > MAX_REQUEST_BYTES:
+                raise RequestError(413, 'The job is too large')
+            body = await reader.readexactly(length)
+            payload = await self.respond(method, target.split('?')[0], body)
+        except RequestError as e:
+            status, payload = e.status, {'error': str(e)}
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            status, payload = 400, {'error': f'Invalid request: {e}'}
+        data = json.dumps(payload).encode()
+        writer.write(
+            f'HTTP/1.1 {status} {REASONS[status]}\r\n'
+            f'Content-Type: application/json\r\n'
+            f'Content-Length: {len(data)}\r\n'
+            f'Connection: close\r\n\r\n'.encode() + data)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    async def start(self, socket_path: Optional[str], host: str, port: int):
+        """Start listening on a Unix socket, accessible only to the user of
+        the server, if `socket_path` is set, or on a loopback TCP port
+        requiring the token of the server otherwise"""
+        if socket_path is None:
+            if not is_loopback(host):
+                raise ValueError(f'The server can only listen on loopback '
+                                 f'addresses, not {host}')
+            if not self.token:
+                raise ValueError('A token is required to listen on a TCP '
+                                 'port')
+            return await asyncio.start_server(self.handle, host, port)
+        if os.path.exists(socket_path) and \
+                stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            os.remove(socket_path)  # left by a previous server
+        umask = os.umask(0o177)
+        try:
+            server = await asyncio.start_unix_server(self.handle, socket_path)
+        finally:
+            os.umask(umask)
+        os.chmod(socket_path, 0o600)
+        return server
+
+    async def close(self):
+        """Wait for the running jobs and close the connection pools"""
+        if self.jobs:
+            log.info('Waiting for %d running jobs', len(self.jobs))
+            await asyncio.gather(*self.jobs.values(), return_exceptions=True)
+        for pool in self.pools.values():
+            await pool.close()
+        self.pools = {}
+
+    async def serve(self, socket_path: Optional[str], host: str, port: int):
+        """Serve until interrupted by SIGINT or SIGTERM"""
+        server = await self.start(socket_path, host, port)
+        log.info('Serving load jobs on %s',
+                 socket_path or f'http://{host}:{port}')
+        stopped = asyncio.Event()
+        loop = asyncio.get_event_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stopped.set)
+        try:
+            await stopped.wait()
+        finally:
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                loop.remove_signal_handler(signum)
+            server.close()
+            await server.wait_closed()
+            await self.close()
+            if socket_path is not None and os.path.exists(socket_path):
+                os.remove(socket_path)
+            log.info('Stopped')
@@ -0,0 +1,205 @@
+"""Input sources read by the readers of csvtopg.aiocsv. A source is an async
+context manager whose `reader(chunk_size, offset)` method returns an object
+with an async `read_chunk()` method, which returns the next bytes of the
+input from `offset`, or b'' at the end. Regular files are read with aiofile or
+memory-mapped, and pipes and the standard input through an asyncio
+StreamReader.
+"""
+
+import asyncio
+import logging
+import mmap
+import os
+import stat
+import sys
+from typing import BinaryIO, Optional
+
+import aiofile
+
+from csvtopg.compression import StreamDecompressor, detect_magic
+
+log = logging.getLogger(__name__)
+
+STDIN = '-'
+INPUT_SOURCES = ('auto', 'aiofile', 'mmap')
+
+
+class SourceError(Exception):
+    pass
+
+
+def is_stream(path: str) -> bool:
+    """Whether the input is the standard input, a named pipe or a character
+    device, which can only be read once, sequentially"""
+    if path == STDIN:
+        return True
+    try:
+        mode = os.stat(path).st_mode
+    except OSError:
+        return False
+    return stat.S_ISFIFO(mode) or stat.S_ISCHR(mode)
+
+
+class FileSource:
+    """Regular file read with aiofile"""
+    seekable = True
+
+    def __init__(self, path: str):
+        self.aio_file = aiofile.AIOFile(path, 'rb')
+
+    def reader(self, chunk_size: int, offset: int = 0) -> aiofile.Reader:
+        return aiofile.Reader(self.aio_file, chunk_size=chunk_size,
+                              offset=offset)
+
+    async def __aenter__(self) -> 'FileSource':
+        await self.aio_file.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aio_file.close()
+
+
+class MmapReader:
+    def __init__(self, buffer, chunk_size: int, offset: int):
+        self.buffer = buffer
+        self.chunk_size = chunk_size
+        self.position = offset
+
+    async def read_chunk(self) -> bytes:
+        chunk = self.buffer[self.position:self.position + self.chunk_size]
+        self.position += len(chunk)
+        return chunk
+
+
+class MmapSource:
+    """Regular file mapped in memory. The pages are read by the kernel as
+    they are accessed, which blocks the event loop on page faults. Its
+    readers return copies of the mapped bytes, csvtopg.aiocsv.MmapChunkReader
+    parses the mapped bytes directly."""
+    seekable = True
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file: Optional[BinaryIO] = None
+        self.buffer = b''
+
+    def reader(self, chunk_size: int, offset: int = 0) -> MmapReader:
+        return MmapReader(self.buffer, chunk_size, offset)
+
+    async def __aenter__(self) -> 'MmapSource':
+        self.file = open(self.path, 'rb')
+        if os.fstat(self.file.fileno()).st_size > 0:
+            self.buffer = mmap.mmap(self.file.fileno(), 0,
+                                    access=mmap.ACCESS_READ)
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                # aggressive readahead, and pages freed soon after being read
+                self.buffer.madvise(mmap.MADV_SEQUENTIAL)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if isinstance(self.buffer, mmap.mmap):
+            try:
+                self.buffer.close()
+            except BufferError:
+                # still viewed, e.g. by the traceback of an error: the
+                # mapping is closed when the views are garbage collected
+                pass
+        self.file.close()
+
+
+class StreamReader:
+    def __init__(self, source: 'StreamSource', chunk_size: int):
+        self.source = source
+        self.chunk_size = chunk_size
+
+    async def read_chunk(self) -> bytes:
+        return await self.source.read_chunk(self.chunk_size)
+
+
+class StreamSource:
+    """Standard input or pipe, read sequentially through an asyncio
+    StreamReader, or by a worker thread if the standard input is redirected
+    from a regular file. Readers can only be created at the current position,
+    which `unread` moves back over the bytes read ahead. Compressed streams
+    are detected by their first bytes, unless `compression` is set, and
+    decompressed in a worker thread."""
+    seekable = False
+
+    def __init__(self, path: str, compression: str = 'auto'):
+        self.path = path
+        self.compression = compression
+        self.file: Optional[BinaryIO] = None
+        self.stream: Optional[asyncio.StreamReader] = None
+        self.transport = None
+        self.decompressor: Optional[StreamDecompressor] = None
+        self.pending = b''  # decompressed or unread bytes
+        self.position = 0
+        self.started = False
+
+    def reader(self, chunk_size: int, offset: int = 0) -> StreamReader:
+        if offset != self.position:
+            raise SourceError(
+                f'Cannot read {self.path} from byte {offset}, streams are '
+                f'read sequentially (current position: {self.position})')
+        return StreamReader(self, chunk_size)
+
+    def unread(self, data: bytes):
+        """Put back bytes to be returned first by the next read"""
+        self.pending = data + self.pending
+        self.position -= len(data)
+
+    async def read_raw(self, size: int) -> bytes:
+        """Read up to `size` bytes, fewer only at the end of the stream"""
+        if self.stream is None:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(None, self.file.read, size)
+        chunks = []
+        while size > 0:
+            chunk = await self.stream.read(size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    async def read_chunk(self, size: int) -> bytes:
+        while not self.pending:
+            raw = await self.read_raw(size)
+            if not raw:
+                return b''
+            if not self.started:
+                self.started = True
+                compression = self.compression
+                if compression == 'auto':
+                    compression = detect_magic(raw)
+                if compression not in (None, 'none'):
+                    log.debug('Decompressing %s input stream', compression)
+                    self.decompressor = StreamDecompressor(compression)
+            if self.decompressor is not None:
+                loop = asyncio.get_event_loop()
+                raw = await loop.run_in_executor(
+                    None, self.decompressor.decompress, raw)
+            self.pending = raw
+        chunk, self.pending = self.pending[:size], self.pending[size:]
+        self.position += len(chunk)
+        return chunk
+
+    async def __aenter__(self) -> 'StreamSource':
+        if self.path == STDIN:
+            self.file = os.fdopen(os.dup(sys.stdin.fileno()), 'rb')
+        else:
+            self.file = open(self.path, 'rb')
+        if stat.S_ISREG(os.fstat(self.file.fileno()).st_mode):
+            # redirected regular file, read in a worker thread
+            return self
+        loop = asyncio.get_event_loop()
+        self.stream = asyncio.StreamReader(limit=2 ** 20)
+        self.transport, _ = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(self.stream, loop=loop),
+            self.file)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self.transport is not None:
+            self.transport.close()
+        self.file.close()
@@ -0,0 +1,378 @@
+"""Loads through an UNLOGGED staging table without indexes, which is either
+swapped in place of the target table once its indexes and constraints are
+built, or appended to the target table in a single INSERT ... SELECT, and
+upserts of each batch through a temporary table.
+
+The swap recreates on the staging table the indexes and the constraints of
+the existing target table, building the indexes in parallel, then drops the
+target table and renames the staging table, its indexes and its constraints
+in one transaction. Readers of the target table see either the previous
+table or the complete new one. The privileges granted on the previous table
+are not carried over, and the tables with foreign keys to it prevent the
+swap.
+
+The rows copied into the staging table skip the WAL, but unless wal_level is
+minimal, the staging table is written whole to the WAL when it is made
+LOGGED before the swap, so that the saving is then mostly that the indexes
+are built once, after the load, instead of updated by each batch. With
+`keep_unlogged`, the swapped table stays UNLOGGED and is never written to
+the WAL: it is emptied after a crash of the server and is not replicated.
+An append inserts the staging table into the logged target table, which
+writes its rows to the WAL.
+
+With key columns, the rows appended or upserted are merged with the rows of
+the target table that have the same keys, according to the conflict policy:
+'ignore' keeps the existing rows, 'update' overwrites their columns, or only
+the configured update columns. The target table needs a primary key or a
+unique index on the key columns; csvtopg creates tables with one.
+"""
+
+import asyncio
+import logging
+import re
+import time
+from typing import Callable, List, NamedTuple, Optional, Sequence, Tuple
+
+import asyncpg
+
+from csvtopg.packing import copy_rows_to_table
+
+log = logging.getLogger(__name__)
+
+LOAD_STRATEGIES = ('direct', 'swap', 'append')
+CONFLICT_POLICIES = ('ignore', 'update')
+MAX_IDENTIFIER_LENGTH = 63
+INDEX_DEFINITION = re.compile(
+    r'CREATE (UNIQUE )?INDEX .+? ON (?:ONLY )?.+? (USING .*)$', re.DOTALL)
+
+
+class StagingError(Exception):
+    pass
+
+
+def staging_table_name(table_name: str) -> str:
+    """
+    >>> staging_table_name('public.sales')
+    'public.sales_staging'
+    """
+    return f'{table_name}_staging'
+
+
+def quote_identifier(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def split_table_name(table_name: str):
+    """Return the schema prefix, with its trailing dot, and the name of a
+    possibly schema-qualified table"""
+    schema, dot, name = table_name.rpartition('.')
+    return schema + dot, name
+
+
+def rewrite_index_definition(definition: str, name: str, table: str) -> str:
+    """Rename an index definition returned by pg_get_indexdef and move it to
+    another table
+
+    >>> rewrite_index_definition(
+    ...     'CREATE UNIQUE INDEX t_pkey ON public.t USING btree (id)',
+    ...     'i1', 't_staging')
+    'CREATE UNIQUE INDEX i1 ON t_staging USING btree (id)'
+    """
+    match = INDEX_DEFINITION.match(definition)
+    if match is None:
+        raise StagingError(f'Cannot parse the index definition {definition}')
+    unique, method = match.groups()
+    return f'CREATE {unique or ""}INDEX {name} ON {table} {method}'
+
+
+def check_key_columns(columns: List[str], key_columns: List[str],
+                      update_columns: Sequence[str] = ()):
+    missing = [col for col in (*key_columns, *update_columns)
+               if col not in columns]
+    if missing:
+        raise StagingError(
+            f'Key or update columns {", ".join(missing)} are not in the '
+            f'header')
+
+
+def merge_statement(table: str, source: str, columns: List[str],
+                    key_columns: List[str], on_conflict: str = 'update',
+                    update_columns: Sequence[str] = ()) -> str:
+    """Statement inserting the rows of the source table into the target
+    table, which returns the numbers of rows inserted and updated. With key
+    columns, a single row is kept per key, the last one in the source table.
+
+    >>> print(merge_statement('t', 't_merge', ['id', 'v'], ['id']))
+    WITH merged AS (
+    INSERT INTO t ("id", "v")
+    SELECT DISTINCT ON ("id") "id", "v" FROM t_merge
+    ORDER BY "id", ctid DESC
+    ON CONFLICT ("id") DO UPDATE SET "v" = EXCLUDED."v"
+    RETURNING xmax = 0 AS inserted)
+    SELECT count(*) FILTER (WHERE inserted) AS inserted,
+           count(*) FILTER (WHERE NOT inserted) AS updated
+    FROM merged
+    """
+    column_list = ', '.join(map(quote_identifier, columns))
+    select = f'SELECT {column_list} FROM {source}'
+    conflict = ''
+    if key_columns:
+        keys = ', '.join(map(quote_identifier, key_columns))
+        select = (f'SELECT DISTINCT ON ({keys}) {column_list} FROM {source}\n'
+                  f'ORDER BY {keys}, ctid DESC')
+        updates = ', '.join(
+            f'{quote_identifier(col)} = EXCLUDED.{quote_identifier(col)}'
+            for col in update_columns or columns if col not in key_columns)
+        action = 'NOTHING'
+        if on_conflict == 'update' and updates:
+            action = f'UPDATE SET {updates}'
+        conflict = f'\nON CONFLICT ({keys}) DO {action}'
+    # the rows inserted, as opposed to updated, have no deleting transaction
+    return (f'WITH merged AS (\n'
+            f'INSERT INTO {table} ({column_list})\n'
+            f'{select}{conflict}\n'
+            f'RETURNING xmax = 0 AS inserted)\n'
+            f'SELECT count(*) FILTER (WHERE inserted) AS inserted,\n'
+            f'       count(*) FILTER (WHERE NOT inserted) AS updated\n'
+            f'FROM merged')
+
+
+def primary_key_clause(key_columns: List[str]) -> str:
+    if not key_columns:
+        return ''
+    return f', PRIMARY KEY ({", ".join(map(quote_identifier, key_columns))})'
+
+
+class IndexBuild(NamedTuple):
+    """Index to build on the staging table, and the constraint it backs if
+    any, with their temporary and final names"""
+    name: str
+    final_name: str
+    definition: str  # CREATE INDEX statement on the staging table
+    constraint: Optional[str] = None  # PRIMARY KEY or UNIQUE
+    constraint_options: str = ''  # DEFERRABLE...
+
+
+class StagingLoad:
+    """Staging table of the load of `table_name`, see the module docstring"""
+
+    def __init__(self, table_name: str, strategy: str,
+                 key_columns: List[str], max_parallel_index_builds: int = 4,
+                 on_conflict: Optional[str] = None,
+                 update_columns: Sequence[str] = (),
+                 keep_unlogged: bool = False):
+        self.table_name = table_name
+        self.staging_table = staging_table_name(table_name)
+        self.strategy = strategy
+        self.key_columns = key_columns
+        self.on_conflict = on_conflict or 'update'
+        self.update_columns = update_columns
+        self.max_parallel_index_builds = max_parallel_index_builds
+        self.keep_unlogged = keep_unlogged
+        self.schema_prefix, self.unqualified_name = split_table_name(
+            table_name)
+
+    async def target_exists(self, conn: asyncpg.Connection) -> bool:
+        return await conn.fetchval('SELECT to_regclass($1) IS NOT NULL',
+                                   self.table_name)
+
+    async def create(self, conn: asyncpg.Connection, schema: str):
+        """Create an empty staging table, with the columns of the target
+        table if it exists, or else with `schema`"""
+        await conn.execute(f'DROP TABLE IF EXISTS {self.staging_table}')
+        if await self.target_exists(conn):
+            columns = (f'LIKE {self.table_name} INCLUDING DEFAULTS '
+                       f'INCLUDING GENERATED INCLUDING IDENTITY '
+                       f'INCLUDING STORAGE')
+        else:
+            columns = f'\n{schema}'
+        await conn.execute(
+            f'CREATE UNLOGGED TABLE {self.staging_table} ({columns})')
+
+    def temporary_name(self, i: int) -> str:
+        suffix = f'_{i}'
+        prefix = split_table_name(self.staging_table)[1]
+        return prefix[:MAX_IDENTIFIER_LENGTH - len(suffix)] + suffix
+
+    def primary_key_build(self, i: int) -> IndexBuild:
+        """Primary key of the target table created from the staging table"""
+        name = self.temporary_name(i)
+        keys = ', '.join(map(quote_identifier, self.key_columns))
+        return IndexBuild(
+            name, f'{self.unqualified_name}_pkey'[:MAX_IDENTIFIER_LENGTH],
+            f'CREATE UNIQUE INDEX {name} ON {self.staging_table} ({keys})',
+            'PRIMARY KEY')
+
+    async def plan_index_builds(self, conn: asyncpg.Connection):
+        """Return the indexes to build and the other constraints to add to
+        the staging table for it to replace the target table"""
+        if not await self.target_exists(conn):
+            if self.key_columns:
+                return [self.primary_key_build(0)], []
+            return [], []
+        builds = []
+        constraints = []
+        for record in await conn.fetch('''
+                SELECT c.relname AS name,
+                    pg_get_indexdef(i.indexrelid) AS definition, k.conname,
+                    k.contype::text, k.condeferrable, k.condeferred
+                FROM pg_index i
+                JOIN pg_class c ON c.oid = i.indexrelid
+                LEFT JOIN pg_constraint k ON k.conindid = i.indexrelid
+                    AND k.conrelid = i.indrelid AND k.contype IN ('p', 'u')
+                WHERE i.indrelid = $1::regclass
+                    AND NOT EXISTS (
+                        SELECT FROM pg_constraint x
+                        WHERE x.conindid = i.indexrelid
+                            AND x.conrelid = i.indrelid AND x.contype = 'x')
+                ORDER BY c.relname''', self.table_name):
+            name = self.temporary_name(len(builds))
+            definition = rewrite_index_definition(
+                record['definition'], name, self.staging_table)
+            if record['conname'] is None:
+                builds.append(IndexBuild(name, record['name'], definition))
+                continue
+            options = ''
+            if record['condeferrable']:
+                options = ' DEFERRABLE'
+                if record['condeferred']:
+                    options += ' INITIALLY DEFERRED'
+            builds.append(IndexBuild(
+                name, record['conname'], definition,
+                'PRIMARY KEY' if record['contype'] == 'p' else 'UNIQUE',
+                options))
+        for record in await conn.fetch('''
+                SELECT conname, pg_get_constraintdef(oid) AS definition
+                FROM pg_constraint
+                WHERE conrelid = $1::regclass
+                    AND contype IN ('c', 'f', 'x')
+                ORDER BY conname''', self.table_name):
+            constraints.append((record['conname'], record['definition']))
+        return builds, constraints
+
+    async def build_indexes(self, connect: Callable, builds: List[IndexBuild]):
+        """Build the indexes on separate connections, at most
+        max_parallel_index_builds at a time"""
+        semaphore = asyncio.Semaphore(self.max_parallel_index_builds)
+
+        async def build(index: IndexBuild):
+            async with semaphore:
+                async with connect() as conn:
+                    t0 = time.perf_counter()
+                    await conn.execute(index.definition)
+                    log.debug('Built index %s in %.1f s', index.final_name,
+                              time.perf_counter() - t0)
+
+        await asyncio.gather(*map(build, builds))
+
+    async def finish(self, connect: Callable, columns: List[str]) \
+            -> Optional[Tuple[int, int]]:
+        """Swap or append the staging table into the target table, and return
+        the numbers of rows inserted and updated by an append. `connect`
+        returns an async context manager yielding a connection."""
+        t0 = time.perf_counter()
+        counts = None
+        if self.strategy == 'swap':
+            await self.swap(connect)
+        else:
+            counts = await self.append(connect, columns)
+        log.info('Staging table %s %s into %s in %.1f s', self.staging_table,
+                 'swapped' if counts is None else
+                 'appended (%d inserted, %d updated rows)' % counts,
+                 self.table_name, time.perf_counter() - t0)
+        return counts
+
+    async def swap(self, connect: Callable):
+        async with connect() as conn:
+            builds, constraints = await self.plan_index_builds(conn)
+            target_exists = await self.target_exists(conn)
+            if not self.keep_unlogged:
+                # a copy of the whole table to the WAL, unless wal_level is
+                # minimal
+                await conn.execute(
+                    f'ALTER TABLE {self.staging_table} SET LOGGED')
+        await self.build_indexes(connect, builds)
+        async with connect() as conn:
+            for index in builds:
+                if index.constraint is not None:
+                    await conn.execute(
+                        f'ALTER TABLE {self.staging_table} ADD CONSTRAINT '
+                        f'{index.name} {index.constraint} USING INDEX '
+                        f'{index.name}{index.constraint_options}')
+            temporary_constraints = []
+            for i, (name, definition) in enumerate(constraints):
+                temporary_name = self.temporary_name(len(builds) + i)
+                await conn.execute(
+                    f'ALTER TABLE {self.staging_table} ADD CONSTRAINT '
+                    f'{temporary_name} {definition}')
+                temporary_constraints.append((temporary_name, name))
+            async with conn.transaction():
+                if target_exists:
+                    await conn.execute(f'DROP TABLE {self.table_name}')
+                await conn.execute(
+                    f'ALTER TABLE {self.staging_table} RENAME TO '
+                    f'{self.unqualified_name}')
+                for index in builds:
+                    if index.constraint is None:
+                        await conn.execute(
+                            f'ALTER INDEX {self.schema_prefix}{index.name} '
+                            f'RENAME TO {quote_identifier(index.final_name)}')
+                    else:
+                        temporary_constraints.append(
+                            (index.name, index.final_name))
+                for temporary_name, name in temporary_constraints:
+                    await conn.execute(
+                        f'ALTER TABLE {self.table_name} RENAME CONSTRAINT '
+                        f'{temporary_name} TO {quote_identifier(name)}')
+
+    async def append(self, connect: Callable, columns: List[str]) \
+            -> Tuple[int, int]:
+        async with connect() as conn:
+            async with conn.transaction():
+                if not await self.target_exists(conn):
+                    await conn.execute(
+                        f'CREATE TABLE {self.table_name} (LIKE '
+                        f'{self.staging_table} INCLUDING ALL'
+                        f'{primary_key_clause(self.key_columns)})')
+                counts = await conn.fetchrow(merge_statement(
+                    self.table_name, self.staging_table, columns,
+                    self.key_columns, self.on_conflict, self.update_columns))
+                await conn.execute(f'DROP TABLE {self.staging_table}')
+        return tuple(counts)
+
+
+class BatchMerge:
+    """Upsert of the batches: each batch is copied into a temporary table of
+    the writer connection, then merged into the target table with a single
+    INSERT ... ON CONFLICT, in the transaction of the batch."""
+
+    def __init__(self, table_name: str, key_columns: List[str],
+                 on_conflict: str, update_columns: Sequence[str] = ()):
+        self.table_name = table_name
+        self.key_columns = key_columns
+        self.on_conflict = on_conflict
+        self.update_columns = update_columns
+        self.temporary_table = f'{split_table_name(table_name)[1]}_merge'
+
+    async def prepare(self, conn: asyncpg.Connection):
+        """Create the temporary table of the connection. A pooled connection
+        keeps the temporary tables of its previous loads, which may have
+        been of another table of the same name or with other columns, and
+        the statements that asyncpg prepared on them."""
+        await conn.execute(
+            f'DROP TABLE IF EXISTS pg_temp.{self.temporary_table}')
+        await conn.execute(
+            f'CREATE TEMPORARY TABLE {self.temporary_table} '
+            f'(LIKE {self.table_name} INCLUDING DEFAULTS)')
+        await conn.reload_schema_state()
+
+    async def merge(self, conn: asyncpg.Connection, rows: List,
+                    columns: List[str]) -> Tuple[int, int]:
+        """Upsert the rows and return the numbers of rows inserted and
+        updated. Must run in a transaction."""
+        await copy_rows_to_table(conn, self.temporary_table, rows)
+        counts = await conn.fetchrow(merge_statement(
+            self.table_name, self.temporary_table, columns, self.key_columns,
+            self.on_conflict, self.update_columns))
+        await conn.execute(f'TRUNCATE {self.temporary_table}')
+        return tuple(counts)
@@ -0,0 +1,10 @@
+from csvtopg.bench import Dataset, generate_csv, measure_batch_memory
+
+
+def test_packed_batches_hold_less_memory_than_rows(tmp_path):
+    path = str(tmp_path / 'bench.csv')
+    generate_csv(path, Dataset(num_rows=20_000, quote_ratio=0.2))
+    memory = measure_batch_memory(path)
+    packed, rows = memory['packed'], memory['rows']
+    assert packed['bytes_per_row'] < rows['bytes_per_row'] / 2
+    assert packed['blocks_per_batch'] < rows['blocks_per_batch'] / 100
@@ -0,0 +1,79 @@
+import asyncio
+import time
+
+import aiofile
+
+from csvtopg.aiocsv import AsyncChunkReader, AsyncListReader, MmapChunkReader
+from csvtopg.sources import MmapSource
+
+NUM_ROWS = 100_000
+
+
+async def read_lines(path):
+    async with aiofile.AIOFile(path, 'rb') as f:
+        return sum([1 async for _ in AsyncListReader(f)])
+
+
+async def read_chunks(path):
+    async with aiofile.AIOFile(path, 'rb') as f:
+        return sum([len(rows) async for rows in AsyncChunkReader(f)])
+
+
+async def read_mapped_chunks(path):
+    async with MmapSource(path) as f:
+        return sum([len(rows) async for rows in MmapChunkReader(f)])
+
+
+def timed(coroutine):
+    t0 = time.perf_counter()
+    result = asyncio.new_event_loop().run_until_complete(coroutine)
+    return result, time.perf_counter() - t0
+
+
+def write_bench_csv(path, num_rows=NUM_ROWS):
+    with open(path, 'w') as f:
+        f.write('id,name,amount,comment\n')
+        for i in range(num_rows):
+            f.write(f'{i},name {i},{i * 1.5},"some, quoted ""text"""\n')
+
+
+def test_chunk_reader_is_faster_than_line_reader(tmp_path):
+    path = tmp_path / 'bench.csv'
+    write_bench_csv(path)
+    num_lines, line_time = timed(read_lines(str(path)))
+    num_chunk_rows, chunk_time = timed(read_chunks(str(path)))
+    assert num_lines == num_chunk_rows == NUM_ROWS + 1
+    assert chunk_time < line_time
+
+
+def test_mmap_reader_is_not_slower_than_chunk_reader(tmp_path):
+    path = tmp_path / 'bench.csv'
+    write_bench_csv(path, 10 * NUM_ROWS)
+    num_chunk_rows, chunk_time = timed(read_chunks(str(path)))
+    num_mapped_rows, mmap_time = timed(read_mapped_chunks(str(path)))
+    assert num_mapped_rows == num_chunk_rows == 10 * NUM_ROWS + 1
+    # a wide margin, the copies avoided are checked below
+    assert mmap_time < 2 * chunk_time
+
+
+def test_mmap_reader_parses_views_of_the_mapping(tmp_path):
+    path = tmp_path / 'bench.csv'
+    write_bench_csv(path)
+
+    async def read_blocks():
+        async with MmapSource(str(path)) as f:
+            reader = MmapChunkReader(f, chunk_size=64 * 1024)
+            views = []
+            while not reader.eof:
+                views.append(await reader.read_records())
+            copied = [view for view in views if view.obj is not f.buffer]
+            num_bytes = sum(map(len, views))
+            for view in views:
+                view.release()
+            return len(views), copied, num_bytes
+
+    loop = asyncio.new_event_loop()
+    num_blocks, copied, num_bytes = loop.run_until_complete(read_blocks())
+    loop.close()
+    assert num_blocks > 1 and copied == []
+    assert num_bytes == path.stat().st_size
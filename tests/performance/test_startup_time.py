@@ -0,0 +1,21 @@
+import subprocess
+import sys
+
+# Cumulative import time of csvtopg.cli, in microseconds: about 0.17s when
+# the modules of the loads are imported by the commands only, and 0.5s when
+# they are imported at start-up. The budget leaves a margin of about 50%.
+IMPORT_TIME_BUDGET = 250_000
+LAZY_MODULES = {'asyncpg', 'aiofile', 'toml', 'pkg_resources',
+                'importlib.metadata', 'csvtopg.application'}
+
+
+def test_cli_imports_only_what_the_command_line_needs():
+    stderr = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import csvtopg.cli'],
+        stderr=subprocess.PIPE, check=True, universal_newlines=True).stderr
+    times = {}
+    for line in stderr.splitlines()[1:]:
+        _, cumulative, module = line.split('|')
+        times[module.strip()] = int(cumulative)
+    assert not LAZY_MODULES & set(times)
+    assert times['csvtopg.cli'] < IMPORT_TIME_BUDGET
@@ -0,0 +1,49 @@
+import asyncio
+import os
+import shutil
+
+import asyncpg
+import pytest
+
+from csvtopg.application import CSVToPg
+from csvtopg.bench import Dataset, LocalPostgres, generate_csv, run_benchmarks
+from csvtopg.configuration import Config
+
+PG_BIN_DIR = os.environ.get('CSVTOPG_PG_BIN_DIR')
+
+pytestmark = pytest.mark.skipif(
+    not (PG_BIN_DIR or shutil.which('initdb')) or os.geteuid() == 0,
+    reason='requires PostgreSQL binaries and a non-root user')
+
+
+def test_chunk_modes_load_all_rows_and_report_throughput():
+    report = run_benchmarks(Dataset(num_rows=20_000, quote_ratio=0.05),
+                            ['chunk', 'chunk-4-writers', 'passthrough'],
+                            PG_BIN_DIR)
+    assert report['dataset']['num_rows'] == 20_000
+    for result in report['results']:
+        assert result['errors'] == []
+        assert result['num_rows_written'] == 20_000
+        assert result['rows_per_s'] > 0 and result['peak_rss_mb'] > 0
+
+
+def test_parallel_writers_in_a_shared_snapshot_commit_all_rows(tmp_path):
+    input_file = str(tmp_path / 'data.csv')
+    num_rows = generate_csv(input_file, Dataset(num_rows=20_000))
+    with LocalPostgres(PG_BIN_DIR) as server:
+        config = Config(server.conn_uri, 'shared', input_file, False,
+                        'WARNING', num_writers=4, shared_snapshot=True,
+                        batch_target_rows=500)
+        result = CSVToPg(config).run()
+
+        async def count():
+            conn = await asyncpg.connect(server.conn_uri)
+            try:
+                return await conn.fetchval('SELECT count(*) FROM shared')
+            finally:
+                await conn.close()
+
+        num_rows_in_table = asyncio.new_event_loop().run_until_complete(
+            count())
+    assert result.errors == []
+    assert result.metrics.num_rows_written == num_rows == num_rows_in_table
@@ -0,0 +1,77 @@
+import asyncio
+import warnings
+
+import pytest
+
+import aiofile
+
+from csvtopg.aiocsv import (
+    AsyncChunkReader, AsyncReaderError, OnError, find_records_end)
+
+
+def read_batches(path, **kwargs):
+    async def read():
+        async with aiofile.AIOFile(path, 'rb') as f:
+            reader = AsyncChunkReader(f, **kwargs)
+            header = await reader.read_header()
+            return header, [batch async for batch in reader]
+    return asyncio.new_event_loop().run_until_complete(read())
+
+
+def test_find_records_end_ignores_quoted_newlines():
+    assert find_records_end(b'a,"b\nc"') == 0
+    assert find_records_end(b'a,b\n"c\nd",e') == 4
+    assert find_records_end(b'a,"b\nc"\nd') == 8
+
+
+def test_chunk_reader_carries_quoted_records_over_blocks(tmp_path):
+    path = tmp_path / 'quoted.csv'
+    path.write_text('h1,h2\n1,"multi\nline"\n2,"x ""quoted"" y"\n3,end')
+    header, batches = read_batches(str(path), chunk_size=4)
+    assert header == ['h1', 'h2']
+    assert [row for batch in batches for row in batch] == [
+        ['1', 'multi\nline'], ['2', 'x "quoted" y'], ['3', 'end']]
+
+
+def test_chunk_reader_does_not_carry_over_stray_quotes(tmp_path):
+    path = tmp_path / 'stray.csv'
+    path.write_text('id,name\n1,12" ruler\n' + ''.join(
+        f'{i},"x\n{"y" * 40}"\n' if i == 500 else f'{i},name\n'
+        for i in range(2, 1000)))
+    header, batches = read_batches(str(path), chunk_size=64)
+    rows = [row for batch in batches for row in batch]
+    assert len(rows) == 999
+    assert rows[0] == ['1', '12" ruler']
+    assert rows[499] == ['500', 'x\n' + 'y' * 40]
+    # blocks of at most MAX_TAIL_CHUNKS + 1 chunks, not the rest of the file
+    assert len(batches) > path.stat().st_size // (5 * 64)
+
+
+def test_chunk_reader_skips_bad_rows(tmp_path):
+    path = tmp_path / 'bad.csv'
+    path.write_text('h1,h2\n1,2\n\n3\n4,5\n')
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        _, batches = read_batches(str(path))
+    assert [row for batch in batches for row in batch] == [
+        ['1', '2'], ['4', '5']]
+    assert len(caught) == 2
+    with pytest.raises(AsyncReaderError, match='line 4'):
+        read_batches(str(path), on_empty_line=OnError.skip_silently,
+                     on_wrong_length=OnError.exception)
+
+
+def test_chunk_reader_verify_counts_records_and_checks_lengths(tmp_path):
+    async def verify(path):
+        async with aiofile.AIOFile(path, 'rb') as f:
+            reader = AsyncChunkReader(
+                f, on_wrong_length=OnError.exception, chunk_size=8)
+            await reader.read_header()
+            return await reader.verify()
+    path = tmp_path / 'verify.csv'
+    path.write_text('a,b\n1,2\n3,"4,\n5"\n6,7\n')
+    loop = asyncio.new_event_loop()
+    assert loop.run_until_complete(verify(str(path))) == 3
+    path.write_text('a,b\n1,2\n3,4,5\n')
+    with pytest.raises(AsyncReaderError, match='line 3'):
+        loop.run_until_complete(verify(str(path)))
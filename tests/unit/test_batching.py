@@ -0,0 +1,90 @@
+import asyncio
+
+from csvtopg.batching import Batch, Batcher, ByteBudgetQueue, Segment
+
+
+def drain(q):
+    batches = []
+    while not q.empty():
+        batches.append(q.get_nowait())
+    return batches
+
+
+def test_batcher_splits_by_rows_and_bytes():
+    async def fill():
+        q = asyncio.Queue()
+        batcher = Batcher(q, target_rows=4, target_bytes=30, max_linger=60)
+        await batcher.add([[i] for i in range(10)], nbytes=50)
+        await batcher.flush()
+        return batcher, drain(q)
+    batcher, batches = asyncio.new_event_loop().run_until_complete(fill())
+    assert [len(batch) for batch in batches] == [4, 4, 2]
+    assert [batch.nbytes for batch in batches] == [20, 20, 10]
+    assert batcher.rows_histogram == {4: 2, 2: 1}
+
+
+def test_batcher_flushes_lingering_rows():
+    async def fill():
+        q = asyncio.Queue()
+        batcher = Batcher(q, target_rows=100, target_bytes=1000,
+                          max_linger=0.01)
+        linger_task = asyncio.ensure_future(batcher.linger())
+        await batcher.add([[1], [2]], nbytes=4)
+        batch = await asyncio.wait_for(q.get(), timeout=1)
+        linger_task.cancel()
+        return batch
+    batch = asyncio.new_event_loop().run_until_complete(fill())
+    assert batch.rows == [[1], [2]]
+
+
+def test_rows_of_a_cancelled_linger_flush_are_kept():
+    async def fill():
+        q = asyncio.Queue(maxsize=1)
+        await q.put(None)
+        batcher = Batcher(q, target_rows=100, target_bytes=1000,
+                          max_linger=0.01)
+        linger_task = asyncio.ensure_future(batcher.linger())
+        await batcher.add([[1], [2]], nbytes=4)
+        await asyncio.sleep(0.05)  # the linger flush waits for room
+        assert not batcher.rows
+        linger_task.cancel()
+        await asyncio.gather(linger_task, return_exceptions=True)
+        q.get_nowait()
+        await batcher.flush()
+        return batcher, drain(q)
+    batcher, batches = asyncio.new_event_loop().run_until_complete(fill())
+    assert [batch.rows for batch in batches] == [[[1], [2]]]
+    assert batcher.rows_histogram == {2: 1}
+
+
+def test_batcher_splits_input_segments_with_rows():
+    async def fill():
+        q = asyncio.Queue()
+        batcher = Batcher(q, target_rows=4, target_bytes=1000, max_linger=60)
+        await batcher.add([[i] for i in range(3)], 30, Segment(0, 30, 0, 3, 3))
+        await batcher.add([[i] for i in range(3)], 30,
+                          Segment(30, 60, 0, 3, 3))
+        await batcher.flush()
+        return drain(q)
+    batches = asyncio.new_event_loop().run_until_complete(fill())
+    assert [batch.segments for batch in batches] == [
+        [Segment(0, 30, 0, 3, 3), Segment(30, 60, 0, 1, 3)],
+        [Segment(30, 60, 1, 3, 3)]]
+
+
+def test_byte_budget_queue_blocks_until_batches_are_released():
+    async def run():
+        q = ByteBudgetQueue(max_bytes=100)
+        await q.put(Batch([1], 60))
+        blocked = asyncio.ensure_future(q.put(Batch([2], 60)))
+        await asyncio.sleep(0.01)
+        assert not blocked.done() and q.qsize() == 1
+        q.release(q.get_nowait())
+        await asyncio.wait_for(blocked, 1)
+        # a batch larger than the budget passes when nothing is in flight
+        q.release(q.get_nowait())
+        await asyncio.wait_for(q.put(Batch([3], 150)), 1)
+        return q
+    q = asyncio.new_event_loop().run_until_complete(run())
+    assert q.inflight_bytes == 150
+    assert q.peak_inflight_bytes == 150
@@ -0,0 +1,17 @@
+import pytest
+
+from csvtopg.batching import Segment
+from csvtopg.checkpoints import CheckpointError, missing_rows, plan_reads
+
+
+def test_plan_reads_skips_copied_blocks_and_keeps_partial_ones():
+    segments = [Segment(10, 20, 0, 3, 5), Segment(10, 20, 3, 5, 5),
+                Segment(40, 50, 2, 4, 6), Segment(20, 30, 0, 1, 1)]
+    assert plan_reads(10, 60, segments) == [
+        (30, 40, []), (40, 50, [(2, 4)]), (50, 60, [])]
+    assert missing_rows(6, [(2, 4)]) == [(0, 2), (4, 6)]
+
+
+def test_plan_reads_rejects_blocks_across_the_range():
+    with pytest.raises(CheckpointError):
+        plan_reads(15, 60, [Segment(10, 20, 0, 3, 5)])
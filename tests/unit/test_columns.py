@@ -0,0 +1,39 @@
+import pytest
+
+from csvtopg.columns import ColumnError, ColumnSpec, Projection
+from csvtopg.configuration import Config
+
+HEADER = ['id', 'E-mail', 'Date', 'unused']
+
+
+def test_projection_selects_renames_and_transforms_columns():
+    projection = Projection(HEADER, {
+        'email': ColumnSpec(source='E-mail', trim=True, lower=True,
+                            null_if_empty=True),
+        'id': ColumnSpec(regex_replace=['^0+', '']),
+        'day': ColumnSpec(source='Date', date_format='%d/%m/%Y')})
+    assert projection.names == ['email', 'id', 'day']
+    assert projection([['007', ' Bob@X.org ', '31/01/2020', 'x'],
+                       ['10', '  ', 'unknown', 'y']]) == [
+        ('bob@x.org', '7', '2020-01-31'), (None, '10', 'unknown')]
+
+
+def test_projection_of_short_rows_and_single_columns():
+    projection = Projection(HEADER, {'Date': ColumnSpec()})
+    assert projection([['1', 'a', 'd'], ['2']]) == [('d',), ('',)]
+
+
+def test_unknown_source_column():
+    with pytest.raises(ColumnError):
+        Projection(HEADER, {'email': ColumnSpec()})
+
+
+def test_columns_from_configuration():
+    config = Config.from_dict({
+        'conn_uri': '1', 'table_name': 'table', 'input_file': __file__,
+        'use_uvloop': False, 'log_level': 'INFO', 'columns': {
+            'id': {}, 'email': {'source': 'E-mail', 'lower': True,
+                                'upper': True}}})
+    assert config.columns['email'].source == 'E-mail'
+    assert config.configuration_issues == [
+        'Column "email": lower and upper are exclusive.']
@@ -0,0 +1,50 @@
+import asyncio
+import gzip
+
+import pytest
+
+from csvtopg.compression import (
+    CompressedFile, detect_compression, find_frames)
+
+DATA = b''.join(b'%d,name %d\n' % (i, i) for i in range(10000))
+
+
+def read_all(path, compression, offset=0, num_threads=1):
+    async def read():
+        chunks = []
+        async with CompressedFile(path, compression, num_threads) as f:
+            reader = f.reader(chunk_size=1000, offset=offset)
+            while True:
+                chunk = await reader.read_chunk()
+                if not chunk:
+                    return b''.join(chunks)
+                chunks.append(chunk)
+    return asyncio.new_event_loop().run_until_complete(read())
+
+
+def test_gzip_is_detected_and_read_from_an_offset(tmp_path):
+    path = str(tmp_path / 'data.csv.gz')
+    with open(path, 'wb') as f:
+        f.write(gzip.compress(DATA))
+    assert detect_compression(path) == 'gzip'
+    assert read_all(path, 'gzip', offset=5) == DATA[5:]
+
+
+@pytest.mark.parametrize('compression', ['zstd', 'lz4'])
+def test_frames_are_decompressed_in_parallel(tmp_path, compression):
+    parts = [DATA[i:i + 20000] for i in range(0, len(DATA), 20000)]
+    if compression == 'zstd':
+        zstandard = pytest.importorskip('zstandard')
+        frames = [zstandard.ZstdCompressor(write_checksum=True).compress(part)
+                  for part in parts]
+    else:
+        lz4_frame = pytest.importorskip('lz4.frame')
+        frames = [lz4_frame.compress(part, block_checksum=True,
+                                     block_size=lz4_frame.BLOCKSIZE_MAX64KB)
+                  for part in parts]
+    path = str(tmp_path / 'data.csv')
+    with open(path, 'wb') as f:
+        f.write(b''.join(frames))
+    assert detect_compression(path) == compression
+    assert len(find_frames(path, compression)) == len(parts)
+    assert read_all(path, compression, num_threads=3) == DATA
@@ -7,3 +7,41 @@ def test_invalid_log_level_returns_an_error():
                   input_file="1",
                   use_uvloop=False,
                   log_level='INFU').configuration_issues != []
+
+
+def test_input_files_expands_directories_and_globs(tmp_path):
+    for name in ('b.csv', 'a.csv', 'a.csv.checkpoint', 'c.txt'):
+        (tmp_path / name).write_text('x\n')
+    config = Config(conn_uri="1", table_name="table",
+                    input_file=[str(tmp_path / '*.csv'), str(tmp_path)],
+                    use_uvloop=False, log_level='INFO')
+    assert config.input_files == [
+        str(tmp_path / name) for name in ('a.csv', 'b.csv', 'c.txt')]
+    assert config.configuration_issues == []
+
+
+def test_conflict_policy_requires_key_columns():
+    config = Config(conn_uri="1", table_name="table", input_file=__file__,
+                    use_uvloop=False, log_level='INFO', on_conflict='update',
+                    update_columns=['id'])
+    assert config.configuration_issues == [
+        'A conflict policy requires key columns.']
+    config.key_columns = ['id']
+    assert config.configuration_issues == ['Key columns cannot be updated.']
+    config.update_columns = []
+    config.shared_snapshot = True
+    assert config.configuration_issues == []
+    config.num_writers = 2
+    assert 'Writers sharing a snapshot cannot merge rows on conflicts' in \
+        config.configuration_issues[0]
+
+
+def test_table_names_are_plain_identifiers():
+    config = Config(conn_uri="1", table_name="public.sales$2020",
+                    input_file=__file__, use_uvloop=False, log_level='INFO')
+    assert config.configuration_issues == []
+    config.table_name = 'sales; DROP TABLE users'
+    config.dead_letter_table = '"rejected"'
+    issues = config.configuration_issues
+    assert [issue.split(':')[0] for issue in issues] == [
+        'Invalid table_name', 'Invalid dead_letter_table']
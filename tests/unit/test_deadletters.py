@@ -0,0 +1,69 @@
+import asyncio
+import csv
+import io
+
+from csvtopg.aiocsv import AsyncChunkReader, OnError
+from csvtopg.deadletters import FileDeadLetters
+from csvtopg.pgtypes import RowConverter
+from csvtopg.sources import FileSource
+
+
+def test_file_dead_letters_are_written_by_buffers(tmp_path):
+    path = tmp_path / 'data.csv.rejected'
+
+    async def reject():
+        dead_letters = FileDeadLetters(str(path), 'data.csv', buffer_rows=2)
+        for line in range(2, 7):
+            dead_letters.reject(0, line, 'bad', ['a', 'b,c'])
+        await asyncio.sleep(0.1)
+        assert not dead_letters.pending and path.exists()
+        await dead_letters.close()
+        return dead_letters.num_rejected
+
+    assert asyncio.new_event_loop().run_until_complete(reject()) == 5
+    rows = list(csv.DictReader(io.StringIO(path.read_text())))
+    assert [row['line'] for row in rows] == ['2', '3', '4', '5', '6']
+    assert rows[0]['record'] == 'a,"b,c"'
+
+
+def test_worker_dead_letters_are_merged_in_byte_range_order(tmp_path):
+    path = tmp_path / 'data.csv.rejected'
+
+    async def reject():
+        for byte_range_start in (100, 4):
+            dead_letters = FileDeadLetters(str(path), 'data.csv',
+                                           byte_range_start)
+            dead_letters.reject(byte_range_start, 2, 'bad', ['a'])
+            await dead_letters.close()
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(reject())
+    loop.close()
+    assert not path.exists()
+    FileDeadLetters(str(path), 'data.csv').merge_worker_files([4, 100, 200])
+    rows = list(csv.DictReader(io.StringIO(path.read_text())))
+    assert [row['byte_offset'] for row in rows] == ['4', '100']
+    assert [p.name for p in tmp_path.iterdir()] == [path.name]
+
+
+def test_rejected_rows_are_located_by_line(tmp_path):
+    path = tmp_path / 'data.csv'
+    path.write_bytes(b'a,b\n1,"x\ny"\n2\n3,z\nq,w\n')
+    rejected = []
+
+    async def read():
+        async with FileSource(str(path)) as f:
+            reader = AsyncChunkReader(f, offset=4)
+            reader.expected_num_fields = 2
+            reader.line_num = 1
+            reader.reject = lambda *args: rejected.append(args)
+            convert = RowConverter(['a', 'b'], {'a': 'int'},
+                                   OnError.skip_silently)
+            convert.reject = lambda row, reason, fields: rejected.append(
+                (reader.row_lines()[row], reason, fields))
+            return [row async for rows in reader for row in convert(rows)]
+
+    rows = asyncio.new_event_loop().run_until_complete(read())
+    assert rows == [(1, 'x\ny'), (3, 'z')]
+    assert [(line, row) for line, _, row in rejected] == [
+        (4, ['2']), (6, ['q', 'w'])]
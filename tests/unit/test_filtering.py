@@ -0,0 +1,43 @@
+import datetime
+from decimal import Decimal
+
+import pytest
+
+from csvtopg.filtering import FilterError, RowFilter
+
+COLUMNS = ['country', 'amount', 'day']
+TYPES = {'amount': 'numeric', 'day': 'date'}
+
+
+def test_filter_compares_literals_as_typed_values():
+    row_filter = RowFilter(
+        'country in ["SG", "MY"] and amount > 0 and day >= "2020-01-02"',
+        COLUMNS, TYPES)
+    rows = [('SG', Decimal('1.5'), datetime.date(2020, 1, 2)),
+            ('FR', Decimal('1.5'), datetime.date(2020, 1, 2)),
+            ('MY', Decimal('-1'), datetime.date(2020, 1, 2)),
+            ('MY', Decimal('2'), datetime.date(2019, 12, 31))]
+    assert row_filter(rows) == rows[:1]
+
+
+def test_null_fields_fail_ordering_comparisons():
+    rows = [('SG', None, None), ('SG', Decimal('2'), None)]
+    assert RowFilter('amount > 1', COLUMNS, TYPES)(rows) == rows[1:]
+    assert RowFilter('day is None and not amount', COLUMNS,
+                     TYPES)(rows) == rows[:1]
+
+
+@pytest.mark.parametrize('expression', [
+    'country == "SG" and', 'city == "Paris"', 'country.lower() == "sg"',
+    'amount > "a lot"'])
+def test_invalid_filters(expression):
+    with pytest.raises(FilterError):
+        RowFilter(expression, COLUMNS, TYPES)
+
+
+@pytest.mark.parametrize('expression', [
+    'country == "SG" and amount > 0', 'amount + 1 > "2"', '-amount < "2"',
+    'country in ["SG", 1]'])
+def test_numbers_compared_with_untyped_columns_are_rejected(expression):
+    with pytest.raises(FilterError, match='set its type in column_types'):
+        RowFilter(expression, COLUMNS)
@@ -0,0 +1,82 @@
+import asyncio
+import datetime
+
+import pytest
+
+from csvtopg.aiocsv import OnError
+from csvtopg.formats import ColumnarFile, NdjsonReader, detect_format
+from csvtopg.sources import FileSource
+
+NDJSON = b''.join(
+    b'{"id": %d, "name": "name %d", "tags": [%d]}\n' % (i, i, i)
+    if i != 42 else b'not json\n' for i in range(100))
+
+
+def test_ndjson_is_parsed_by_blocks(tmp_path):
+    path = tmp_path / 'data.ndjson'
+    path.write_bytes(b'{"id": -1, "name": null}\n' + NDJSON)
+    assert detect_format(str(path)) == 'ndjson'
+    rejected = []
+
+    async def read():
+        async with FileSource(str(path)) as f:
+            header = await NdjsonReader(f).read_header()
+            reader = NdjsonReader(f, chunk_size=100,
+                                  on_wrong_length=OnError.skip_silently)
+            reader.keys = header
+            reader.reject = lambda *args: rejected.append(args)
+            rows = []
+            async for block in reader:
+                rows.extend(zip(reader.row_lines(), block))
+            return header, rows
+
+    header, rows = asyncio.new_event_loop().run_until_complete(read())
+    assert header == ['id', 'name']
+    assert rows[0] == (1, ('-1', None))
+    assert rows[1] == (2, ('0', 'name 0'))
+    assert len(rows) == 100 and rows[-1] == (101, ('99', 'name 99'))
+    assert [(line, row) for line, _, row in rejected] == [(44, ['not json'])]
+
+
+def test_ndjson_lines_of_several_objects_are_rejected(tmp_path):
+    path = tmp_path / 'data.ndjson'
+    path.write_bytes(b'{"id": 0}\n{"id": 1}, {"id": 2}\n{"id": 3}\n')
+    rejected = []
+
+    async def read():
+        async with FileSource(str(path)) as f:
+            reader = NdjsonReader(f, on_wrong_length=OnError.skip_silently)
+            reader.keys = await reader.read_header()
+            reader.reject = lambda *args: rejected.append(args)
+            rows = []
+            async for block in reader:
+                rows.extend(zip(reader.row_lines(), block))
+            return rows
+
+    rows = asyncio.new_event_loop().run_until_complete(read())
+    assert rows == [(1, ('0',)), (3, ('3',))]
+    assert [line for line, _, _ in rejected] == [2]
+
+
+def test_parquet_row_groups_are_read_in_parallel_in_order(tmp_path):
+    pyarrow = pytest.importorskip('pyarrow')
+    parquet = pytest.importorskip('pyarrow.parquet')
+    path = str(tmp_path / 'data.parquet')
+    table = pyarrow.table({
+        'id': pyarrow.array(range(1000), pyarrow.int32()),
+        'at': pyarrow.array([datetime.datetime(2020, 1, 1)] * 1000),
+        'name': [f'name {i}' for i in range(1000)]})
+    parquet.write_table(table, path, row_group_size=64)
+    assert detect_format(path) == 'parquet'
+
+    async def read():
+        async with ColumnarFile(path, 'parquet', num_threads=4) as f:
+            assert f.column_types == {
+                'id': 'int', 'at': 'timestamptz', 'name': 'text'}
+            reader = f.reader(['id', 'at'], {'id'})
+            return [row async for rows in reader for row in rows]
+
+    rows = asyncio.new_event_loop().run_until_complete(read())
+    assert [row[0] for row in rows] == [str(i) for i in range(1000)]
+    assert rows[0][1] == datetime.datetime(2020, 1, 1,
+                                           tzinfo=datetime.timezone.utc)
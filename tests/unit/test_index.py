@@ -0,0 +1,71 @@
+import asyncio
+
+from csvtopg.aiocsv import AsyncChunkReader
+from csvtopg.index import (
+    RecordIndex, build_index, fingerprint, import_numpy, index_path,
+    record_ends, record_ends_vectorized)
+from csvtopg.sources import FileSource
+
+CSV = b'id,text\n' + b''.join(
+    b'%d,"line\nbreak ""%d"""\n' % (i, i) if i % 3 == 0 else b'%d,x\n' % i
+    for i in range(100))
+
+
+def test_index_records_across_blocks(tmp_path):
+    path = tmp_path / 'data.csv'
+    path.write_bytes(CSV)
+    index = build_index(str(path), stride=7, block_size=16)
+    assert (index.num_records, index.num_fields) == (100, 2)
+    assert index.header_end == len(b'id,text\n')
+    assert len(index.offsets) == 15
+    for i, offset in enumerate(index.offsets):
+        assert CSV[offset:].startswith(b'%d,' % (7 * i))
+    numpy = import_numpy()
+    if numpy is not None:
+        ends, odd = record_ends_vectorized(numpy, CSV[:40], True)
+        assert (list(ends), odd) == record_ends(CSV[:40], True)
+
+
+def test_saved_index_matches_its_file(tmp_path):
+    path = tmp_path / 'data.csv'
+    path.write_bytes(CSV)
+    build_index(str(path), stride=10).save(index_path(str(path)))
+    index = RecordIndex.load(index_path(str(path)))
+    assert index == build_index(str(path), stride=10)
+    assert index.matches(str(path))
+    path.write_bytes(CSV.replace(b'98,x', b'98,y'))
+    assert not index.matches(str(path))
+
+
+def test_index_does_not_match_moved_records(tmp_path):
+    path = tmp_path / 'data.csv'
+    data = b'id,text\n' + b''.join(b'%06d,x\n' % i for i in range(200000))
+    path.write_bytes(data)
+    index = build_index(str(path), stride=10)
+    # records 5001 to 5011, between two samples, moved by one byte
+    start, end = data.index(b'005001,'), data.index(b'005012,')
+    path.write_bytes(data[:start] + b' ' + data[start:end - 2] + b'\n' +
+                     data[end:])
+    assert fingerprint(str(path)) == index.fingerprint
+    assert not index.matches(str(path))
+
+
+def test_split_and_seek_on_indexed_records(tmp_path):
+    path = tmp_path / 'data.csv'
+    path.write_bytes(CSV)
+    index = build_index(str(path), stride=10)
+    ranges = index.split(4)
+    assert len(ranges) == 4
+    assert ranges[0][0] == index.header_end and ranges[-1][1] == len(CSV)
+    assert sum(index.records_between(*r) for r in ranges) == 100
+
+    async def read(window):
+        async with FileSource(str(path)) as f:
+            reader = AsyncChunkReader(f, chunk_size=32, offset=window.start,
+                                      end=window.end)
+            reader.window = window
+            return [row async for rows in reader for row in rows]
+
+    rows = asyncio.new_event_loop().run_until_complete(
+        read(index.seek(25, 42)))
+    assert [row[0] for row in rows] == [str(i) for i in range(25, 42)]
@@ -0,0 +1,22 @@
+from csvtopg.inference import infer_column_type, infer_column_types
+
+
+def test_infer_column_type_picks_the_narrowest_type():
+    assert infer_column_type(['yes', 'No', '']) == 'bool'
+    assert infer_column_type(['1', '0', '-12']) == 'int'
+    assert infer_column_type(['1', '3000000000']) == 'bigint'
+    assert infer_column_type(['1', '2.50']) == 'numeric'
+    assert infer_column_type(['1.5', 'NaN', '-1e-3']) == 'float8'
+    assert infer_column_type(['2020-01-31']) == 'date'
+    assert infer_column_type(['2020-02-30']) == 'text'
+    assert infer_column_type(['2020-01-31 10:00', '2020-01-31T10:00Z']) == \
+        'timestamptz'
+    assert infer_column_type(['12345678-1234-1234-1234-123456789abc']) == \
+        'uuid'
+    assert infer_column_type(['{"a": 1}', '[]']) == 'json'
+    assert infer_column_type(['00123', '1']) == 'text'
+
+
+def test_infer_column_types_omits_text_columns():
+    rows = [['1', 'a', ''], ['2', 'b', '']]
+    assert infer_column_types(['x', 'y', 'z'], rows) == {'x': 'int'}
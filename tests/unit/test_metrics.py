@@ -0,0 +1,25 @@
+from csvtopg.metrics import Metrics, format_prometheus
+
+
+def test_merge_adds_stage_times_and_latencies():
+    metrics = Metrics(parse_time=1., num_bytes_copied=10,
+                      batch_copy_latencies=[0.1, 0.3])
+    metrics.merge(Metrics(parse_time=2., num_bytes_copied=5,
+                          batch_copy_latencies=[0.2, 0.4]))
+    assert metrics.parse_time == 3.
+    assert metrics.num_bytes_copied == 15
+    assert metrics.batch_copy_latency_percentiles == {
+        'p50': 0.2, 'p90': 0.4, 'p99': 0.4, 'max': 0.4}
+
+
+def test_format_prometheus():
+    metrics = Metrics(num_rows_written=3, copy_time=0.5,
+                      queue_depth_samples=[(0., 2), (1., 5)],
+                      batch_copy_latencies=[0.5])
+    text = format_prometheus(metrics, table='t')
+    assert 'csvtopg_rows_written_total{table="t"} 3\n' in text
+    assert 'csvtopg_copy_seconds_total{table="t"} 0.5\n' in text
+    assert 'csvtopg_queue_depth{table="t"} 5\n' in text
+    assert 'csvtopg_batch_copy_latency_seconds{table="t",quantile="0.99"}' \
+        ' 0.5\n' in text
+    assert text.count('# TYPE csvtopg_batch_copy_latency_seconds ') == 1
@@ -0,0 +1,26 @@
+import datetime
+
+from csvtopg.packing import PackedRows
+
+ROWS = [['1', 'plain', 'é'], ['2', 'tab\there', 'back\\slash'],
+        ['3', 'line\nbreak', '\\N'], ['4', '', 'cr\r']]
+
+
+def test_packed_rows_are_copy_text():
+    packed = PackedRows.pack(ROWS[:1] + ROWS[3:1:-1])
+    assert bytes(packed.data) == (
+        '1\tplain\té\n4\t\tcr\\r\n3\tline\\nbreak\t\\\\N\n'.encode())
+    assert len(packed) == 3
+    assert [list(row) for row in packed] == [ROWS[0], ROWS[3], ROWS[2]]
+    typed = PackedRows.pack([[1, None, datetime.date(2020, 1, 31)]])
+    assert bytes(typed.data) == b'1\t\\N\t2020-01-31\n'
+    assert list(typed[0]) == ['1', None, '2020-01-31']
+
+
+def test_packed_rows_are_sliced_without_copies():
+    packed = PackedRows.pack(ROWS)
+    half = packed[1:3]
+    assert isinstance(half.data, memoryview)
+    assert [list(row) for row in half] == ROWS[1:3]
+    assert half[-1][2] == '\\N' and half[0][1] == 'tab\there'
+    assert len(packed[4:]) == 0
@@ -0,0 +1,29 @@
+import datetime
+import decimal
+
+import pytest
+
+from csvtopg.aiocsv import OnError
+from csvtopg.pgtypes import ConversionError, RowConverter
+
+
+def test_row_converter_converts_columns_and_nulls_empty_fields():
+    convert = RowConverter(['a', 'b', 'c', 'd'],
+                           {'a': 'int', 'b': 'numeric', 'c': 'timestamptz'})
+    assert convert([['1', '2.5', '2020-01-02T03:04:05Z', 'x'],
+                    ['', '', '', '']]) == [
+        (1, decimal.Decimal('2.5'),
+         datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc),
+         'x'),
+        (None, None, None, '')]
+
+
+def test_row_converter_applies_error_policy():
+    rows = [['1', 't'], ['x', 'f'], ['3', 'maybe']]
+    types = {'a': 'bigint', 'b': 'bool'}
+    with pytest.warns(UserWarning):
+        assert RowConverter(['a', 'b'], types)(rows) == [(1, True)]
+    assert RowConverter(['a', 'b'], types, OnError.leroy_jenkins)(rows) == [
+        (1, True), (None, False), (3, None)]
+    with pytest.raises(ConversionError, match="'x'"):
+        RowConverter(['a', 'b'], types, OnError.exception)(rows)
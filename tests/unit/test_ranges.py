@@ -0,0 +1,23 @@
+from csvtopg.ranges import find_first_record_end, split_records
+
+
+def test_find_first_record_end_skips_quoted_newlines():
+    assert find_first_record_end(b'a,"b\n""c"""\nd') == 12
+    assert find_first_record_end(b'a,"b\nc') == 0
+
+
+def test_split_records_starts_ranges_on_record_boundaries(tmp_path):
+    path = tmp_path / 'quoted.csv'
+    records = [f'{i},"line\n{i}\n"\n'.encode() for i in range(100)]
+    path.write_bytes(b''.join(records))
+    ranges = split_records(str(path), 7, block_size=64)
+    assert len(ranges) == 7
+    assert ranges[0][0] == 0 and ranges[-1][1] == path.stat().st_size
+    starts = set()
+    offset = 0
+    for record in records:
+        starts.add(offset)
+        offset += len(record)
+    for (start, end), (next_start, _) in zip(ranges, ranges[1:]):
+        assert end == next_start
+        assert next_start in starts
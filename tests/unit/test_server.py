@@ -0,0 +1,116 @@
+import asyncio
+import json
+import os
+import stat
+
+import pytest
+
+from csvtopg.server import LoadServer, RequestError
+
+
+async def request(socket_path, method, path, body=b''):
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    writer.write(f'{method} {path} HTTP/1.1\r\nHost: localhost\r\n'
+                 f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    return int(head.split()[1]), json.loads(body)
+
+
+def serve_requests(tmp_path, *requests):
+    socket_path = str(tmp_path / 'csvtopg.sock')
+
+    async def run():
+        server = LoadServer(str(tmp_path), max_jobs=2, pool_size=2)
+        listener = await server.start(socket_path, None, None)
+        assert stat.S_IMODE(os.stat(socket_path).st_mode) == 0o600
+        try:
+            return [await request(socket_path, *r) for r in requests]
+        finally:
+            listener.close()
+            await server.close()
+
+    return asyncio.new_event_loop().run_until_complete(run())
+
+
+def test_health_and_unknown_endpoints(tmp_path):
+    responses = serve_requests(tmp_path, ('GET', '/health'),
+                               ('GET', '/jobs'), ('GET', '/nope'))
+    assert responses[0] == (200, {'running_jobs': 0, 'completed_jobs': 0,
+                                  'pools': 0})
+    assert [status for status, _ in responses[1:]] == [405, 404]
+
+
+def test_invalid_jobs_are_rejected_before_connecting(tmp_path):
+    path = tmp_path / 'data.csv'
+    path.write_text('a,b\n1,2\n')
+    job = {'conn_uri': 'postgres://localhost:1/db', 'table_name': 't',
+           'input_file': str(path)}
+    responses = serve_requests(
+        tmp_path, ('POST', '/jobs', b'{"table_name": '),
+        ('POST', '/jobs', json.dumps({**job, 'num_processes': 2}).encode()),
+        ('POST', '/jobs', json.dumps({**job, 'input_file': '-'}).encode()),
+        ('POST', '/jobs', json.dumps({**job, 'num_writers': 3}).encode()),
+        ('POST', '/jobs', json.dumps({**job, 'shared_snapshot': True,
+                                      'num_writers': 2}).encode()))
+    assert [status for status, _ in responses] == [400] * 5
+    assert responses[0][1]['error'].startswith('Invalid JSON')
+    assert 'num_processes must be 1' in responses[1][1]['error']
+    assert 'standard input' in responses[2][1]['error']
+    assert 'at most 2 writers' in responses[3][1]['error']
+    assert 'share a snapshot' in responses[4][1]['error']
+
+
+def test_jobs_cannot_use_files_outside_of_the_root(tmp_path):
+    root = tmp_path / 'root'
+    root.mkdir()
+    (root / 'data.csv').write_text('a,b\n1,2\n')
+    (root / 'link.csv').symlink_to(tmp_path / 'secret.csv')
+    (tmp_path / 'secret.csv').write_text('a,b\n1,2\n')
+    job = {'conn_uri': 'postgres://localhost:1/db', 'table_name': 't',
+           'input_file': str(root / 'data.csv')}
+    jobs = [{**job, 'input_file': str(root / '..' / 'secret.csv')},
+            {**job, 'input_file': str(root / 'link.csv')},
+            {**job, 'dead_letter': 'file',
+             'dead_letter_file': str(tmp_path / 'rejected.csv')},
+            {**job, 'schema_file': '/etc/passwd'},
+            {**job, 'checkpoint': 'file', 'checkpoint_file': '/tmp/c'},
+            {**job, 'metrics_prometheus_file': '/tmp/csvtopg.prom'}]
+
+    async def run():
+        server = LoadServer(str(root))
+        assert server.job_config(job).input_files == [job['input_file']]
+        for outside in jobs:
+            with pytest.raises(RequestError, match='outside of'):
+                server.job_config(outside)
+        with pytest.raises(ValueError, match='loopback'):
+            await server.start(None, '0.0.0.0', 0)
+
+    asyncio.new_event_loop().run_until_complete(run())
+
+
+def test_tcp_requests_require_the_token(tmp_path):
+    async def get_health(port, headers):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(f'GET /health HTTP/1.1\r\n{headers}\r\n'.encode())
+        response = await reader.read()
+        writer.close()
+        return int(response.split()[1])
+
+    async def run():
+        with pytest.raises(ValueError, match='token'):
+            await LoadServer(str(tmp_path)).start(None, '127.0.0.1', 0)
+        server = LoadServer(str(tmp_path), token='s3cret')
+        listener = await server.start(None, '127.0.0.1', 0)
+        port = listener.sockets[0].getsockname()[1]
+        try:
+            return [await get_health(port, headers) for headers in (
+                '', 'Authorization: Bearer nope\r\n',
+                'Authorization: Bearer s3cret\r\n')]
+        finally:
+            listener.close()
+            await server.close()
+
+    assert asyncio.new_event_loop().run_until_complete(run()) == [
+        401, 401, 200]
@@ -0,0 +1,66 @@
+import asyncio
+import gzip
+import os
+import threading
+
+from csvtopg.aiocsv import AsyncChunkReader, MmapChunkReader
+from csvtopg.sources import MmapSource, StreamSource, is_stream
+
+DATA = b'id,name\n' + b''.join(b'%d,name %d\n' % (i, i) for i in range(1000))
+
+
+def read_rows(source):
+    async def read():
+        async with source as f:
+            reader = AsyncChunkReader(f, chunk_size=100)
+            header = await reader.read_header()
+            if not f.seekable:
+                f.unread(reader.tail)
+            reader = AsyncChunkReader(f, chunk_size=1000,
+                                      offset=reader.records_end)
+            return header, [row async for rows in reader for row in rows]
+    return asyncio.new_event_loop().run_until_complete(read())
+
+
+def test_mmap_source(tmp_path):
+    path = tmp_path / 'data.csv'
+    path.write_bytes(DATA)
+    header, rows = read_rows(MmapSource(str(path)))
+    assert header == ['id', 'name']
+    assert len(rows) == 1000 and rows[-1] == ['999', 'name 999']
+
+
+def test_compressed_stream_from_a_named_pipe(tmp_path):
+    path = str(tmp_path / 'fifo')
+    os.mkfifo(path)
+    assert is_stream(path)
+
+    def write():
+        with open(path, 'wb') as f:
+            f.write(gzip.compress(DATA))
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    header, rows = read_rows(StreamSource(path))
+    writer.join()
+    assert header == ['id', 'name']
+    assert rows[0] == ['0', 'name 0'] and len(rows) == 1000
+
+
+def test_mmap_chunk_reader_splits_blocks_on_records(tmp_path):
+    path = tmp_path / 'data.csv'
+    long_field = b'"' + b'\n'.join([b'line'] * 20) + b'"'
+    path.write_bytes(b'a,b\n1,"x\ny"\n2,"z,""w"""\n3,' + long_field +
+                     b'\n4,12" ruler\n5,v')
+
+    async def read():
+        async with MmapSource(str(path)) as f:
+            reader = MmapChunkReader(f, chunk_size=5)
+            return await reader.read_header(), [
+                row async for rows in reader for row in rows]
+
+    header, rows = asyncio.new_event_loop().run_until_complete(read())
+    assert header == ['a', 'b']
+    assert rows == [['1', 'x\ny'], ['2', 'z,"w"'],
+                    ['3', '\n'.join(['line'] * 20)], ['4', '12" ruler'],
+                    ['5', 'v']]
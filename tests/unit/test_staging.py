@@ -0,0 +1,24 @@
+from csvtopg.staging import (
+    StagingLoad, merge_statement, rewrite_index_definition)
+
+
+def test_index_definitions_are_moved_to_the_staging_table():
+    assert rewrite_index_definition(
+        'CREATE INDEX "On idx" ON ONLY s.t USING gin (j) WHERE (a > 0)',
+        'i0', 's.t_staging') == \
+        'CREATE INDEX i0 ON s.t_staging USING gin (j) WHERE (a > 0)'
+
+
+def test_merge_statements():
+    assert 'SELECT "a" FROM t_staging\nRETURNING' in merge_statement(
+        't', 't_staging', ['a'], [])
+    assert 'ON CONFLICT ("a") DO NOTHING' in merge_statement(
+        't', 't_merge', ['a', 'b'], ['a'], 'ignore')
+    assert 'DO UPDATE SET "c" = EXCLUDED."c"\n' in merge_statement(
+        't', 't_merge', ['a', 'b', 'c'], ['a'], 'update', ['c'])
+
+
+def test_temporary_names_fit_in_identifiers():
+    staging = StagingLoad('s.' + 'x' * 70, 'swap', [])
+    assert staging.staging_table == 's.' + 'x' * 70 + '_staging'
+    assert staging.temporary_name(12) == 'x' * 60 + '_12'